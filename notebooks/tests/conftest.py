@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# the notebooks import the utilities as the `utils` package from the notebooks directory
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+DATA_DIR = Path(__file__).resolve().parents[2] / "data"
@@ -0,0 +1,101 @@
+import contextlib
+import copy
+import io
+import json
+
+import numpy as np
+import pytest
+from conftest import DATA_DIR
+from utils.coco_eval import CocoEvaluator, evaluate_coco
+
+pycocotools = pytest.importorskip("pycocotools")
+from pycocotools.coco import COCO  # noqa: E402
+from pycocotools.cocoeval import COCOeval  # noqa: E402
+
+MAX_DETECTIONS = (1, 10, 100)
+
+
+@pytest.fixture(scope="module")
+def coco():
+    with open(
+        DATA_DIR / "coco-annotations" / "annotations" / "instances_default.json"
+    ) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module")
+def results(coco):
+    """Jittered ground truths, misses, duplicates and false positives of other categories."""
+    rng = np.random.default_rng(0)
+    category_ids = [c["id"] for c in coco["categories"]]
+    results = []
+    for annotation in coco["annotations"]:
+        if rng.random() < 0.2:
+            continue
+        x, y, w, h = annotation["bbox"]
+        for _ in range(rng.integers(1, 3)):
+            jitter = rng.normal(0, 0.1, 4) * [w, h, w, h]
+            results.append(
+                {
+                    "image_id": annotation["image_id"],
+                    "category_id": annotation["category_id"],
+                    "bbox": [
+                        x + jitter[0],
+                        y + jitter[1],
+                        w + jitter[2],
+                        h + jitter[3],
+                    ],
+                    "score": float(rng.random()),
+                }
+            )
+    for image in coco["images"]:
+        for _ in range(rng.integers(0, 4)):
+            x, y = rng.random(2) * [image["width"], image["height"]]
+            w, h = rng.random(2) * 100 + 1
+            results.append(
+                {
+                    "image_id": image["id"],
+                    "category_id": int(rng.choice(category_ids)),
+                    "bbox": [x, y, w, h],
+                    "score": float(rng.random()),
+                }
+            )
+    return results
+
+
+def _pycocotools_stats(coco, results):
+    with contextlib.redirect_stdout(io.StringIO()):
+        ground_truth = COCO()
+        ground_truth.dataset = copy.deepcopy(coco)
+        ground_truth.createIndex()
+        evaluation = COCOeval(
+            ground_truth, ground_truth.loadRes(copy.deepcopy(results)), "bbox"
+        )
+        evaluation.params.maxDets = list(MAX_DETECTIONS)
+        evaluation.evaluate()
+        evaluation.accumulate()
+        evaluation.summarize()
+    return evaluation.stats
+
+
+@pytest.mark.parametrize("batch_size", [1, 7, 64, 512])
+def test_evaluate_coco_matches_pycocotools(coco, results, batch_size):
+    evaluator = evaluate_coco(coco, results, MAX_DETECTIONS, batch_size=batch_size)
+    stats = evaluator.summarize(verbose=False)
+    np.testing.assert_allclose(stats, _pycocotools_stats(coco, results), atol=1e-6)
+
+
+def test_detections_without_ground_truth_in_batch():
+    annotation = {
+        "image_id": 1,
+        "category_id": 1,
+        "bbox": [0, 0, 10, 10],
+        "area": 100,
+        "iscrowd": 0,
+    }
+    result = {"image_id": 1, "category_id": 2, "bbox": [0, 0, 10, 10], "score": 0.9}
+    evaluator = CocoEvaluator([1, 2], MAX_DETECTIONS)
+    evaluator.update([1], [annotation], [result])
+    stats = evaluator.summarize(verbose=False)
+    # category 1 has no detection, category 2 no ground truth
+    assert stats[0] == 0
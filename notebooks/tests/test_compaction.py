@@ -0,0 +1,71 @@
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+from utils.compaction import compact_model
+from utils.runtime import create_session_from_model
+
+
+def _bloated_model():
+    """A Conv model with a duplicated weight behind Identity nodes, a dead branch and an unused initializer."""
+    rng = np.random.default_rng(0)
+    weight = rng.standard_normal((4, 3, 3, 3)).astype(np.float32)
+    initializers = [
+        numpy_helper.from_array(weight, "weight"),
+        numpy_helper.from_array(weight.copy(), "weight_copy"),
+        numpy_helper.from_array(np.ones(1000, np.int8), "dead_quantized"),
+        numpy_helper.from_array(np.float32(0.1), "dead_scale"),
+        numpy_helper.from_array(np.zeros(500, np.float32), "unused"),
+    ]
+    nodes = [
+        helper.make_node("Identity", ["weight_copy"], ["weight_1"]),
+        helper.make_node("Identity", ["weight_1"], ["weight_2"]),
+        helper.make_node(
+            "DequantizeLinear", ["dead_quantized", "dead_scale"], ["dead"]
+        ),
+        helper.make_node("Conv", ["input", "weight"], ["a"], pads=[1, 1, 1, 1]),
+        helper.make_node("Conv", ["input", "weight_2"], ["b"], pads=[1, 1, 1, 1]),
+        helper.make_node("Add", ["a", "b"], ["sum"]),
+        # an Identity producing a graph output is kept
+        helper.make_node("Identity", ["sum"], ["output"]),
+    ]
+    graph = helper.make_graph(
+        nodes,
+        "bloated",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, [1, 3, 8, 8])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, 4, 8, 8])],
+        initializers,
+    )
+    return helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 17)], ir_version=9
+    )
+
+
+def test_compaction_removes_redundancy():
+    model = _bloated_model()
+    compacted = compact_model(model)
+    onnx.checker.check_model(compacted, full_check=True)
+    assert [n.op_type for n in compacted.graph.node] == [
+        "Conv",
+        "Conv",
+        "Add",
+        "Identity",
+    ]
+    assert [i.name for i in compacted.graph.initializer] == ["weight"]
+    assert compacted.ByteSize() < model.ByteSize()
+    # the input model is not modified
+    assert len(model.graph.node) == 7
+
+
+def test_compacted_model_has_the_same_outputs():
+    model = _bloated_model()
+    compacted = compact_model(model)
+    x = np.random.default_rng(1).standard_normal((1, 3, 8, 8)).astype(np.float32)
+    (expected,) = create_session_from_model(model).run(None, {"input": x})
+    (actual,) = create_session_from_model(compacted).run(None, {"input": x})
+    # ONNX Runtime may fuse the two Convs differently, so equal up to float rounding
+    np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_compaction_is_idempotent():
+    compacted = compact_model(_bloated_model())
+    assert compact_model(compacted).SerializeToString() == compacted.SerializeToString()
@@ -0,0 +1,121 @@
+import zipfile
+
+import numpy as np
+import onnx
+import pytest
+from onnx import TensorProto, helper, numpy_helper
+from utils.export import export_univision_model_v3
+from utils.image import preprocess_from_metadata
+from utils.runtime import (
+    UnivisionSession,
+    clear_session_cache,
+    read_external_initializers,
+    read_univision_model,
+)
+
+CLASSES = ["a", "b", "c", "d"]
+
+
+def _classifier():
+    rng = np.random.default_rng(0)
+    graph = helper.make_graph(
+        [
+            helper.make_node("Conv", ["input", "weight"], ["conv"], pads=[1, 1, 1, 1]),
+            helper.make_node("GlobalAveragePool", ["conv"], ["pooled"]),
+            helper.make_node("Flatten", ["pooled"], ["flat"]),
+            helper.make_node("Gemm", ["flat", "fc"], ["logits"]),
+            helper.make_node("Softmax", ["logits"], ["output"]),
+        ],
+        "classifier",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, [1, 3, 16, 16])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, 4])],
+        [
+            numpy_helper.from_array(
+                rng.standard_normal((8, 3, 3, 3)).astype(np.float32), "weight"
+            ),
+            numpy_helper.from_array(
+                rng.standard_normal((8, 4)).astype(np.float32), "fc"
+            ),
+        ],
+    )
+    return helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 17)], ir_version=9
+    )
+
+
+@pytest.fixture
+def model_paths(tmp_path):
+    model = _classifier()
+    plain_path = tmp_path / "plain.onnx"
+    onnx.save(model, plain_path)
+    external_dir = tmp_path / "external"
+    external_dir.mkdir()
+    external_path = external_dir / "model.onnx"
+    onnx.save_model(
+        model,
+        external_path,
+        save_as_external_data=True,
+        all_tensors_to_one_file=True,
+        location="model.onnx.data",
+        size_threshold=16,
+    )
+    yield plain_path, external_path
+    clear_session_cache()
+
+
+def _run(path, x):
+    return UnivisionSession(path, session_config=False).run(x)[0]
+
+
+def test_onnx_model_with_external_data(model_paths):
+    plain_path, external_path = model_paths
+    model_bytes, metadata = read_univision_model(external_path)
+    assert metadata is None
+    initializers = read_external_initializers(external_path, model_bytes)
+    assert sorted(initializers) == ["fc", "weight"]
+    x = np.random.default_rng(1).standard_normal((1, 3, 16, 16)).astype(np.float32)
+    np.testing.assert_allclose(_run(external_path, x), _run(plain_path, x), rtol=1e-6)
+
+
+@pytest.mark.parametrize("fold_normalization", [False, True])
+def test_export_of_model_with_external_data(model_paths, tmp_path, fold_normalization):
+    plain_path, external_path = model_paths
+    image = np.random.default_rng(2).integers(0, 256, (40, 50, 3), dtype=np.uint8)
+    kwargs = dict(
+        output_type="MULTI_CLASS_CLASSIFICATION",
+        resize_mode="STRETCH",
+        unit_scaling=True,
+        standardization_mean=(0.485, 0.456, 0.406),
+        standardization_std=(0.229, 0.224, 0.225),
+    )
+    exported = {}
+    for name, path, fold in (
+        ("plain", plain_path, False),
+        ("external", external_path, fold_normalization),
+    ):
+        exported[name] = tmp_path / f"{name}.u3o"
+        export_univision_model_v3(
+            exported[name], path, CLASSES, image, fold_normalization=fold, **kwargs
+        )
+
+    with zipfile.ZipFile(exported["external"]) as archive:
+        infos = {info.filename: info for info in archive.infolist()}
+    external_files = [name for name in infos if name.endswith(".data")]
+    if not fold_normalization:
+        # the tensor files are stored uncompressed, so they can be read without extracting them
+        assert external_files
+        assert all(infos[n].compress_type == zipfile.ZIP_STORED for n in external_files)
+
+    sessions = {
+        name: UnivisionSession(path, session_config=False)
+        for name, path in exported.items()
+    }
+    outputs = {
+        name: session.run(
+            preprocess_from_metadata(image, session.metadata["input"])[0]
+        )[0]
+        for name, session in sessions.items()
+    }
+    np.testing.assert_allclose(
+        outputs["external"], outputs["plain"], rtol=1e-4, atol=1e-6
+    )
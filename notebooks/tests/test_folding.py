@@ -0,0 +1,105 @@
+import numpy as np
+import onnx
+import pytest
+from onnx import TensorProto, helper, numpy_helper
+from utils.folding import fold_input_normalization
+from utils.runtime import create_session_from_model
+
+MEAN = (0.485, 0.456, 0.406)
+STD = (0.229, 0.224, 0.225)
+
+
+def _model(batch=1, nhwc=False, quantized=False, group=1, **conv_attributes):
+    rng = np.random.default_rng(0)
+    initializers = [
+        numpy_helper.from_array(
+            rng.standard_normal((6, 3 // group, 3, 3)).astype(np.float32), "W"
+        ),
+        numpy_helper.from_array(rng.standard_normal(6).astype(np.float32), "B"),
+        numpy_helper.from_array(np.float32(0.02), "scale"),
+        numpy_helper.from_array(np.uint8(128), "zero_point"),
+    ]
+    nodes, tensor = [], "input"
+    if nhwc:
+        nodes.append(
+            helper.make_node("Transpose", [tensor], ["nchw"], perm=[0, 3, 1, 2])
+        )
+        tensor = "nchw"
+    if quantized:
+        nodes += [
+            helper.make_node("QuantizeLinear", [tensor, "scale", "zero_point"], ["q"]),
+            helper.make_node("DequantizeLinear", ["q", "scale", "zero_point"], ["dq"]),
+        ]
+        tensor = "dq"
+    nodes += [
+        helper.make_node(
+            "Conv",
+            [tensor, "W", "B"],
+            ["conv"],
+            name="conv",
+            group=group,
+            **conv_attributes
+        ),
+        helper.make_node("Relu", ["conv"], ["output"]),
+    ]
+    shape = [batch, 17, 20, 3] if nhwc else [batch, 3, 17, 20]
+    graph = helper.make_graph(
+        nodes,
+        "model",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, shape)],
+        [
+            helper.make_tensor_value_info(
+                "output", TensorProto.FLOAT, ["N", "C", "H", "W"]
+            )
+        ],
+        initializers,
+    )
+    return helper.make_model(
+        graph, opset_imports=[helper.make_opsetid("", 17)], ir_version=9
+    )
+
+
+def _normalize(x, nhwc):
+    shape = (1, 1, 1, 3) if nhwc else (1, 3, 1, 1)
+    mean, std = np.reshape(MEAN, shape), np.reshape(STD, shape)
+    return ((x / 255 - mean) / std).astype(np.float32)
+
+
+@pytest.mark.parametrize("nhwc", [False, True])
+@pytest.mark.parametrize("batch", [1, 3, "N"])
+@pytest.mark.parametrize(
+    "conv_attributes",
+    [
+        {"pads": [1, 1, 1, 1], "strides": [2, 2]},
+        {"pads": [1, 0, 2, 1]},
+        {"pads": [0, 0, 0, 0]},
+        {"auto_pad": "SAME_UPPER", "strides": [2, 2]},
+        {"auto_pad": "SAME_LOWER", "strides": [2, 2]},
+        {"auto_pad": "VALID"},
+        {"pads": [2, 2, 2, 2], "dilations": [2, 2], "group": 3},
+    ],
+)
+def test_folded_model_matches_normalized_input(nhwc, batch, conv_attributes):
+    model = _model(batch, nhwc, **conv_attributes)
+    folded = fold_input_normalization(model, True, MEAN, STD)
+    onnx.checker.check_model(folded, full_check=True)
+    size = 1 if batch == 1 else 3
+    shape = (size, 17, 20, 3) if nhwc else (size, 3, 17, 20)
+    x = np.random.default_rng(1).integers(0, 256, shape).astype(np.float32)
+    (expected,) = create_session_from_model(model).run(
+        None, {"input": _normalize(x, nhwc)}
+    )
+    (actual,) = create_session_from_model(folded).run(None, {"input": x})
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_folding_keeps_the_padding_small():
+    model = _model(pads=[1, 1, 1, 1])
+    folded = fold_input_normalization(model, True, MEAN, STD)
+    # only the border strips are stored, a padded (3, 19, 22) image would take 5016 bytes
+    assert folded.ByteSize() - model.ByteSize() < 2000
+
+
+def test_folding_rejects_quantized_models():
+    with pytest.raises(ValueError, match="float models"):
+        fold_input_normalization(_model(quantized=True), True, MEAN, STD)
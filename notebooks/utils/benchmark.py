@@ -0,0 +1,316 @@
+import json
+import statistics
+import tempfile
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Callable, Dict
+
+import numpy as np
+import onnx
+from onnx import TensorProto, helper, numpy_helper
+from utils.quantization import (
+    GraphIndex,
+    find_postprocess_nodes_to_exclude,
+    get_nodes_to_exclude,
+    sort_nodes_topologically,
+)
+from utils.runtime import (
+    UnivisionSession,
+    create_session,
+    create_session_options,
+    load_session_config,
+    read_univision_model,
+)
+
+
+def measure(fn: Callable, repeat: int = 5, warmup: int = 1) -> Dict[str, float]:
+    """
+    Measures the wall time of a callable.
+
+    Args:
+        fn: The callable to measure, it is called without arguments.
+        repeat: Number of measured calls.
+        warmup: Number of calls before the measurement starts.
+
+    Returns:
+        Dictionary with the min, mean and max duration in seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return {
+        "min": min(durations),
+        "mean": statistics.fmean(durations),
+        "max": max(durations),
+    }
+
+
+def make_synthetic_qdq_model(num_nodes: int = 100_000) -> onnx.ModelProto:
+    """
+    Builds a QDQ model with roughly `num_nodes` nodes for benchmarking the graph analysis helpers.
+
+    The backbone is a chain of Q -> DQ -> Conv(DQ weight) -> Relu blocks, where the weight DequantizeLinear
+    nodes are placed at the top of the node list like in the models produced by `quantize_static`. It is
+    followed by a Softmax/Gemm classification branch and a YOLOX-like post-processing tail with
+    NonMaxSuppression. The model is meant for graph analysis, it is not intended to be run.
+    """
+    channels = 4
+    num_blocks = max(1, (num_nodes - 16) // 5)
+
+    initializers = [
+        numpy_helper.from_array(np.array(0.02, dtype=np.float32), "scale"),
+        numpy_helper.from_array(np.array(0, dtype=np.uint8), "zero_point"),
+        numpy_helper.from_array(np.array(0, dtype=np.int8), "weight_zero_point"),
+        numpy_helper.from_array(np.array([1, -1, 4], dtype=np.int64), "boxes_shape"),
+        numpy_helper.from_array(np.array([1, 1, -1], dtype=np.int64), "scores_shape"),
+        numpy_helper.from_array(np.array([20], dtype=np.int64), "max_boxes"),
+        numpy_helper.from_array(np.array([0.45], dtype=np.float32), "iou_threshold"),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), "box_index"),
+        numpy_helper.from_array(np.array(8.0, dtype=np.float32), "stride"),
+    ]
+    weight_nodes = []
+    nodes = []
+    tensor = "input"
+    for block in range(num_blocks):
+        weight = np.ones((channels, channels, 1, 1), dtype=np.int8)
+        initializers.append(numpy_helper.from_array(weight, f"w{block}_quantized"))
+        weight_nodes.append(
+            helper.make_node(
+                "DequantizeLinear",
+                [f"w{block}_quantized", "scale", "weight_zero_point"],
+                [f"w{block}"],
+                name=f"/block{block}/weight/DequantizeLinear",
+            )
+        )
+        nodes += [
+            helper.make_node(
+                "QuantizeLinear",
+                [tensor, "scale", "zero_point"],
+                [f"x{block}_quantized"],
+                name=f"/block{block}/QuantizeLinear",
+            ),
+            helper.make_node(
+                "DequantizeLinear",
+                [f"x{block}_quantized", "scale", "zero_point"],
+                [f"x{block}_dequantized"],
+                name=f"/block{block}/DequantizeLinear",
+            ),
+            helper.make_node(
+                "Conv",
+                [f"x{block}_dequantized", f"w{block}"],
+                [f"conv{block}"],
+                name=f"/block{block}/Conv",
+            ),
+            helper.make_node(
+                "Relu", [f"conv{block}"], [f"relu{block}"], name=f"/block{block}/Relu"
+            ),
+        ]
+        tensor = f"relu{block}"
+
+    nodes += [
+        # classification branch
+        helper.make_node(
+            "GlobalAveragePool", [tensor], ["pooled"], name="/head/GlobalAveragePool"
+        ),
+        helper.make_node("Flatten", ["pooled"], ["flat"], name="/head/Flatten"),
+        helper.make_node(
+            "Gemm", ["flat", f"w{num_blocks - 1}"], ["logits"], name="/head/fc/Gemm"
+        ),
+        helper.make_node("Softmax", ["logits"], ["probabilities"], name="/Softmax"),
+        # detection post-processing
+        helper.make_node("Sigmoid", [tensor], ["objectness"], name="/head/Sigmoid"),
+        helper.make_node("Mul", [tensor, "stride"], ["decoded"], name="/decode/Mul"),
+        helper.make_node("Exp", ["decoded"], ["wh"], name="/decode/Exp"),
+        helper.make_node(
+            "Reshape", ["wh", "boxes_shape"], ["boxes"], name="/decode/Reshape"
+        ),
+        helper.make_node(
+            "Reshape",
+            ["objectness", "scores_shape"],
+            ["scores"],
+            name="/scores/Reshape",
+        ),
+        helper.make_node(
+            "NonMaxSuppression",
+            ["boxes", "scores", "max_boxes", "iou_threshold"],
+            ["selected"],
+            name="/NonMaxSuppression",
+        ),
+        helper.make_node(
+            "Gather", ["selected", "box_index"], ["keep"], name="/Gather", axis=1
+        ),
+        helper.make_node("Squeeze", ["keep"], ["detections"], name="/Squeeze"),
+    ]
+
+    graph = helper.make_graph(
+        weight_nodes + nodes,
+        "synthetic_qdq",
+        [
+            helper.make_tensor_value_info(
+                "input", TensorProto.FLOAT, [1, channels, 8, 8]
+            )
+        ],
+        [
+            helper.make_tensor_value_info("probabilities", TensorProto.FLOAT, None),
+            helper.make_tensor_value_info("detections", TensorProto.INT64, None),
+        ],
+        initializers,
+    )
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid("", 20)])
+
+
+def _find_postprocess_nodes_with_full_load(onnx_model_path):
+    """The search of `find_postprocess_nodes_to_exclude` before GraphIndex, the reference of the benchmark."""
+    nodes = list(onnx.load(str(onnx_model_path)).graph.node)
+    producer = {o: i for i, node in enumerate(nodes) for o in node.output}
+    consumers = defaultdict(list)
+    for i, node in enumerate(nodes):
+        for tensor in node.input:
+            consumers[tensor].append(i)
+    nms = next(
+        (i for i, node in enumerate(nodes) if node.op_type == "NonMaxSuppression"),
+        None,
+    )
+    if nms is None:
+        return []
+    visited = {nms}
+    names = [nodes[nms].name]
+    queue = deque(producer[t] for t in nodes[nms].input if t in producer)
+    while queue:
+        i = queue.popleft()
+        if i in visited:
+            continue
+        visited.add(i)
+        if nodes[i].op_type in ("Conv", "Sigmoid"):
+            continue
+        names.append(nodes[i].name)
+        queue.extend(producer[t] for t in nodes[i].input if t in producer)
+    queue = deque(c for t in nodes[nms].output for c in consumers[t])
+    while queue:
+        i = queue.popleft()
+        if i not in visited:
+            visited.add(i)
+            names.append(nodes[i].name)
+            queue.extend(c for t in nodes[i].output for c in consumers[t])
+    return [name for name in names if name]
+
+
+def benchmark_graph_index(num_nodes: int = 100_000, repeat: int = 3):
+    """
+    Benchmarks GraphIndex and the graph analysis helpers of `utils.quantization` on a synthetic QDQ graph.
+
+    Returns:
+        Dictionary with the timings of each step, see `measure`.
+    """
+    model = make_synthetic_qdq_model(num_nodes)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = Path(tmp_dir) / "synthetic_qdq.onnx"
+        onnx.save(model, model_path)
+        index = GraphIndex.from_model(model)
+
+        timings = {
+            "onnx.load": measure(lambda: onnx.load(model_path), repeat),
+            "GraphIndex.from_path": measure(
+                lambda: GraphIndex.from_path(model_path), repeat
+            ),
+            "GraphIndex.from_model": measure(
+                lambda: GraphIndex.from_model(model), repeat
+            ),
+            "find_postprocess_nodes_to_exclude(path), before GraphIndex": measure(
+                lambda: _find_postprocess_nodes_with_full_load(model_path), repeat
+            ),
+            "find_postprocess_nodes_to_exclude(path)": measure(
+                lambda: find_postprocess_nodes_to_exclude(model_path), repeat
+            ),
+            "find_postprocess_nodes_to_exclude(index)": measure(
+                lambda: find_postprocess_nodes_to_exclude(index), repeat
+            ),
+            "get_nodes_to_exclude(model)": measure(
+                lambda: get_nodes_to_exclude(model), repeat
+            ),
+            "get_nodes_to_exclude(index)": measure(
+                lambda: get_nodes_to_exclude(index), repeat
+            ),
+            "sort_nodes_topologically": measure(
+                lambda: sort_nodes_topologically(model), repeat
+            ),
+        }
+
+    print(f"Synthetic QDQ graph with {len(model.graph.node)} nodes")
+    for name, timing in timings.items():
+        print(f"  {name:<60} {timing['mean'] * 1000:>10.1f} ms")
+    return timings
+
+
+def _kernel_time(model_path, x: np.ndarray, repeat: int) -> float:
+    """Mean time per call spent in the operator kernels, from the ONNX Runtime profiler."""
+    sess_options = create_session_options(load_session_config(model_path))
+    sess_options.enable_profiling = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sess_options.profile_file_prefix = str(Path(tmp_dir) / "profile")
+        model_bytes, _ = read_univision_model(model_path)
+        session = create_session(model_bytes, sess_options, model_path=model_path)
+        feed = {session.get_inputs()[0].name: x}
+        for _ in range(repeat):
+            session.run(None, feed)
+        with open(session.end_profiling()) as file:
+            events = json.load(file)
+    runs = sorted(
+        (event["ts"], event["ts"] + event["dur"])
+        for event in events
+        if event.get("cat") == "Session" and event["name"] == "model_run"
+    )
+    kernel_us = [0.0] * len(runs)
+    for event in events:
+        if event.get("cat") == "Node" and event["name"].endswith("_kernel_time"):
+            for run_id, (start, end) in enumerate(runs):
+                if start <= event["ts"] <= end:
+                    kernel_us[run_id] += event["dur"]
+                    break
+    # the median ignores the warmup of the first runs
+    return statistics.median(kernel_us) / 1e6
+
+
+def benchmark_session_overhead(model_path, x: np.ndarray, repeat: int = 100):
+    """
+    Compares the per-call time of a plain InferenceSession with UnivisionSession and with the kernel time.
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+        x: Batched model input.
+        repeat: Number of measured calls.
+
+    Returns:
+        Dictionary with the timings of each call style, see `measure`.
+    """
+    model_bytes, _ = read_univision_model(model_path)
+    session = create_session(
+        model_bytes,
+        create_session_options(load_session_config(model_path)),
+        model_path=model_path,
+    )
+    feed = {session.get_inputs()[0].name: x}
+    univision_session = UnivisionSession(model_path, pool_size=1)
+
+    def run_bound():
+        with univision_session.binding() as bound_run:
+            bound_run.run(x)
+
+    timings = {
+        "InferenceSession.run": measure(lambda: session.run(None, feed), repeat),
+        "UnivisionSession.run": measure(lambda: univision_session.run(x), repeat),
+        "UnivisionSession.binding": measure(run_bound, repeat),
+    }
+    kernel_time = _kernel_time(model_path, x, repeat)
+    print(f"{'kernels':<30} {kernel_time * 1000:>10.3f} ms")
+    for name, timing in timings.items():
+        print(
+            f"{name:<30} {timing['mean'] * 1000:>10.3f} ms"
+            f"  (overhead {(timing['mean'] - kernel_time) * 1000:.3f} ms)"
+        )
+    return timings
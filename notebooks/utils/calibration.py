@@ -0,0 +1,488 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional, Sequence
+
+import numpy as np
+import onnxruntime
+from onnxruntime.quantization.calibrate import (
+    CalibrationDataReader,
+    CalibrationMethod,
+    HistogramCollector,
+    TensorsData,
+    create_calibrator,
+)
+from onnxruntime.quantization.onnx_quantizer import ONNXQuantizer
+from onnxruntime.quantization.qdq_quantizer import QDQQuantizer
+from onnxruntime.quantization.quant_utils import (
+    QuantFormat,
+    QuantizationMode,
+    QuantType,
+    load_model_with_shape_infer,
+)
+from onnxruntime.quantization.quantize import check_static_quant_arguments
+from onnxruntime.quantization.registry import QDQRegistry, QLinearOpsRegistry
+from utils.tracing import traced
+
+# Defaults of onnxruntime.quantization.calibrate.create_calibrator for the histogram based methods.
+HISTOGRAM_METHOD_DEFAULTS = {
+    CalibrationMethod.Entropy: {
+        "method": "entropy",
+        "num_bins": 128,
+        "num_quantized_bins": 128,
+        "symmetric": False,
+    },
+    CalibrationMethod.Percentile: {
+        "method": "percentile",
+        "num_bins": 2048,
+        "percentile": 99.999,
+        "symmetric": True,
+    },
+    CalibrationMethod.Distribution: {
+        "method": "distribution",
+        "num_bins": 2048,
+        "scenario": "same",
+        "symmetric": False,
+    },
+}
+
+
+class DatasetShardDataReader(CalibrationDataReader):
+    def __init__(self, input_name, dataset, indices):
+        """
+        Initializes a data reader which iterates over a fixed subset of a dataset.
+
+        Args:
+            input_name (str): Name of the ONNX model input.
+            dataset: Indexable dataset whose items are `(input, *targets)` tuples, e.g. a PyTorch dataset.
+            indices (Sequence[int]): Dataset indices of the shard, read in the given order.
+        """
+        self.input_name = input_name
+        self.dataset = dataset
+        self.indices = list(indices)
+        self.counter = 0
+
+    def get_next(self):
+        if self.counter >= len(self.indices):
+            return None
+        inputs, *_ = self.dataset[self.indices[self.counter]]
+        self.counter += 1
+        # Add the batch dimension, like the DataLoader of TorchCalibrationDataReader does.
+        return {self.input_name: np.asarray(inputs, dtype=np.float32)[np.newaxis]}
+
+
+def select_calibration_indices(dataset_size: int, samples: int, seed: int = 0):
+    """
+    Draws a reproducible list of calibration sample indices.
+
+    Like `TorchCalibrationDataReader` with `shuffle=True`, the dataset is reshuffled every time it has been
+    exhausted, so `samples` may be larger than `dataset_size`.
+
+    Args:
+        dataset_size: Number of items in the dataset.
+        samples: Number of indices to draw.
+        seed: Seed of the random generator.
+
+    Returns:
+        Array of `samples` dataset indices.
+    """
+    if dataset_size <= 0:
+        raise ValueError("The calibration dataset is empty.")
+    if samples <= 0:
+        raise ValueError("The number of calibration samples must be positive.")
+
+    rng = np.random.default_rng(seed)
+    epochs = -(-samples // dataset_size)
+    return np.concatenate([rng.permutation(dataset_size) for _ in range(epochs)])[
+        :samples
+    ]
+
+
+def _create_shard_calibrator(
+    model_path,
+    op_types_to_calibrate,
+    shard_dir,
+    calibrate_method,
+    calib_extra_options,
+    intra_op_num_threads,
+):
+    # The calibrator writes a shape-inferred copy next to the model, so every worker needs its own copy.
+    shard_dir.mkdir(exist_ok=True)
+    shard_model_path = shard_dir / "model.onnx"
+    if not shard_model_path.exists():
+        shutil.copy(model_path, shard_model_path)
+
+    calibrator = create_calibrator(
+        shard_model_path,
+        op_types_to_calibrate,
+        augmented_model_path=str(shard_dir / f"augmented_{calibrate_method.name}.onnx"),
+        calibrate_method=calibrate_method,
+        extra_options=calib_extra_options,
+    )
+    # Replace the default session so that the workers do not oversubscribe the cores.
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+    )
+    sess_options.intra_op_num_threads = intra_op_num_threads
+    calibrator.infer_session = onnxruntime.InferenceSession(
+        calibrator.augmented_model_path,
+        sess_options,
+        providers=["CPUExecutionProvider"],
+    )
+    return calibrator
+
+
+def _collect_shard_min_max(
+    model_path,
+    op_types_to_calibrate,
+    dataset,
+    indices,
+    shard_dir,
+    intra_op_num_threads,
+):
+    calibrator = _create_shard_calibrator(
+        model_path,
+        op_types_to_calibrate,
+        shard_dir,
+        CalibrationMethod.MinMax,
+        {},
+        intra_op_num_threads,
+    )
+    input_name = calibrator.infer_session.get_inputs()[0].name
+    calibrator.collect_data(DatasetShardDataReader(input_name, dataset, indices))
+    return {
+        name: tuple(
+            np.asarray(value, dtype=np.float32) for value in tensor_data.range_value
+        )
+        for name, tensor_data in calibrator.compute_data().items()
+    }
+
+
+def _collect_shard_histograms(
+    model_path,
+    op_types_to_calibrate,
+    dataset,
+    indices,
+    shard_dir,
+    intra_op_num_threads,
+    calibrate_method,
+    calib_extra_options,
+    histogram_ranges,
+):
+    calibrator = _create_shard_calibrator(
+        model_path,
+        op_types_to_calibrate,
+        shard_dir,
+        calibrate_method,
+        calib_extra_options,
+        intra_op_num_threads,
+    )
+    session = calibrator.infer_session
+    input_name = session.get_inputs()[0].name
+    output_names = [o.name for o in session.get_outputs()]
+    num_bins = calib_extra_options["num_bins"]
+    absolute = calib_extra_options["absolute"]
+
+    histograms = {name: np.zeros(num_bins, dtype=np.int64) for name in histogram_ranges}
+    reader = DatasetShardDataReader(input_name, dataset, indices)
+    while (inputs := reader.get_next()) is not None:
+        for name, output in zip(output_names, session.run(None, inputs)):
+            if name not in histograms:
+                continue
+            values = np.asarray(output).ravel()
+            if absolute:
+                values = np.absolute(values)
+            histograms[name] += np.histogram(
+                values, bins=num_bins, range=histogram_ranges[name]
+            )[0]
+    return histograms
+
+
+def _merge_min_max(shard_ranges):
+    """Merges per-shard (min, max) pairs. The reduction does not depend on the shard order."""
+    merged = {}
+    for ranges in shard_ranges:
+        for name, (lowest, highest) in ranges.items():
+            if name in merged:
+                lowest = np.minimum(merged[name][0], lowest)
+                highest = np.maximum(merged[name][1], highest)
+            merged[name] = (lowest, highest)
+    return merged
+
+
+@traced("calibration")
+def collect_calibration_ranges(
+    model_path,
+    dataset,
+    samples: int = 500,
+    calibrate_method: CalibrationMethod = CalibrationMethod.MinMax,
+    op_types_to_calibrate: Optional[Sequence[str]] = None,
+    calib_extra_options: Optional[dict] = None,
+    num_workers: Optional[int] = None,
+    seed: int = 0,
+    mp_context=None,
+) -> TensorsData:
+    """
+    Computes quantization ranges by running the calibration in several worker processes.
+
+    The calibration samples are split into contiguous shards, one per worker, and every worker runs its own
+    ONNX Runtime session on the augmented model. MinMax ranges are merged with an element-wise min/max.
+    Entropy, Percentile and Distribution calibration needs two passes: the first one computes the global
+    min/max of every tensor, the second one fills histograms whose bin edges are derived from these global
+    ranges, so the per-shard bin counts can simply be added. The merged result does not depend on the
+    number of workers or on the order in which the workers finish.
+
+    Args:
+        model_path: Path to the preprocessed fp32 ONNX model.
+        dataset: Indexable dataset whose items are `(input, *targets)` tuples, e.g. the dataset passed to
+            `TorchCalibrationDataReader`. It must be picklable if the processes are not forked.
+        samples: The number of samples to calibrate on. Defaults to 500.
+        calibrate_method: The ONNX Runtime calibration method. Defaults to MinMax.
+        op_types_to_calibrate: Operator types to calibrate. Defaults to all quantizable operators.
+        calib_extra_options: Options of `create_calibrator`, e.g. `symmetric`, `num_bins`, `percentile`.
+            Moving average MinMax calibration is not supported because it depends on the sample order.
+        num_workers: Number of worker processes. Defaults to the number of CPU cores.
+        seed: Seed used to draw the calibration samples.
+        mp_context: Optional multiprocessing context used for the worker processes.
+
+    Returns:
+        TensorsData that can be passed to `quantize_static_with_ranges`.
+    """
+    calib_extra_options = dict(calib_extra_options or {})
+    if calib_extra_options.get("moving_average", False):
+        raise ValueError(
+            "Moving average calibration depends on the sample order and cannot be sharded."
+        )
+    if calib_extra_options.get("per_channel", False):
+        raise ValueError("Per channel calibration ranges are not supported.")
+    if (
+        calibrate_method != CalibrationMethod.MinMax
+        and calibrate_method not in HISTOGRAM_METHOD_DEFAULTS
+    ):
+        raise ValueError(f"Unsupported calibration method {calibrate_method}.")
+
+    if op_types_to_calibrate is None:
+        op_types_to_calibrate = sorted(
+            set(QLinearOpsRegistry.keys()) | set(QDQRegistry.keys())
+        )
+
+    indices = select_calibration_indices(len(dataset), samples, seed)
+    num_workers = min(num_workers or os.cpu_count() or 1, len(indices))
+    shards = np.array_split(indices, num_workers)
+    intra_op_num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+
+    with (
+        tempfile.TemporaryDirectory(prefix="calibration.") as tmp_dir,
+        ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context) as executor,
+    ):
+        # Results are gathered in shard order, which keeps the merge deterministic.
+        futures = [
+            executor.submit(
+                _collect_shard_min_max,
+                model_path,
+                op_types_to_calibrate,
+                dataset,
+                shard,
+                Path(tmp_dir) / f"shard_{shard_id}",
+                intra_op_num_threads,
+            )
+            for shard_id, shard in enumerate(shards)
+        ]
+        min_max = _merge_min_max(future.result() for future in futures)
+
+        if calibrate_method == CalibrationMethod.MinMax:
+            if calib_extra_options.get("symmetric", False):
+                for name, (lowest, highest) in min_max.items():
+                    amax = np.maximum(np.abs(lowest), np.abs(highest))
+                    min_max[name] = (-amax, amax)
+            print(
+                f"Collected MinMax ranges of {len(min_max)} tensors from {len(indices)} samples "
+                f"using {num_workers} workers"
+            )
+            return TensorsData(calibrate_method, min_max)
+
+        options = {**HISTOGRAM_METHOD_DEFAULTS[calibrate_method], **calib_extra_options}
+        # Symmetric percentile calibration histograms absolute values, see HistogramCollector.collect().
+        options["absolute"] = options["method"] == "percentile" and options["symmetric"]
+        histogram_ranges = {}
+        for name, (lowest, highest) in min_max.items():
+            amax = float(np.max(np.maximum(np.abs(lowest), np.abs(highest))))
+            histogram_ranges[name] = (
+                (0.0, amax) if options["absolute"] else (-amax, amax)
+            )
+
+        futures = [
+            executor.submit(
+                _collect_shard_histograms,
+                model_path,
+                op_types_to_calibrate,
+                dataset,
+                shard,
+                Path(tmp_dir) / f"shard_{shard_id}",
+                intra_op_num_threads,
+                calibrate_method,
+                options,
+                histogram_ranges,
+            )
+            for shard_id, shard in enumerate(shards)
+        ]
+        histograms = {}
+        for future in futures:
+            for name, hist in future.result().items():
+                histograms[name] = (
+                    histograms[name] + hist if name in histograms else hist
+                )
+
+    collector = HistogramCollector(
+        method=options["method"],
+        symmetric=options["symmetric"],
+        num_bins=options["num_bins"],
+        num_quantized_bins=options.get("num_quantized_bins", 128),
+        percentile=options.get("percentile", 99.999),
+        scenario=options.get("scenario", "same"),
+    )
+    for name, hist in histograms.items():
+        lowest, highest = np.min(min_max[name][0]), np.max(min_max[name][1])
+        hist_edges = np.histogram_bin_edges(
+            [], bins=options["num_bins"], range=histogram_ranges[name]
+        ).astype(np.float32)
+        threshold = np.array(histogram_ranges[name][1], dtype=np.float32)
+        collector.histogram_dict[name] = (
+            (hist, hist_edges, lowest, highest)
+            if options["absolute"]
+            else (hist, hist_edges, lowest, highest, threshold)
+        )
+    print(
+        f"Collected {options['method']} histograms of {len(histograms)} tensors from {len(indices)} samples "
+        f"using {num_workers} workers"
+    )
+    return TensorsData(calibrate_method, collector.compute_collection_result())
+
+
+@traced("quantization")
+def quantize_static_with_ranges(
+    model_input,
+    model_output,
+    tensors_range: TensorsData,
+    quant_format=QuantFormat.QDQ,
+    op_types_to_quantize=None,
+    per_channel=False,
+    reduce_range=False,
+    activation_type=QuantType.QInt8,
+    weight_type=QuantType.QInt8,
+    nodes_to_quantize=None,
+    nodes_to_exclude=None,
+    extra_options=None,
+):
+    """
+    Quantizes a model with precomputed calibration ranges.
+
+    This follows `onnxruntime.quantization.quantize_static` (onnxruntime 1.22) after its calibration step,
+    the arguments have the same meaning.
+
+    Args:
+        model_input: Path to the preprocessed fp32 ONNX model.
+        model_output: Path where the quantized model will be saved.
+        tensors_range: Calibration ranges, e.g. the result of `collect_calibration_ranges`.
+    """
+    extra_options = extra_options or {}
+    nodes_to_exclude = nodes_to_exclude or []
+    nodes_to_quantize = nodes_to_quantize or []
+    if not op_types_to_quantize:
+        op_types_to_quantize = list(
+            set(QLinearOpsRegistry.keys()) | set(QDQRegistry.keys())
+        )
+
+    check_static_quant_arguments(quant_format, activation_type, weight_type)
+    model = load_model_with_shape_infer(Path(model_input))
+
+    if quant_format is QuantFormat.QOperator:
+        quantizer = ONNXQuantizer(
+            model,
+            per_channel,
+            reduce_range,
+            QuantizationMode.QLinearOps,
+            True,  # static
+            weight_type,
+            activation_type,
+            tensors_range,
+            nodes_to_quantize,
+            nodes_to_exclude,
+            op_types_to_quantize,
+            extra_options,
+        )
+    else:
+        quantizer = QDQQuantizer(
+            model,
+            per_channel,
+            reduce_range,
+            weight_type,
+            activation_type,
+            tensors_range,
+            nodes_to_quantize,
+            nodes_to_exclude,
+            op_types_to_quantize,
+            extra_options,
+        )
+    quantizer.quantize_model()
+    quantizer.model.save_model_to_file(str(model_output))
+
+
+def quantize_static_sharded(
+    model_input,
+    model_output,
+    dataset,
+    samples: int = 500,
+    calibrate_method: CalibrationMethod = CalibrationMethod.MinMax,
+    calib_extra_options: Optional[dict] = None,
+    num_workers: Optional[int] = None,
+    seed: int = 0,
+    mp_context=None,
+    **kwargs,
+):
+    """
+    Drop-in replacement of `quantize_static` that calibrates in several worker processes.
+
+    Example:
+    quantize_static_sharded(
+        model_input=float32_preprocessed_model_path,
+        model_output=INT8_ONNX_MODEL_PATH,
+        dataset=calibration_dataset,
+        samples=CALIBRATION_SAMPLE_SIZE,
+        num_workers=8,
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=False,
+        calibrate_method=CalibrationMethod.MinMax,
+        nodes_to_exclude=postprocess_nodes,
+    )
+
+    Args:
+        model_input: Path to the preprocessed fp32 ONNX model.
+        model_output: Path where the quantized model will be saved.
+        dataset: Calibration dataset, see `collect_calibration_ranges`.
+        samples: The number of samples to calibrate on. Defaults to 500.
+        calibrate_method: The ONNX Runtime calibration method. Defaults to MinMax.
+        calib_extra_options: Options of the calibrator, see `collect_calibration_ranges`.
+        num_workers: Number of worker processes. Defaults to the number of CPU cores.
+        seed: Seed used to draw the calibration samples.
+        mp_context: Optional multiprocessing context used for the worker processes.
+        **kwargs: Quantization arguments of `quantize_static_with_ranges`.
+    """
+    tensors_range = collect_calibration_ranges(
+        model_input,
+        dataset,
+        samples=samples,
+        calibrate_method=calibrate_method,
+        op_types_to_calibrate=kwargs.get("op_types_to_quantize"),
+        calib_extra_options=calib_extra_options,
+        num_workers=num_workers,
+        seed=seed,
+        mp_context=mp_context,
+    )
+    quantize_static_with_ranges(model_input, model_output, tensors_range, **kwargs)
+    print(f"Model quantized and saved to: {model_output}")
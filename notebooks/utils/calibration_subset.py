@@ -0,0 +1,248 @@
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import onnx
+from onnx.utils import Extractor
+from onnxruntime.quantization import CalibrationMethod
+from sklearn.cluster import KMeans
+from torch.utils.data import Subset
+from utils.calibration import (
+    collect_calibration_ranges,
+    quantize_static_with_ranges,
+    select_calibration_indices,
+)
+from utils.runtime import create_session_from_model
+
+
+def select_embedding_tensor(model: onnx.ModelProto) -> str:
+    """
+    Returns the deepest feature map of a model, the 4D float tensor with the most channels (the latest one
+    in case of a tie). The model needs shape information, e.g. from the quantization preprocessing.
+    """
+    best_name, best_channels = None, 0
+    produced = {t for node in model.graph.node for t in node.output}
+    for vi in model.graph.value_info:
+        tensor_type = vi.type.tensor_type
+        if (
+            vi.name not in produced
+            or tensor_type.elem_type != onnx.TensorProto.FLOAT
+            or len(tensor_type.shape.dim) != 4
+        ):
+            continue
+        channels = tensor_type.shape.dim[1].dim_value
+        if channels >= best_channels:
+            best_name, best_channels = vi.name, channels
+    if best_name is None:
+        raise ValueError(
+            "The model has no 4D feature map with shape information, pass tensor_names explicitly."
+        )
+    return best_name
+
+
+def compute_embeddings(
+    model_path,
+    dataset,
+    indices: Optional[Sequence[int]] = None,
+    tensor_names: Optional[Sequence[str]] = None,
+) -> np.ndarray:
+    """
+    Embeds dataset images with globally average pooled activations of the fp32 model.
+
+    The model is truncated after the embedding tensors, so the heads and the post-processing are not run.
+
+    Args:
+        model_path: Path to the preprocessed fp32 ONNX model.
+        dataset: Indexable dataset whose items are `(input, *targets)` tuples.
+        indices: Dataset indices to embed. Defaults to the whole dataset.
+        tensor_names: Feature maps to pool, their L2 normalized embeddings are concatenated. Defaults to
+            `select_embedding_tensor`.
+
+    Returns:
+        Array of shape (len(indices), embedding size).
+    """
+    model = onnx.load(model_path)
+    if tensor_names is None:
+        tensor_names = [select_embedding_tensor(model)]
+    tensor_names = list(tensor_names)
+    input_name = model.graph.input[0].name
+    truncated_model = Extractor(model).extract_model([input_name], tensor_names)
+    session = create_session_from_model(truncated_model)
+
+    if indices is None:
+        indices = range(len(dataset))
+    embeddings = []
+    for i in indices:
+        x = np.asarray(dataset[i][0], dtype=np.float32)[np.newaxis]
+        features = []
+        for feature_map in session.run(tensor_names, {input_name: x}):
+            pooled = feature_map.reshape(feature_map.shape[0], feature_map.shape[1], -1)
+            pooled = pooled.mean(axis=-1)[0]
+            features.append(pooled / max(np.linalg.norm(pooled), 1e-12))
+        embeddings.append(np.concatenate(features))
+    return np.stack(embeddings)
+
+
+def _class_quotas(labels: np.ndarray, size: int) -> Dict:
+    """Splits `size` as evenly as possible over the classes, without exceeding the class sizes."""
+    classes, counts = np.unique(labels, return_counts=True)
+    available = dict(zip(classes.tolist(), counts.tolist()))
+    quotas = dict.fromkeys(available, 0)
+    remaining = min(size, len(labels))
+    while remaining:
+        open_classes = [c for c in available if quotas[c] < available[c]]
+        share = max(1, remaining // len(open_classes))
+        # larger classes first, so a remainder goes to them
+        for c in sorted(open_classes, key=lambda c: -available[c]):
+            added = min(share, available[c] - quotas[c], remaining)
+            quotas[c] += added
+            remaining -= added
+            if not remaining:
+                break
+    return quotas
+
+
+def select_calibration_subset(
+    embeddings: np.ndarray,
+    size: int,
+    labels: Optional[Sequence] = None,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    Selects a small, diverse and class-balanced calibration subset.
+
+    The samples of every class are clustered with k-means, one cluster per sample of the class quota, and
+    the sample closest to each cluster center is picked. The quota is split evenly over the classes.
+
+    Example:
+    embeddings = compute_embeddings(float32_preprocessed_model_path, train_dataset)
+    indices = select_calibration_subset(embeddings, 128, labels=train_labels)
+    calibration_data_reader = TorchCalibrationDataReader(
+        float32_preprocessed_model_path,
+        samples=len(indices),
+        dataset=torch.utils.data.Subset(train_dataset, indices),
+        batch_size=1,
+    )
+
+    Args:
+        embeddings: Embeddings of the candidate samples, e.g. from `compute_embeddings`.
+        size: Number of samples to select.
+        labels: Class of every candidate sample. For multi-label or detection datasets the dominant class
+            can be used. Defaults to a single class.
+        seed: Seed of the k-means initialization.
+
+    Returns:
+        Sorted positions of the selected samples in `embeddings`.
+    """
+    labels = (
+        np.zeros(len(embeddings), dtype=int) if labels is None else np.asarray(labels)
+    )
+    if len(labels) != len(embeddings):
+        raise ValueError("labels and embeddings must have the same length.")
+
+    selected = []
+    for label, quota in _class_quotas(labels, size).items():
+        if not quota:
+            continue
+        members = np.flatnonzero(labels == label)
+        if quota >= len(members):
+            selected.extend(members.tolist())
+            continue
+        kmeans = KMeans(n_clusters=quota, n_init=1, random_state=seed).fit(
+            embeddings[members]
+        )
+        distances = kmeans.transform(embeddings[members])
+        # closest member to each center; a member can only represent one cluster
+        taken = set()
+        for cluster in np.argsort(distances.min(axis=0)):
+            for member in np.argsort(distances[:, cluster]):
+                if member not in taken:
+                    taken.add(member)
+                    break
+        selected.extend(members[sorted(taken)].tolist())
+    return np.sort(np.asarray(selected, dtype=int))
+
+
+def calibration_subset_experiment(
+    model_path,
+    dataset,
+    sizes: Sequence[int],
+    metric: Callable[[Path], float],
+    output_dir,
+    embeddings: Optional[np.ndarray] = None,
+    labels: Optional[Sequence] = None,
+    calibrate_method: CalibrationMethod = CalibrationMethod.MinMax,
+    num_workers: Optional[int] = None,
+    seed: int = 0,
+    **quantization_kwargs,
+) -> List[Dict]:
+    """
+    Compares the calibration time and the int8 accuracy of diverse and random calibration subsets of
+    decreasing size.
+
+    Args:
+        model_path: Path to the preprocessed fp32 ONNX model.
+        dataset: Indexable dataset whose items are `(input, *targets)` tuples, the candidate samples.
+        sizes: Subset sizes to try.
+        metric: Callable mapping a quantized model path to its accuracy, higher is better, e.g.
+            `utils.sweep.ReferenceSQNR`.
+        output_dir: Directory for the quantized models.
+        embeddings: Embeddings of the whole dataset. Defaults to `compute_embeddings`.
+        labels: Class of every sample of the dataset, see `select_calibration_subset`.
+        calibrate_method: The ONNX Runtime calibration method.
+        num_workers: Number of calibration worker processes.
+        seed: Seed of the subset selection.
+        **quantization_kwargs: Arguments of `quantize_static_with_ranges`.
+
+    Returns:
+        One row per size and selection ("diverse" or "random") with the keys `selection`, `size`,
+        `calibration_s`, `accuracy` and `model_path`.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if embeddings is None:
+        start = time.perf_counter()
+        embeddings = compute_embeddings(model_path, dataset)
+        print(
+            f"Embedded {len(embeddings)} samples in {time.perf_counter() - start:.1f} s"
+        )
+
+    rows = []
+    for size in sorted(sizes, reverse=True):
+        for selection in ("diverse", "random"):
+            if selection == "diverse":
+                indices = select_calibration_subset(embeddings, size, labels, seed)
+            else:
+                indices = select_calibration_indices(len(dataset), size, seed)
+            start = time.perf_counter()
+            tensors_range = collect_calibration_ranges(
+                model_path,
+                Subset(dataset, indices.tolist()),
+                samples=len(indices),
+                calibrate_method=calibrate_method,
+                num_workers=num_workers,
+                seed=seed,
+            )
+            calibration_s = time.perf_counter() - start
+            quantized_model_path = output_dir / f"{selection}_{size}.onnx"
+            quantize_static_with_ranges(
+                model_path, quantized_model_path, tensors_range, **quantization_kwargs
+            )
+            rows.append(
+                {
+                    "selection": selection,
+                    "size": len(indices),
+                    "calibration_s": calibration_s,
+                    "accuracy": float(metric(quantized_model_path)),
+                    "model_path": str(quantized_model_path),
+                }
+            )
+
+    print(f"{'selection':<10} {'size':>6} {'calibration s':>14} {'accuracy':>10}")
+    for row in rows:
+        print(
+            f"{row['selection']:<10} {row['size']:>6} {row['calibration_s']:>14.2f} "
+            f"{row['accuracy']:>10.4f}"
+        )
+    return rows
@@ -0,0 +1,180 @@
+import time
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+from utils.image import boxes_to_image, decode_boxes, preprocess_from_metadata
+from utils.runtime import UnivisionSession
+
+# Threshold of the classes without `default_threshold`, the export default.
+DEFAULT_CLASS_THRESHOLD = 0.5
+
+
+class CascadeRunner:
+    def __init__(
+        self,
+        classifier_path,
+        detector_path,
+        empty_classes: Sequence[str] = (),
+        threshold_scale: float = 1.0,
+        detection_threshold: Optional[float] = None,
+        **session_kwargs,
+    ):
+        """
+        Runs a cheap classifier on every frame and the detector only on the frames the classifier flags.
+
+        A frame passes the gate when the probability of a class, other than the `empty_classes`, reaches its
+        `default_threshold` from the classifier metadata times `threshold_scale`. A scale below 1 lets more
+        frames through, trading throughput for recall.
+
+        Example:
+        cascade = CascadeRunner("classifier.u3o", "detector.u3o", empty_classes=["ok"])
+        result = cascade.run(read_image_file("frame.png"))
+        if result["detections"] is not None:
+            boxes, labels, scores = result["detections"]
+
+        Args:
+            classifier_path: Path to the exported multi-class or multi-label classifier (.u3o).
+            detector_path: Path to the exported object detector (.u3o).
+            empty_classes: Classifier classes which mean that there is nothing to detect.
+            threshold_scale: Factor applied to the class thresholds of the gate.
+            detection_threshold: Minimum detection score. Defaults to the `default_threshold` of the
+                detected class.
+            **session_kwargs: Arguments of `UnivisionSession`, e.g. intra_op_num_threads.
+        """
+        self.classifier = UnivisionSession(classifier_path, **session_kwargs)
+        self.detector = UnivisionSession(detector_path, **session_kwargs)
+        for session, path in (
+            (self.classifier, classifier_path),
+            (self.detector, detector_path),
+        ):
+            if session.metadata is None:
+                raise ValueError(f"{path} is not a uniVision model.")
+
+        classes = self.classifier.metadata["outputs"][0]["classes"]
+        unknown = set(empty_classes) - {c["name"] for c in classes}
+        if unknown:
+            raise ValueError(f"Unknown classifier classes {sorted(unknown)}.")
+        self.trigger = np.array([c["name"] not in empty_classes for c in classes])
+        self.thresholds = threshold_scale * np.array(
+            [c.get("default_threshold", DEFAULT_CLASS_THRESHOLD) for c in classes]
+        )
+
+        self.detector_output = self.detector.metadata["outputs"][0]
+        self.output_indices = [
+            self.detector_output.get(f"{name}_output_index", default)
+            for name, default in (("boxes", 0), ("labels", 1), ("scores", 2))
+        ]
+        self.detection_thresholds = np.array(
+            [
+                (
+                    detection_threshold
+                    if detection_threshold is not None
+                    else c.get("default_threshold", DEFAULT_CLASS_THRESHOLD)
+                )
+                for c in self.detector_output["classes"]
+            ]
+        )
+
+    def gate(self, image: np.ndarray):
+        """Returns whether the detector has to run on an image and the classifier probabilities."""
+        x, _ = preprocess_from_metadata(image, self.classifier.metadata["input"])
+        probabilities = self.classifier.run(x)[0][0]
+        return (
+            bool(np.any((probabilities >= self.thresholds) & self.trigger)),
+            probabilities,
+        )
+
+    def detect(self, image: np.ndarray):
+        """
+        Runs the detector on an image.
+
+        Returns:
+            The boxes (N, 4) in xyxy image coordinates, labels (N,) and scores (N,) above the detection
+            thresholds.
+        """
+        input_metadata = self.detector.metadata["input"]
+        x, transform = preprocess_from_metadata(image, input_metadata)
+        outputs = self.detector.run(x)
+        boxes, labels, scores = (outputs[i] for i in self.output_indices)
+        boxes = decode_boxes(boxes, self.detector_output, input_metadata)
+        labels, scores = labels.reshape(-1), scores.reshape(-1)
+        keep = scores >= self.detection_thresholds[labels]
+        boxes = boxes_to_image(boxes[keep], transform, image.shape)
+        return boxes.astype(np.float32), labels[keep], scores[keep]
+
+    def run(self, image: np.ndarray) -> Dict:
+        """
+        Runs the cascade on an image.
+
+        Returns:
+            Dictionary with the classifier `probabilities` and the `detections` of `detect`, None if the
+            frame did not pass the gate.
+        """
+        passed, probabilities = self.gate(image)
+        return {
+            "probabilities": probabilities,
+            "detections": self.detect(image) if passed else None,
+        }
+
+
+def evaluate_cascade(
+    cascade: CascadeRunner, images: Sequence[np.ndarray], positives: Sequence[bool]
+) -> Dict[str, float]:
+    """
+    Compares the cascade with running the detector on every frame of a labeled set.
+
+    Args:
+        cascade: The cascade.
+        images: The frames, e.g. from `read_image_file`.
+        positives: Whether a frame contains objects to detect.
+
+    Returns:
+        Dictionary with the frames per second of the cascade (`cascade_fps`) and of the detector alone
+        (`detector_fps`), the `invocation_rate` of the detector, the `frame_recall` of the gate on the
+        positive frames and `missed_detections`, the share of the detections of the detector alone on the
+        frames the gate rejected.
+    """
+    if len(images) != len(positives):
+        raise ValueError("images and positives must have the same length.")
+    positives = np.asarray(positives, dtype=bool)
+    gate_s = detector_s = gated_detector_s = 0.0
+    passed = np.zeros(len(images), dtype=bool)
+    detections = np.zeros(len(images), dtype=int)
+    for i, image in enumerate(images):
+        start = time.perf_counter()
+        passed[i], _ = cascade.gate(image)
+        gate_s += time.perf_counter() - start
+        start = time.perf_counter()
+        detections[i] = len(cascade.detect(image)[0])
+        detector_time = time.perf_counter() - start
+        detector_s += detector_time
+        # the cascade runs the detector only on the frames which passed the gate
+        gated_detector_s += detector_time if passed[i] else 0.0
+
+    cascade_s = gate_s + gated_detector_s
+    report = {
+        "frames": len(images),
+        "cascade_fps": len(images) / cascade_s,
+        "detector_fps": len(images) / detector_s,
+        "invocation_rate": float(passed.mean()),
+        "frame_recall": (
+            float(passed[positives].mean()) if positives.any() else float("nan")
+        ),
+        "missed_detections": (
+            float(detections[~passed].sum() / detections.sum())
+            if detections.sum()
+            else 0.0
+        ),
+    }
+    print(
+        f"{report['frames']} frames, detector invoked on {report['invocation_rate']:.1%}"
+    )
+    print(
+        f"cascade {report['cascade_fps']:.1f} frames/s, "
+        f"detector only {report['detector_fps']:.1f} frames/s"
+    )
+    print(
+        f"recall cost: {1 - report['frame_recall']:.1%} of the positive frames and "
+        f"{report['missed_detections']:.1%} of the detections missed"
+    )
+    return report
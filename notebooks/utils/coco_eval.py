@@ -0,0 +1,411 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_THRESHOLDS = np.linspace(0.0, 1.0, 101)
+AREA_RANGES = {
+    "all": (0.0, 1e10),
+    "small": (0.0, 32.0**2),
+    "medium": (32.0**2, 96.0**2),
+    "large": (96.0**2, 1e10),
+}
+
+# (name, metric, IoU threshold, area range, index of the maximum detections) of the COCOeval statistics.
+# COCOeval computes the first one at 100 detections whatever maxDets is, None stands for that.
+STATS = [
+    ("AP @ IoU=0.50:0.95", "precision", None, "all", None),
+    ("AP @ IoU=0.50", "precision", 0.5, "all", -1),
+    ("AP @ IoU=0.75", "precision", 0.75, "all", -1),
+    ("AP (small)", "precision", None, "small", -1),
+    ("AP (medium)", "precision", None, "medium", -1),
+    ("AP (large)", "precision", None, "large", -1),
+    ("AR @ maxDets[0]", "recall", None, "all", 0),
+    ("AR @ maxDets[1]", "recall", None, "all", 1),
+    ("AR @ maxDets[2]", "recall", None, "all", 2),
+    ("AR (small)", "recall", None, "small", -1),
+    ("AR (medium)", "recall", None, "medium", -1),
+    ("AR (large)", "recall", None, "large", -1),
+]
+
+
+def _xywh_array(items: List[Dict]) -> np.ndarray:
+    return np.asarray([item["bbox"] for item in items], dtype=np.float64).reshape(-1, 4)
+
+
+def batched_box_iou(
+    detections: np.ndarray, ground_truths: np.ndarray, crowd: np.ndarray
+) -> np.ndarray:
+    """
+    IoU of padded batches of xywh boxes like pycocotools: for crowd ground truths the intersection is
+    divided by the detection area.
+
+    Args:
+        detections: Detections (G, D, 4).
+        ground_truths: Ground truths (G, M, 4).
+        crowd: Crowd flag of the ground truths (G, M).
+
+    Returns:
+        IoU matrices (G, D, M).
+    """
+    d = detections[:, :, np.newaxis, :]
+    g = ground_truths[:, np.newaxis, :, :]
+    w = np.minimum(d[..., 0] + d[..., 2], g[..., 0] + g[..., 2]) - np.maximum(
+        d[..., 0], g[..., 0]
+    )
+    h = np.minimum(d[..., 1] + d[..., 3], g[..., 1] + g[..., 3]) - np.maximum(
+        d[..., 1], g[..., 1]
+    )
+    intersection = np.clip(w, 0, None) * np.clip(h, 0, None)
+    detection_area = d[..., 2] * d[..., 3]
+    union = np.where(
+        crowd[:, np.newaxis, :],
+        detection_area,
+        detection_area + g[..., 2] * g[..., 3] - intersection,
+    )
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+
+def _pad(values: np.ndarray, group: np.ndarray, rank: np.ndarray, groups: int, fill):
+    width = int(rank.max()) + 1 if len(rank) else 0
+    padded = np.full((groups, width) + values.shape[1:], fill, dtype=values.dtype)
+    padded[group, rank] = values
+    return padded
+
+
+def _rank_in_group(group: np.ndarray) -> np.ndarray:
+    """Position of every element within its group, the elements of a group must be contiguous."""
+    if not len(group):
+        return np.zeros(0, dtype=int)
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    return np.arange(len(group)) - np.repeat(starts, np.diff(np.r_[starts, len(group)]))
+
+
+class CocoEvaluator:
+    def __init__(
+        self,
+        categories: Union[Dict, Sequence[int]],
+        max_detections: Sequence[int] = (100, 300, 1000),
+    ):
+        """
+        NumPy implementation of the COCOeval box metrics.
+
+        The detections of an image and a category are matched greedily by decreasing score, like pycocotools,
+        but the matching runs for all images of a batch and all IoU thresholds at once, one step per detection
+        rank. Images are added in batches with `update`, only their matches are kept. Since a detection is
+        matched independently of the detections with lower scores, the matches stay valid when detections are
+        dropped by a score threshold or a lower maximum number of detections, so `summarize` can re-score
+        with other settings without matching again.
+
+        Example:
+        evaluator = CocoEvaluator(coco, max_detections=[100, 300, 1000])
+        for batch in batches:
+            evaluator.update(batch_image_ids, batch_annotations, batch_results)
+        stats = evaluator.summarize()
+        stats_at_threshold = evaluator.summarize(score_thresholds={1: 0.4, 2: 0.6}, max_detections=[1, 10, 20])
+
+        Args:
+            categories: The COCO annotation dictionary or the category ids.
+            max_detections: The maximum numbers of detections per image of the recall statistics, the last
+                one is used by the precision statistics and bounds the detections kept per image.
+        """
+        if isinstance(categories, dict):
+            categories = [c["id"] for c in categories["categories"]]
+        self.category_ids = sorted(categories)
+        self.max_detections = list(max_detections)
+        # per (category, area range) the columns of the matched detections and the ground truth count
+        self._matches = defaultdict(list)
+        self._ground_truths = defaultdict(int)
+        self.image_ids = set()
+
+    def update(
+        self,
+        image_ids: Sequence[int],
+        annotations: List[Dict],
+        results: List[Dict],
+    ):
+        """
+        Matches the detections of a batch of images.
+
+        Args:
+            image_ids: Ids of the images of the batch, images without annotations and detections included.
+            annotations: COCO ground truth annotations of the images.
+            results: COCO detection results of the images, with `image_id`, `category_id`, `bbox` (xywh)
+                and `score`.
+        """
+        image_ids = np.asarray(sorted(set(image_ids)), dtype=np.int64)
+        if self.image_ids.intersection(image_ids.tolist()):
+            raise ValueError("Images were already added.")
+        self.image_ids.update(image_ids.tolist())
+
+        gt_images = np.asarray([a["image_id"] for a in annotations], dtype=np.int64)
+        gt_categories = np.asarray(
+            [a["category_id"] for a in annotations], dtype=np.int64
+        )
+        gt_boxes = _xywh_array(annotations)
+        gt_areas = np.asarray([a["area"] for a in annotations], dtype=np.float64)
+        gt_crowd = np.asarray(
+            [bool(a.get("iscrowd", 0)) for a in annotations], dtype=bool
+        )
+        dt_images = np.asarray([r["image_id"] for r in results], dtype=np.int64)
+        dt_categories = np.asarray([r["category_id"] for r in results], dtype=np.int64)
+        dt_boxes = _xywh_array(results)
+        dt_scores = np.asarray([r["score"] for r in results], dtype=np.float64)
+        if (
+            not np.isin(dt_images, image_ids).all()
+            or not np.isin(gt_images, image_ids).all()
+        ):
+            raise ValueError(
+                "The annotations and results must belong to the images of the batch."
+            )
+
+        for category_id in self.category_ids:
+            gt = np.flatnonzero(gt_categories == category_id)
+            dt = np.flatnonzero(dt_categories == category_id)
+            self._match_category(
+                category_id,
+                np.searchsorted(image_ids, gt_images[gt]),
+                gt_boxes[gt],
+                gt_areas[gt],
+                gt_crowd[gt],
+                np.searchsorted(image_ids, dt_images[dt]),
+                dt_boxes[dt],
+                dt_scores[dt],
+                image_ids,
+            )
+
+    def _match_category(
+        self,
+        category_id,
+        gt_group,
+        gt_boxes,
+        gt_areas,
+        gt_crowd,
+        dt_group,
+        dt_boxes,
+        dt_scores,
+        image_ids,
+    ):
+        groups = len(image_ids)
+        # ground truths keep their annotation order within an image
+        order = np.argsort(gt_group, kind="stable")
+        gt_group, gt_boxes, gt_areas, gt_crowd = (
+            gt_group[order],
+            gt_boxes[order],
+            gt_areas[order],
+            gt_crowd[order],
+        )
+        gt_rank = _rank_in_group(gt_group)
+        # detections by decreasing score within an image, at most max_detections[-1]
+        order = np.lexsort((-dt_scores, dt_group))
+        dt_group, dt_boxes, dt_scores = (
+            dt_group[order],
+            dt_boxes[order],
+            dt_scores[order],
+        )
+        dt_rank = _rank_in_group(dt_group)
+        keep = dt_rank < self.max_detections[-1]
+        dt_group, dt_boxes, dt_scores, dt_rank = (
+            dt_group[keep],
+            dt_boxes[keep],
+            dt_scores[keep],
+            dt_rank[keep],
+        )
+        dt_areas = dt_boxes[:, 2] * dt_boxes[:, 3]
+
+        valid_gt = _pad(np.ones(len(gt_group), bool), gt_group, gt_rank, groups, False)
+        crowd = _pad(gt_crowd, gt_group, gt_rank, groups, False)
+        areas = _pad(gt_areas, gt_group, gt_rank, groups, 0.0)
+        ious = batched_box_iou(
+            _pad(dt_boxes, dt_group, dt_rank, groups, 0.0),
+            _pad(gt_boxes, gt_group, gt_rank, groups, 0.0),
+            crowd,
+        )
+        if not ious.shape[2]:
+            # no ground truth in the batch, every detection is a false positive
+            ious = np.zeros(ious.shape[:2] + (1,))
+            valid_gt, crowd = np.zeros((groups, 1), bool), np.zeros((groups, 1), bool)
+            areas = np.zeros((groups, 1))
+        thresholds = IOU_THRESHOLDS[np.newaxis, :, np.newaxis]
+
+        for area_name, (low, high) in AREA_RANGES.items():
+            ignored = crowd | (areas < low) | (areas > high)
+            self._ground_truths[category_id, area_name] += int(
+                np.count_nonzero(valid_gt & ~ignored)
+            )
+            matched_gt = np.zeros((groups, len(IOU_THRESHOLDS), ious.shape[2]), bool)
+            dt_matched = np.zeros((len(dt_group), len(IOU_THRESHOLDS)), bool)
+            dt_ignored = np.zeros((len(dt_group), len(IOU_THRESHOLDS)), bool)
+            for rank in range(ious.shape[1]):
+                at_rank = np.flatnonzero(dt_rank == rank)
+                group = dt_group[at_rank]
+                iou = ious[group, rank][:, np.newaxis, :]
+                # a ground truth is taken once, crowds can absorb any number of detections
+                candidates = (
+                    valid_gt[group][:, np.newaxis, :]
+                    & (~matched_gt[group] | crowd[group][:, np.newaxis, :])
+                    & (iou >= np.minimum(thresholds, 1 - 1e-10))
+                )
+                # the best IoU among the regular ground truths, the ignored ones only if there is none;
+                # ties go to the last ground truth, as in pycocotools
+                key = np.where(
+                    candidates, iou + 2 * ~ignored[group][:, np.newaxis, :], -1.0
+                )
+                best = key.shape[2] - 1 - np.argmax(key[:, :, ::-1], axis=2)
+                found = (
+                    np.take_along_axis(key, best[..., np.newaxis], axis=2)[..., 0] >= 0
+                )
+                g, t = np.nonzero(found)
+                matched_gt[group[g], t, best[g, t]] = True
+                dt_matched[at_rank] = found
+                dt_ignored[at_rank[g], t] = ignored[group[g], best[g, t]]
+
+            # unmatched detections outside of the area range do not count
+            outside = (dt_areas < low) | (dt_areas > high)
+            dt_ignored |= ~dt_matched & outside[:, np.newaxis]
+            self._matches[category_id, area_name].append(
+                (
+                    dt_scores,
+                    image_ids[dt_group],
+                    dt_rank,
+                    dt_matched,
+                    dt_ignored,
+                )
+            )
+
+    def accumulate(
+        self,
+        max_detections: Optional[Sequence[int]] = None,
+        score_thresholds: Optional[Union[float, Dict[int, float]]] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        Computes the precision and recall arrays of COCOeval from the matches.
+
+        Args:
+            max_detections: Maximum numbers of detections per image, at most the last value of the
+                constructor. Defaults to the values of the constructor.
+            score_thresholds: Minimum detection score, for all categories or per category id, e.g. the
+                `default_threshold` of the classes.
+
+        Returns:
+            Dictionary with `precision` (IoU thresholds, recall thresholds, categories, area ranges, maximum
+            detections) and `recall` (IoU thresholds, categories, area ranges, maximum detections), -1 where
+            a category has no ground truth.
+        """
+        max_detections = list(max_detections or self.max_detections)
+        if max(max_detections) > self.max_detections[-1]:
+            raise ValueError(
+                f"Only the best {self.max_detections[-1]} detections per image were matched."
+            )
+        if not isinstance(score_thresholds, dict):
+            score_thresholds = dict.fromkeys(self.category_ids, score_thresholds or 0.0)
+
+        shape = (
+            len(IOU_THRESHOLDS),
+            len(self.category_ids),
+            len(AREA_RANGES),
+            len(max_detections),
+        )
+        precision = -np.ones(shape[:1] + (len(RECALL_THRESHOLDS),) + shape[1:])
+        recall = -np.ones(shape)
+        for k, category_id in enumerate(self.category_ids):
+            for a, area_name in enumerate(AREA_RANGES):
+                ground_truths = self._ground_truths[category_id, area_name]
+                if not ground_truths:
+                    continue
+                scores, images, ranks, matched, ignored = (
+                    np.concatenate(
+                        [c[i] for c in self._matches[category_id, area_name]]
+                    )
+                    for i in range(5)
+                )
+                # the order of pycocotools: by score, then by image id and rank
+                order = np.lexsort((ranks, images, -scores))
+                scores, ranks, matched, ignored = (
+                    scores[order],
+                    ranks[order],
+                    matched[order],
+                    ignored[order],
+                )
+                above = scores >= score_thresholds.get(category_id, 0.0)
+                for m, max_detection in enumerate(max_detections):
+                    selected = above & (ranks < max_detection)
+                    tp = np.cumsum(matched[selected] & ~ignored[selected], axis=0).T
+                    fp = np.cumsum(~matched[selected] & ~ignored[selected], axis=0).T
+                    detections = tp.shape[1]
+                    rc = tp / ground_truths
+                    pr = tp / (tp + fp + np.spacing(1))
+                    # precision envelope, the maximum precision at any higher recall
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+                    recall[:, k, a, m] = rc[:, -1] if detections else 0
+                    for t in range(len(IOU_THRESHOLDS)):
+                        indices = np.searchsorted(rc[t], RECALL_THRESHOLDS, side="left")
+                        q = np.zeros(len(RECALL_THRESHOLDS))
+                        inside = indices < detections
+                        q[inside] = pr[t, indices[inside]]
+                        precision[t, :, k, a, m] = q
+        return {"precision": precision, "recall": recall}
+
+    def summarize(
+        self,
+        max_detections: Optional[Sequence[int]] = None,
+        score_thresholds: Optional[Union[float, Dict[int, float]]] = None,
+        verbose: bool = True,
+    ) -> np.ndarray:
+        """
+        Computes the 12 COCOeval box statistics, see `accumulate` for the arguments.
+
+        Returns:
+            The statistics in the order of COCOeval.stats, the first one is the mAP @ IoU=0.50:0.95.
+        """
+        max_detections = list(max_detections or self.max_detections)
+        accumulated = self.accumulate(max_detections, score_thresholds)
+        area_names = list(AREA_RANGES)
+        stats = np.zeros(len(STATS))
+        for i, (name, metric, iou_threshold, area_name, m) in enumerate(STATS):
+            if m is None:
+                m = max_detections.index(100) if 100 in max_detections else None
+            values = np.zeros(0)
+            if m is not None:
+                values = accumulated[metric]
+                if iou_threshold is not None:
+                    values = values[np.isclose(IOU_THRESHOLDS, iou_threshold)]
+                values = values[..., area_names.index(area_name), m]
+                values = values[values > -1]
+                name = name.replace(f"maxDets[{m}]", f"maxDets={max_detections[m]}")
+            stats[i] = values.mean() if values.size else -1
+            if verbose:
+                print(f"{name:<22} {stats[i]:.3f}")
+        return stats
+
+
+def evaluate_coco(
+    coco: Dict,
+    results: List[Dict],
+    max_detections: Sequence[int] = (100, 300, 1000),
+    batch_size: int = 512,
+) -> CocoEvaluator:
+    """
+    Matches detection results against a COCO annotation dictionary in batches of images.
+
+    Returns:
+        The evaluator, call `summarize` for the statistics.
+    """
+    evaluator = CocoEvaluator(coco, max_detections)
+    annotations, detections = defaultdict(list), defaultdict(list)
+    for annotation in coco["annotations"]:
+        annotations[annotation["image_id"]].append(annotation)
+    for result in results:
+        detections[result["image_id"]].append(result)
+    image_ids = sorted(image["id"] for image in coco["images"])
+    for start in range(0, len(image_ids), batch_size):
+        batch = image_ids[start : start + batch_size]
+        evaluator.update(
+            batch,
+            [a for image_id in batch for a in annotations[image_id]],
+            [r for image_id in batch for r in detections[image_id]],
+        )
+    return evaluator
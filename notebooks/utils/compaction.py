@@ -0,0 +1,191 @@
+import hashlib
+import time
+from typing import Dict, Set
+
+import numpy as np
+import onnx
+from onnx import numpy_helper
+from utils.image import preprocess_from_metadata
+from utils.runtime import copy_model, create_session_from_model
+
+
+def _subgraphs(node: onnx.NodeProto):
+    for attribute in node.attribute:
+        if attribute.type == onnx.AttributeProto.GRAPH:
+            yield attribute.g
+        elif attribute.type == onnx.AttributeProto.GRAPHS:
+            yield from attribute.graphs
+
+
+def _used_names(graph: onnx.GraphProto) -> Set[str]:
+    """Names of the tensors used by the nodes of a graph and of its subgraphs."""
+    names = set()
+    for node in graph.node:
+        names.update(node.input)
+        for subgraph in _subgraphs(node):
+            names |= _used_names(subgraph)
+            names.update(o.name for o in subgraph.output)
+    return names
+
+
+def _rename_inputs(graph: onnx.GraphProto, mapping: Dict[str, str]):
+    for node in graph.node:
+        for i, name in enumerate(node.input):
+            if name in mapping:
+                node.input[i] = mapping[name]
+        for subgraph in _subgraphs(node):
+            _rename_inputs(subgraph, mapping)
+            for output in subgraph.output:
+                if output.name in mapping:
+                    output.name = mapping[output.name]
+
+
+def _initializer_key(initializer: onnx.TensorProto) -> str:
+    digest = hashlib.sha256(numpy_helper.to_array(initializer).tobytes())
+    digest.update(str((initializer.data_type, tuple(initializer.dims))).encode())
+    return digest.hexdigest()
+
+
+def _resolve(mapping: Dict[str, str]) -> Dict[str, str]:
+    """Follows chains of renamings, e.g. of consecutive Identity nodes, to their end."""
+    resolved = {}
+    for name in mapping:
+        target = mapping[name]
+        while target in mapping:
+            target = mapping[target]
+        resolved[name] = target
+    return resolved
+
+
+def _session_creation_time(model: onnx.ModelProto, repeat: int = 3) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        create_session_from_model(model)
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def compact_model(model: onnx.ModelProto) -> onnx.ModelProto:
+    """
+    Removes the redundancy a model accumulates through `torch.onnx.export`, `quant_pre_process` and
+    `quantize_static`:
+    - duplicated initializers, found by hashing their data, are replaced by the first one,
+    - Identity nodes are bypassed, unless they produce a graph output,
+    - nodes which do not contribute to a graph output, e.g. orphaned DequantizeLinear nodes, are removed,
+    - unused initializers and the value_info of removed tensors are dropped.
+
+    Args:
+        model: The model, it is not modified. External data must be loaded.
+
+    Returns:
+        The compacted model.
+    """
+    model = copy_model(model)
+    graph = model.graph
+    graph_outputs = {o.name for o in graph.output}
+
+    mapping = {}
+    first_by_key = {}
+    for initializer in graph.initializer:
+        if initializer.name in graph_outputs:
+            continue
+        key = _initializer_key(initializer)
+        if key in first_by_key:
+            mapping[initializer.name] = first_by_key[key]
+        else:
+            first_by_key[key] = initializer.name
+
+    identities = []
+    for node in graph.node:
+        if node.op_type == "Identity" and node.output[0] not in graph_outputs:
+            mapping[node.output[0]] = node.input[0]
+            identities.append(node)
+    for node in identities:
+        graph.node.remove(node)
+    _rename_inputs(graph, _resolve(mapping))
+
+    # keep the nodes which contribute to a graph output, walking the topologically sorted nodes backwards
+    needed = set(graph_outputs)
+    live = []
+    for node in reversed(graph.node):
+        if any(output in needed for output in node.output):
+            live.append(node)
+            needed.update(node.input)
+            for subgraph in _subgraphs(node):
+                needed |= _used_names(subgraph)
+    del graph.node[:]
+    graph.node.extend(reversed(live))
+
+    # deleted in place, the initializers of large models are not copied
+    used = _used_names(graph) | graph_outputs
+    removed = set()
+    for i in reversed(range(len(graph.initializer))):
+        if graph.initializer[i].name not in used:
+            removed.add(graph.initializer[i].name)
+            del graph.initializer[i]
+    # models of IR version < 4 list the initializers as graph inputs too
+    inputs = [i for i in graph.input if i.name not in removed]
+    del graph.input[:]
+    graph.input.extend(inputs)
+    produced = {output for node in graph.node for output in node.output}
+    value_info = [vi for vi in graph.value_info if vi.name in produced]
+    del graph.value_info[:]
+    graph.value_info.extend(value_info)
+    return model
+
+
+def compaction_report(
+    model: onnx.ModelProto, compacted_model: onnx.ModelProto
+) -> Dict[str, float]:
+    """
+    Compares a model with its compacted version.
+
+    Returns:
+        Dictionary with the number of `nodes`, `initializers` and the serialized size in `bytes` of both models
+        (`*_before`, `*_after`), and the session creation time in ms (`load_ms_before`, `load_ms_after`).
+    """
+    report = {}
+    for suffix, onnx_model in (("before", model), ("after", compacted_model)):
+        report[f"nodes_{suffix}"] = len(onnx_model.graph.node)
+        report[f"initializers_{suffix}"] = len(onnx_model.graph.initializer)
+        report[f"bytes_{suffix}"] = onnx_model.ByteSize()
+        report[f"load_ms_{suffix}"] = 1000 * _session_creation_time(onnx_model)
+    return report
+
+
+def print_compaction_report(report: Dict[str, float]):
+    print(
+        f"Compaction: {report['nodes_before']} -> {report['nodes_after']} nodes, "
+        f"{report['initializers_before']} -> {report['initializers_after']} initializers, "
+        f"{report['bytes_before'] / 2**20:.2f} -> {report['bytes_after'] / 2**20:.2f} MiB "
+        f"({report['bytes_before'] - report['bytes_after']} bytes saved)"
+    )
+    print(
+        f"Session creation {report['load_ms_before']:.1f} ms -> {report['load_ms_after']:.1f} ms"
+    )
+
+
+def verify_compaction(
+    model: onnx.ModelProto,
+    compacted_model: onnx.ModelProto,
+    input_example: np.ndarray,
+    input_metadata: Dict,
+):
+    """
+    Runs both models on the preprocessed input example, see `preprocess_from_metadata`, and checks that their
+    outputs are identical up to float rounding.
+
+    Raises:
+        ValueError: If the outputs differ.
+    """
+    x, _ = preprocess_from_metadata(input_example, input_metadata)
+    outputs = []
+    for onnx_model in (model, compacted_model):
+        session = create_session_from_model(onnx_model)
+        outputs.append(session.run(None, {session.get_inputs()[0].name: x}))
+    for name, expected, actual in zip([o.name for o in model.graph.output], *outputs):
+        if expected.shape != actual.shape or not np.allclose(
+            actual, expected, rtol=1e-5, atol=1e-6
+        ):
+            raise ValueError(f"Output {name} of the compacted model differs.")
@@ -0,0 +1,334 @@
+import json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import onnx
+from utils.benchmark import measure
+from utils.partition import node_macs, tensor_bytes, tensor_dims, tensor_shapes
+from utils.quantization import load_model_without_weights
+from utils.runtime import (
+    create_session,
+    create_session_options,
+    random_feeds,
+    read_univision_model,
+)
+
+POOL_OP_TYPES = {"MaxPool", "AveragePool", "LpPool"}
+REDUCE_OP_TYPES = {
+    "GlobalAveragePool",
+    "GlobalMaxPool",
+    "ReduceMean",
+    "ReduceMax",
+    "ReduceSum",
+    "ReduceL2",
+}
+ELEMENTWISE_OP_TYPES = {
+    "Add",
+    "Sub",
+    "Mul",
+    "Div",
+    "Pow",
+    "Sqrt",
+    "Exp",
+    "Relu",
+    "LeakyRelu",
+    "PRelu",
+    "Sigmoid",
+    "HardSigmoid",
+    "HardSwish",
+    "Tanh",
+    "Clip",
+    "Softmax",
+    "BatchNormalization",
+    "QuantizeLinear",
+    "DequantizeLinear",
+}
+
+# Features of the latency model: compute, memory traffic and per-node dispatch overhead.
+LATENCY_FEATURES = ("macs", "bytes", "nodes")
+
+
+def node_cost(
+    node: onnx.NodeProto, types: Dict[str, onnx.TypeProto], initializer_names
+) -> Dict[str, int]:
+    """
+    Estimates the cost of a node from the shapes of its tensors.
+
+    Conv, ConvTranspose, Gemm and MatMul count their multiply-accumulate operations, see
+    `utils.partition.node_macs`. Pooling counts one operation per output element and kernel element,
+    reductions one per input element and elementwise ops one per output element. Other ops, e.g. reshapes,
+    count 0.
+
+    Returns:
+        Dictionary with the `macs`, the `param_bytes` of the initializer inputs and the `activation_bytes` of
+        the outputs.
+    """
+    macs = node_macs(node, types)
+    output = types.get(node.output[0]) if node.output else None
+    if not macs and output is not None:
+        output_elements = int(np.prod(tensor_dims(output), dtype=np.int64))
+        if node.op_type in POOL_OP_TYPES:
+            kernel_shape = next(
+                (list(a.ints) for a in node.attribute if a.name == "kernel_shape"), [1]
+            )
+            macs = output_elements * int(np.prod(kernel_shape, dtype=np.int64))
+        elif node.op_type in REDUCE_OP_TYPES and node.input[0] in types:
+            macs = int(np.prod(tensor_dims(types[node.input[0]]), dtype=np.int64))
+        elif node.op_type in ELEMENTWISE_OP_TYPES:
+            macs = output_elements
+    return {
+        "macs": macs,
+        "param_bytes": sum(
+            tensor_bytes(types[name])
+            for name in node.input
+            if name in initializer_names and name in types
+        ),
+        "activation_bytes": sum(
+            tensor_bytes(types[name]) for name in node.output if name in types
+        ),
+    }
+
+
+def _stage(node_name: str, stage_depth: int) -> str:
+    # PyTorch export names nodes after the module path, e.g. /backbone/stage2/conv/Conv
+    parts = [part for part in node_name.split("/") if part][:-1]
+    return "/".join(parts[:stage_depth]) or "(top level)"
+
+
+class ModelCost:
+    def __init__(self, nodes: List[Dict]):
+        """
+        Static cost of the nodes of a model, see `analyze_model`.
+
+        Args:
+            nodes: One row per node with the `node` name, `op_type`, `stage`, `macs`, `param_bytes` and
+                `activation_bytes`.
+        """
+        self.nodes = nodes
+
+    def totals(self) -> Dict[str, int]:
+        """Returns the total `macs`, `param_bytes`, `activation_bytes`, `bytes` and number of `nodes`."""
+        totals = {
+            key: sum(row[key] for row in self.nodes)
+            for key in ("macs", "param_bytes", "activation_bytes")
+        }
+        totals["bytes"] = totals["param_bytes"] + totals["activation_bytes"]
+        totals["nodes"] = len(self.nodes)
+        return totals
+
+    def table(self, key: str = "stage") -> List[Dict]:
+        """Aggregates the costs by "stage" or "op_type", in order of first appearance."""
+        groups = defaultdict(
+            lambda: {"nodes": 0, "macs": 0, "param_bytes": 0, "activation_bytes": 0}
+        )
+        for row in self.nodes:
+            group = groups[row[key]]
+            group["nodes"] += 1
+            for column in ("macs", "param_bytes", "activation_bytes"):
+                group[column] += row[column]
+        return [{key: value, **group} for value, group in groups.items()]
+
+    def print_report(
+        self, key: str = "stage", latency_model: Optional["LatencyModel"] = None
+    ):
+        """Prints the costs per stage or op type, and the predicted latency if a latency model is given."""
+        totals = self.totals()
+        print(
+            f"{key:<40} {'nodes':>6} {'GMACs':>8} {'share':>6} {'params MiB':>10} {'act. MiB':>9}"
+        )
+        for row in self.table(key) + [{key: "total", **totals}]:
+            print(
+                f"{str(row[key])[-40:]:<40} {row['nodes']:>6} {row['macs'] / 1e9:>8.3f} "
+                f"{row['macs'] / max(1, totals['macs']):>6.1%} {row['param_bytes'] / 2**20:>10.2f} "
+                f"{row['activation_bytes'] / 2**20:>9.2f}"
+            )
+        if latency_model is not None:
+            print(f"predicted latency {latency_model.predict(self):.2f} ms")
+
+
+def analyze_model(
+    model: Union[str, Path, onnx.ModelProto],
+    input_shapes: Optional[Dict[str, Sequence[int]]] = None,
+    stage_depth: int = 2,
+) -> ModelCost:
+    """
+    Computes the static cost of every node of a model from the graph structure only, the weights are not
+    loaded, see `utils.quantization.load_model_without_weights`.
+
+    Example:
+    cost = analyze_model("yolox_s.onnx", input_shapes={"input": [1, 3, 640, 640]})
+    cost.print_report(latency_model=LatencyModel.calibrate(["yolox_nano.onnx", "resnet18.onnx"]))
+
+    Args:
+        model: Path to an ONNX model or the loaded model.
+        input_shapes: New shapes of graph inputs, e.g. to evaluate another input resolution. The shapes of
+            the other tensors are inferred again.
+        stage_depth: Number of leading module names of the node names which form the stage, e.g. 2 for
+            "/backbone/stage2".
+    """
+    if not isinstance(model, onnx.ModelProto):
+        model = load_model_without_weights(model)
+    if input_shapes or not len(model.graph.value_info):
+        model = with_input_shapes(model, input_shapes or {})
+    types = tensor_shapes(model)
+    initializer_names = {i.name for i in model.graph.initializer}
+    nodes = []
+    for node in model.graph.node:
+        nodes.append(
+            {
+                "node": node.name,
+                "op_type": node.op_type,
+                "stage": _stage(node.name, stage_depth),
+                **node_cost(node, types, initializer_names),
+            }
+        )
+    return ModelCost(nodes)
+
+
+def with_input_shapes(
+    model: onnx.ModelProto, input_shapes: Dict[str, Sequence[int]]
+) -> onnx.ModelProto:
+    """
+    Returns a copy of a model with new input shapes, e.g. another input resolution, and the shapes of the
+    other tensors inferred again. The model is not modified.
+
+    Args:
+        model: The model.
+        input_shapes: New shape per input name, the other inputs keep their shape.
+    """
+    model = onnx.ModelProto.FromString(model.SerializeToString())
+    for graph_input in model.graph.input:
+        if graph_input.name in input_shapes:
+            shape = graph_input.type.tensor_type.shape
+            del shape.dim[:]
+            for size in input_shapes[graph_input.name]:
+                shape.dim.add().dim_value = size
+    if input_shapes:
+        # the stored shapes are those of the old input size
+        del model.graph.value_info[:]
+        for graph_output in model.graph.output:
+            graph_output.type.tensor_type.ClearField("shape")
+    return onnx.shape_inference.infer_shapes(model)
+
+
+def _features(cost: ModelCost) -> np.ndarray:
+    totals = cost.totals()
+    return np.array([totals[feature] for feature in LATENCY_FEATURES], dtype=np.float64)
+
+
+class LatencyModel:
+    def __init__(
+        self,
+        coefficients: Dict[str, float],
+        intercept_ms: float = 0.0,
+        intra_op_num_threads: int = 1,
+    ):
+        """
+        Linear latency model in ms: `intercept_ms` plus the weighted sum of the MACs, bytes and number of
+        nodes of a model. Create it with `calibrate` on the local CPU.
+
+        Args:
+            coefficients: Milliseconds per unit of each of the `LATENCY_FEATURES`.
+            intercept_ms: Fixed cost of a run.
+            intra_op_num_threads: Threads the latencies are predicted for, those of the calibration.
+        """
+        self.coefficients = coefficients
+        self.intercept_ms = intercept_ms
+        self.intra_op_num_threads = intra_op_num_threads
+
+    def predict(self, cost: ModelCost) -> float:
+        """Returns the predicted latency of a model in ms."""
+        features = _features(cost)
+        return self.intercept_ms + sum(
+            self.coefficients[name] * value
+            for name, value in zip(LATENCY_FEATURES, features)
+        )
+
+    @classmethod
+    def calibrate(
+        cls,
+        reference_models: Sequence,
+        intra_op_num_threads: int = 1,
+        repeat: int = 20,
+    ) -> "LatencyModel":
+        """
+        Fits the latency model to the measured latency of reference models on the local CPU.
+
+        The coefficients are fitted by least squares and kept non-negative, features whose coefficient
+        would be negative are dropped. With fewer reference models than features, only the first ones in
+        the order MACs, fixed cost, bytes and nodes are fitted. Reference models similar to the analyzed ones, e.g. the same
+        architecture family at other widths or input sizes, give the best predictions.
+
+        Args:
+            reference_models: Paths to runnable ONNX or uniVision models.
+            intra_op_num_threads: Threads of the measurement, the predictions are for the same number.
+            repeat: Number of measured runs per model.
+        """
+        features = []
+        latencies = []
+        for path in reference_models:
+            model_bytes, _ = read_univision_model(path)
+            session = create_session(
+                model_bytes,
+                create_session_options({"intra_op_num_threads": intra_op_num_threads}),
+                model_path=path,
+            )
+            feeds = random_feeds(session, 1)
+            latency_ms = (
+                1000 * measure(lambda: session.run(None, feeds), repeat, 3)["min"]
+            )
+            features.append(
+                _features(analyze_model(onnx.load_from_string(model_bytes)))
+            )
+            latencies.append(latency_ms)
+            print(f"{Path(path).name:<40} {latency_ms:>8.2f} ms measured")
+
+        features = np.array(features)
+        latencies = np.array(latencies)
+        # columns in order of priority: MACs, intercept, bytes, nodes, as many as there are models
+        columns = [
+            features[:, 0],
+            np.ones(len(latencies)),
+            features[:, 1],
+            features[:, 2],
+        ]
+        keys = ["macs", "intercept", "bytes", "nodes"]
+        active = list(range(min(len(columns), len(latencies))))
+        while True:
+            solution, *_ = np.linalg.lstsq(
+                np.stack([columns[i] for i in active], axis=1), latencies, rcond=None
+            )
+            if (solution >= 0).all() or len(active) == 1:
+                break
+            del active[int(np.argmin(solution))]
+        weights = {keys[i]: max(0.0, float(w)) for i, w in zip(active, solution)}
+        latency_model = cls(
+            {name: weights.get(name, 0.0) for name in LATENCY_FEATURES},
+            weights.get("intercept", 0.0),
+            intra_op_num_threads,
+        )
+        for path, x, latency_ms in zip(reference_models, features, latencies):
+            predicted = latency_model.intercept_ms + sum(
+                latency_model.coefficients[name] * value
+                for name, value in zip(LATENCY_FEATURES, x)
+            )
+            print(
+                f"{Path(path).name:<40} {predicted:>8.2f} ms predicted "
+                f"({predicted / latency_ms - 1:+.0%})"
+            )
+        return latency_model
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "coefficients": self.coefficients,
+                "intercept_ms": self.intercept_ms,
+                "intra_op_num_threads": self.intra_op_num_threads,
+            }
+        )
+
+    @classmethod
+    def from_json(cls, text: str) -> "LatencyModel":
+        return cls(**json.loads(text))
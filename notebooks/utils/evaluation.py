@@ -0,0 +1,356 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sklearn.metrics import average_precision_score, balanced_accuracy_score
+from utils.coco_eval import CocoEvaluator, evaluate_coco
+from utils.image import (
+    boxes_to_image,
+    decode_boxes,
+    preprocess_from_metadata,
+    read_image_file,
+)
+from utils.pipeline import list_image_files
+from utils.runtime import UnivisionSession, read_univision_model
+
+# State of an evaluation worker process, set by `_init_worker`.
+_worker_state = {}
+
+
+def file_hash(path) -> str:
+    """Returns the SHA-256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    def __init__(self, cache_dir, model_key: str):
+        """
+        On-disk cache of the raw predictions of a model, one .npz file per image, keyed by the image hash.
+
+        Args:
+            cache_dir: Root directory of the cache, shared by all models.
+            model_key: Key of the model, e.g. the hash of the model file and of the preprocessing.
+        """
+        self.directory = Path(cache_dir) / model_key
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, image_hash: str) -> Path:
+        return self.directory / f"{image_hash}.npz"
+
+    def get(self, image_hash: str) -> Optional[Dict]:
+        path = self._path(image_hash)
+        if not path.exists():
+            return None
+        with np.load(path) as data:
+            return {
+                "outputs": [data[f"output_{i}"] for i in range(int(data["count"]))],
+                "transform": tuple(data["transform"].tolist()),
+                "shape": tuple(data["shape"].tolist()),
+            }
+
+    def put(self, image_hash: str, prediction: Dict):
+        # written under a temporary name, so an interrupted run does not leave a truncated entry
+        path = self._path(image_hash)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            count=len(prediction["outputs"]),
+            transform=np.asarray(prediction["transform"], dtype=np.float64),
+            shape=np.asarray(prediction["shape"]),
+            **{f"output_{i}": o for i, o in enumerate(prediction["outputs"])},
+        )
+        os.replace(tmp_path, path)
+
+
+def _init_worker(model_path, preprocess, session_kwargs):
+    _worker_state["session"] = UnivisionSession(
+        model_path, pool_size=1, **session_kwargs
+    )
+    if preprocess is None:
+        input_metadata = _worker_state["session"].metadata["input"]
+        preprocess = lambda image: preprocess_from_metadata(image, input_metadata)
+    _worker_state["preprocess"] = preprocess
+
+
+def _predict(image_path) -> Dict:
+    image = read_image_file(str(image_path))
+    x, transform = _worker_state["preprocess"](image)
+    return {
+        "outputs": _worker_state["session"].run(x),
+        "transform": transform,
+        "shape": image.shape[:2],
+    }
+
+
+def predict_dataset(
+    model_path,
+    image_paths: Sequence,
+    cache_dir,
+    preprocess: Optional[Callable[[np.ndarray], Tuple[np.ndarray, tuple]]] = None,
+    num_workers: Optional[int] = None,
+    intra_op_num_threads: int = 1,
+    **session_kwargs,
+) -> List[Dict]:
+    """
+    Runs a model on images in worker processes and caches the raw predictions on disk.
+
+    The cache is keyed by the hash of the model file and the hash of every image file, so evaluating the
+    same model again, e.g. with other thresholds or metrics, only runs the images which are new or changed.
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+        image_paths: The image files, read with `read_image_file` (RGB).
+        cache_dir: Directory of the prediction cache.
+        preprocess: Picklable function mapping an image to the batched model input and the transform of
+            `preprocess_from_metadata`. Required for ONNX models, defaults to the preprocessing of the
+            uniVision metadata. A custom preprocessing should get its own `cache_dir`, the cache key does not
+            include it.
+        num_workers: Number of worker processes. Defaults to the number of CPUs.
+        intra_op_num_threads: ONNX Runtime threads per worker.
+        **session_kwargs: Further arguments of `UnivisionSession`, e.g. providers.
+
+    Returns:
+        Per image a dictionary with the raw model `outputs`, the `transform` from model input to image
+        coordinates and the image `shape` (height, width).
+    """
+    cache = PredictionCache(cache_dir, file_hash(model_path)[:16])
+    image_hashes = [file_hash(path) for path in image_paths]
+    predictions = [cache.get(image_hash) for image_hash in image_hashes]
+    missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+    print(
+        f"{len(image_paths) - len(missing)} of {len(image_paths)} predictions cached, "
+        f"running {len(missing)} images"
+    )
+    if missing:
+        num_workers = min(num_workers or os.cpu_count(), len(missing))
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=_init_worker,
+            initargs=(
+                model_path,
+                preprocess,
+                {"intra_op_num_threads": intra_op_num_threads, **session_kwargs},
+            ),
+        ) as executor:
+            chunksize = max(1, len(missing) // (4 * num_workers))
+            for i, prediction in zip(
+                missing,
+                executor.map(
+                    _predict, [image_paths[i] for i in missing], chunksize=chunksize
+                ),
+            ):
+                cache.put(image_hashes[i], prediction)
+                predictions[i] = prediction
+    return predictions
+
+
+def class_folder_dataset(
+    directory, classes: Sequence[str], multi_label: bool = False
+) -> Tuple[List[Path], np.ndarray]:
+    """
+    Lists a dataset stored as one folder per class, like the classification notebooks.
+
+    Args:
+        directory: Directory with the class folders.
+        classes: The class names in model output order.
+        multi_label: If True a folder contains the images showing every class whose name is part of the
+            folder name, e.g. `sharpener-pencil`, and folders without a class name are negatives.
+
+    Returns:
+        The image paths and the targets, class indices (N,) or multi-hot labels (N, classes).
+    """
+    image_paths, targets = [], []
+    for folder in sorted(p for p in Path(directory).iterdir() if p.is_dir()):
+        if multi_label:
+            target = [int(c in folder.name) for c in classes]
+        elif folder.name in classes:
+            target = list(classes).index(folder.name)
+        else:
+            continue
+        for path in list_image_files(folder):
+            image_paths.append(path)
+            targets.append(target)
+    return image_paths, np.asarray(targets)
+
+
+def coco_dataset(annotation_file, image_dir) -> Tuple[List[Path], List[int], Dict]:
+    """
+    Lists the images of a COCO annotation file.
+
+    Returns:
+        The image paths, their COCO image ids and the annotation file content.
+    """
+    coco = json.loads(Path(annotation_file).read_text())
+    images = sorted(coco["images"], key=lambda image: image["id"])
+    return (
+        [Path(image_dir) / image["file_name"] for image in images],
+        [image["id"] for image in images],
+        coco,
+    )
+
+
+def balanced_accuracy(targets: np.ndarray, predictions: List[Dict]) -> float:
+    """Balanced accuracy of a multi-class classifier whose first output holds the class probabilities."""
+    probabilities = np.concatenate([p["outputs"][0] for p in predictions])
+    return float(balanced_accuracy_score(targets, probabilities.argmax(axis=1)))
+
+
+def multi_label_average_precision(
+    targets: np.ndarray, predictions: List[Dict], classes: Sequence[str]
+) -> Dict[str, float]:
+    """
+    Average precision per class and their mean (`macro`) of a multi-label classifier whose first output
+    holds the class probabilities.
+    """
+    probabilities = np.concatenate([p["outputs"][0] for p in predictions])
+    per_class = {
+        name: float(average_precision_score(targets[:, i], probabilities[:, i]))
+        for i, name in enumerate(classes)
+    }
+    return {**per_class, "macro": float(np.mean(list(per_class.values())))}
+
+
+def detection_results(
+    predictions: List[Dict],
+    image_ids: Sequence[int],
+    category_ids: Sequence[int],
+    output_metadata: Optional[Dict] = None,
+    input_metadata: Optional[Dict] = None,
+) -> List[Dict]:
+    """
+    Converts the raw predictions of a detector into COCO results, with the boxes in image coordinates.
+
+    Args:
+        predictions: Predictions of `predict_dataset`.
+        image_ids: COCO image id of every prediction.
+        category_ids: COCO category id of every model label.
+        output_metadata: The detection output of the model metadata, with the output indices and the
+            `boxes_format` and `boxes_coordinates`, see `decode_boxes`. Defaults to absolute xyxy boxes,
+            labels and scores as outputs 0, 1 and 2.
+        input_metadata: The `input` of the model metadata, required for relative boxes.
+    """
+    output_metadata = output_metadata or {}
+    output_indices = [
+        output_metadata.get(f"{name}_output_index", default)
+        for name, default in (("boxes", 0), ("labels", 1), ("scores", 2))
+    ]
+    category_ids = np.asarray(category_ids)
+    results = []
+    for prediction, image_id in zip(predictions, image_ids):
+        boxes, labels, scores = (prediction["outputs"][i] for i in output_indices)
+        boxes = decode_boxes(boxes, output_metadata, input_metadata)
+        boxes = boxes_to_image(boxes, prediction["transform"], prediction["shape"])
+        xywh = np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+        valid = (xywh[:, 2] > 0) & (xywh[:, 3] > 0)
+        results += [
+            {
+                "image_id": int(image_id),
+                "category_id": int(category_id),
+                "bbox": [float(v) for v in box],
+                "score": float(score),
+            }
+            for box, category_id, score in zip(
+                xywh[valid],
+                category_ids[labels.reshape(-1)[valid]],
+                scores.reshape(-1)[valid],
+            )
+        ]
+    return results
+
+
+def detection_map(
+    coco: Dict,
+    results: List[Dict],
+    max_detections: Sequence[int] = (100, 300, 1000),
+) -> CocoEvaluator:
+    """
+    COCO box metrics of detection results, with the maximum detections of mmdetection's CocoMetric. The
+    statistics are printed, the returned evaluator re-scores other thresholds without matching again.
+    """
+    evaluator = evaluate_coco(coco, results, max_detections)
+    evaluator.summarize()
+    return evaluator
+
+
+def evaluate_model(
+    model_path,
+    dataset_path,
+    cache_dir,
+    classes: Optional[Sequence[str]] = None,
+    image_dir=None,
+    task: Optional[str] = None,
+    **predict_kwargs,
+) -> Dict:
+    """
+    Scores a model on a class-folder dataset or a COCO file, see `predict_dataset` for the caching.
+
+    Example:
+    evaluate_model("classifier.u3o", "data/images/multi-class", "prediction-cache", ["paper", "rock", "scissors"])
+    evaluate_model("detector.u3o", "valid.json", "prediction-cache", image_dir="images/")
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+        dataset_path: Directory of class folders, or a COCO annotation file for detection.
+        cache_dir: Directory of the prediction cache.
+        classes: Class names in model output order, defaults to the classes of the uniVision metadata.
+        image_dir: Image directory of a COCO file.
+        task: "multi_class", "multi_label" or "detection". Defaults to the output type of the uniVision
+            metadata, or to "detection" for a COCO file.
+        **predict_kwargs: Arguments of `predict_dataset`, e.g. num_workers or preprocess.
+
+    Returns:
+        Dictionary with the `task` and its metrics: `balanced_accuracy`, `average_precision` or the COCO
+        `stats` and the `CocoEvaluator`.
+    """
+    metadata = read_univision_model(model_path)[1] or {}
+    output = (metadata.get("outputs") or [{}])[0]
+    if classes is None:
+        classes = [c["name"] for c in output.get("classes", [])]
+    if task is None:
+        task = {
+            "MULTI_CLASS_CLASSIFICATION": "multi_class",
+            "BINARY_CLASSIFICATION": "multi_class",
+            "MULTI_LABEL_CLASSIFICATION": "multi_label",
+            "OBJECT_DETECTION": "detection",
+        }.get(output.get("type"))
+        if task is None and str(dataset_path).endswith(".json"):
+            task = "detection"
+    if task is None:
+        raise ValueError("The task cannot be inferred, pass it explicitly.")
+
+    if task == "detection":
+        image_paths, image_ids, coco = coco_dataset(dataset_path, image_dir)
+        predictions = predict_dataset(
+            model_path, image_paths, cache_dir, **predict_kwargs
+        )
+        # model labels are the indices of the COCO categories sorted by id
+        category_ids = sorted(c["id"] for c in coco["categories"])
+        results = detection_results(
+            predictions, image_ids, category_ids, output, metadata.get("input")
+        )
+        evaluator = detection_map(coco, results)
+        return {
+            "task": task,
+            "stats": evaluator.summarize(verbose=False),
+            "evaluator": evaluator,
+        }
+
+    image_paths, targets = class_folder_dataset(
+        dataset_path, classes, multi_label=task == "multi_label"
+    )
+    predictions = predict_dataset(model_path, image_paths, cache_dir, **predict_kwargs)
+    if task == "multi_label":
+        average_precision = multi_label_average_precision(targets, predictions, classes)
+        print(f"Average precision (macro): {average_precision['macro']:.4f}")
+        return {"task": task, "average_precision": average_precision}
+    score = balanced_accuracy(targets, predictions)
+    print(f"Balanced accuracy score: {score:.02%}")
+    return {"task": task, "balanced_accuracy": score}
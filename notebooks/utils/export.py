@@ -1,7 +1,6 @@
 import colorsys
 import datetime
 import enum
-import shutil
 import uuid
 from enum import StrEnum
 from pathlib import Path
@@ -14,6 +13,12 @@ import onnx
 import pyzipper
 from ruamel.yaml import YAML
 from ruamel.yaml.scalarstring import SingleQuotedScalarString
+from utils.compaction import (
+    compact_model,
+    compaction_report,
+    print_compaction_report,
+    verify_compaction,
+)
 from utils.enums import (
     BoxesCoordinate,
     BoxesFormat,
@@ -28,12 +33,23 @@ from utils.enums import (
     ResizeImageAlignmentVertical,
     ResizeMode,
 )
+from utils.folding import (
+    benchmark_folding,
+    fold_input_normalization,
+    folded_input_metadata,
+    verify_folding,
+)
 from utils.image import write_image_file
+from utils.quantization import load_model_without_weights
+from utils.runtime import MAX_SERIALIZED_MODEL_SIZE, external_data_locations
+from utils.tracing import span, traced
 
 
+@traced("onnx validation")
 def validate_classification_onnx_model(onnx_model_path, channel_order, classes):
-    onnx_model = onnx.load(onnx_model_path)
-    onnx.checker.check_model(onnx_model)
+    # the checker reads the model from its path, which supports external data and models over 2 GB
+    onnx.checker.check_model(str(onnx_model_path))
+    onnx_model = load_model_without_weights(onnx_model_path)
 
     if len(onnx_model.graph.input) != 1:
         raise ValueError("The number of inputs of ONNX model is not 1.")
@@ -75,6 +91,7 @@ def validate_classification_onnx_model(onnx_model_path, channel_order, classes):
     return input_width, input_height, input_channels
 
 
+@traced("onnx validation")
 def validate_object_detection_onnx_model(
     onnx_model_path,
     channel_order,
@@ -82,8 +99,9 @@ def validate_object_detection_onnx_model(
     labels_output_index,
     scores_output_index,
 ):
-    onnx_model = onnx.load(onnx_model_path)
-    onnx.checker.check_model(onnx_model)
+    # the checker reads the model from its path, which supports external data and models over 2 GB
+    onnx.checker.check_model(str(onnx_model_path))
+    onnx_model = load_model_without_weights(onnx_model_path)
 
     if len(onnx_model.graph.input) != 1:
         raise ValueError("The number of inputs of ONNX model is not 1.")
@@ -213,6 +231,7 @@ def validate_classes(classes: Union[List[str], List[ClassDict]]) -> List[ClassDi
     return classes
 
 
+@traced()
 def export_univision_model_v3(
     univision_model_path: str,
     onnx_model_path: str,
@@ -247,6 +266,8 @@ def export_univision_model_v3(
     boxes_coordinates: Optional[Union[BoxesCoordinate, str]] = None,
     max_detections: Optional[int] = None,
     zip_password: Optional[str] = None,
+    fold_normalization: bool = False,
+    compact: bool = False,
 ):
     """
     Exports a model to a uniVision format, along with metadata and an input example.
@@ -316,6 +337,14 @@ def export_univision_model_v3(
             corresponding ONNX output with index boxes_output_index. Either 'relative' or 'absolute'. Defaults to 'absolute'.
         max_detections (int): Only applicable to object detection. uniVision uses this to filter the detections of the ONNX model
             if it returns too many. Defaults to 20.
+        fold_normalization (bool): Whether to fold the unit scaling and standardization into the first Conv of the
+            model, see `utils.folding.fold_input_normalization`. The model then takes the resized pixel values and
+            uniVision skips the normalization. The outputs are verified on the input_example. Only float models are
+            supported, a quantized (QDQ) model raises a ValueError: fold the float model with
+            `fold_input_normalization` before the quantization instead. Defaults to False.
+        compact (bool): Whether to remove duplicated initializers, Identity nodes and nodes and initializers which do
+            not contribute to the outputs, see `utils.compaction.compact_model`. The outputs are verified on the
+            input_example and the saved bytes and session creation time are reported. Defaults to False.
 
     Returns:
         None: This function saves a zipped Univision model file at the specified path.
@@ -628,28 +657,90 @@ def export_univision_model_v3(
     if quantization is None:
         metadata.pop("quantization")
 
+    rewritten_model = None
+    if compact:
+        with span("compaction"):
+            onnx_model = onnx.load(onnx_model_path)
+            rewritten_model = compact_model(onnx_model)
+            verify_compaction(
+                onnx_model, rewritten_model, input_example, metadata["input"]
+            )
+            print_compaction_report(compaction_report(onnx_model, rewritten_model))
+
+    # after the compaction, which bypasses Identity nodes between the Conv and its weights
+    if fold_normalization and (
+        unit_scaling or standardization_mean or standardization_std
+    ):
+        onnx_model = (
+            rewritten_model
+            if rewritten_model is not None
+            else onnx.load(onnx_model_path)
+        )
+        with span("normalization folding"):
+            rewritten_model = fold_input_normalization(
+                onnx_model, unit_scaling, standardization_mean, standardization_std
+            )
+            difference = verify_folding(
+                onnx_model, rewritten_model, input_example, metadata["input"]
+            )
+            timings = benchmark_folding(
+                onnx_model, rewritten_model, input_example, metadata["input"]
+            )
+        metadata["input"] = folded_input_metadata(metadata["input"])
+        print(
+            f"Folded the input normalization into the first Conv (max output difference {difference:.2e}), "
+            f"preprocessing and inference {timings['normalized_ms']:.2f} ms -> {timings['folded_ms']:.2f} ms per frame"
+        )
+
     # create zip
     with TemporaryDirectory() as tmp_dir:
         yaml_file_path = tmp_dir / Path("model.yaml")
         input_example_file_path = tmp_dir / Path("input_example.png")
-        copied_onnx_model_path = tmp_dir / Path("model.onnx")
-        file_paths = [yaml_file_path, input_example_file_path, copied_onnx_model_path]
+        file_paths = [yaml_file_path, input_example_file_path]
 
-        shutil.copy(onnx_model_path, copied_onnx_model_path)
+        # the model and its external data files are streamed into the archive, the tensor files uncompressed
+        # so that `read_external_initializers` can seek to the tensors
+        external_data = external_data_locations(
+            load_model_without_weights(onnx_model_path)
+        )
+        if rewritten_model is not None:
+            model_path = tmp_dir / Path("model.onnx")
+            with span("model save"):
+                onnx.save(
+                    rewritten_model,
+                    model_path,
+                    save_as_external_data=bool(external_data)
+                    or rewritten_model.ByteSize() >= MAX_SERIALIZED_MODEL_SIZE,
+                    location="model.onnx.data",
+                )
+            model_directory = Path(tmp_dir)
+            external_data = external_data_locations(rewritten_model)
+        else:
+            model_path = Path(onnx_model_path)
+            model_directory = model_path.parent
 
         yaml = YAML()
         yaml.version = (1, 2)
         yaml.default_flow_style = False
         yaml.indent(mapping=2, sequence=4, offset=2)
-        yaml.dump(metadata, yaml_file_path)
+        with span("yaml dump"):
+            yaml.dump(metadata, yaml_file_path)
 
-        write_image_file(input_example, str(input_example_file_path))
+        with span("image encode"):
+            write_image_file(input_example, str(input_example_file_path))
 
-        with pyzipper.ZipFile(
+        with span("zip write", path=str(univision_model_path)), pyzipper.ZipFile(
             univision_model_path, "w", compression=pyzipper.ZIP_DEFLATED
         ) as zip:
             for file_path in file_paths:
                 zip.write(file_path, file_path.name)
+            zip.write(model_path, "model.onnx")
+            for location in external_data:
+                zip.write(
+                    model_directory / location,
+                    location,
+                    compress_type=pyzipper.ZIP_STORED,
+                )
 
     print(f"Successfully exported to {univision_model_path}")
 
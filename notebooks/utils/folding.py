@@ -0,0 +1,362 @@
+import time
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper
+from utils.image import preprocess_from_metadata
+from utils.quantization import GraphIndex
+from utils.runtime import copy_model, create_session_from_model
+
+
+def _first_conv(model: onnx.ModelProto):
+    """
+    Finds the Conv consuming the graph input, directly for NCHW models or through an NCHW Transpose for NHWC
+    models. Returns the Conv node and the name of its input tensor.
+    """
+    index = GraphIndex.from_model(model)
+    tensor = model.graph.input[0].name
+    consumers = index.consumers.get(tensor, [])
+    if len(consumers) == 1 and index.op_types[consumers[0]] == "Transpose":
+        transpose = index.nodes[consumers[0]]
+        perm = next((list(a.ints) for a in transpose.attribute if a.name == "perm"), [])
+        if perm != [0, 3, 1, 2]:
+            raise ValueError(f"Unsupported input transpose {perm}.")
+        tensor = transpose.output[0]
+        consumers = index.consumers.get(tensor, [])
+    if any(index.op_types[c] == "QuantizeLinear" for c in consumers):
+        raise ValueError(
+            "The input normalization can only be folded into float models, the input of this model is "
+            "quantized for the normalized values. Fold it before the quantization."
+        )
+    if (
+        len(consumers) != 1
+        or index.op_types[consumers[0]] != "Conv"
+        or index.inputs[consumers[0]][0] != tensor
+    ):
+        raise ValueError(
+            "The input normalization can only be folded if the model input only feeds a Conv."
+        )
+    return index.nodes[consumers[0]], tensor
+
+
+def _conv_pads(conv: onnx.NodeProto, weight: np.ndarray, height: int, width: int):
+    """Returns the pads [top, left, bottom, right] of a 2D Conv on an input of the given size, also for auto_pad."""
+    attributes = {a.name: helper.get_attribute_value(a) for a in conv.attribute}
+    auto_pad = attributes.get("auto_pad", b"NOTSET").decode()
+    if auto_pad == "VALID":
+        return [0, 0, 0, 0]
+    if auto_pad not in ("SAME_UPPER", "SAME_LOWER"):
+        return list(attributes.get("pads", [0, 0, 0, 0]))
+    begins, ends = [], []
+    for size, kernel, stride, dilation in zip(
+        (height, width),
+        attributes.get("kernel_shape", weight.shape[2:]),
+        attributes.get("strides", [1, 1]),
+        attributes.get("dilations", [1, 1]),
+    ):
+        total = max(
+            (-(-size // stride) - 1) * stride + (kernel - 1) * dilation + 1 - size, 0
+        )
+        small, large = total // 2, total - total // 2
+        begins.append(small if auto_pad == "SAME_UPPER" else large)
+        ends.append(large if auto_pad == "SAME_UPPER" else small)
+    return begins + ends
+
+
+def fold_input_normalization(
+    model: onnx.ModelProto,
+    unit_scaling: bool = False,
+    standardization_mean: Optional[Sequence[float]] = None,
+    standardization_std: Optional[Sequence[float]] = None,
+) -> onnx.ModelProto:
+    """
+    Folds the unit scaling `x / 255` and the standardization `(x - mean) / std` of the input into the weights
+    and bias of the first Conv, so the model takes the resized pixel values directly.
+
+    The normalization is x * a + b per channel, so the Conv weights are multiplied by a and the Conv of the
+    constant b is added to the bias. The zero padding of the Conv is applied to the normalized input, which
+    is -b / a in pixel values and not 0. If the Conv pads its input, the folded model pads it explicitly with
+    -b / a per channel, by concatenating constant strips of the padding width around it, and the Conv pads
+    nothing. Only the border is stored, a few KB; for a batch size other than 1 the strips are expanded to
+    the batch size of the input. The padding of FIT_WITH_PADDING needs no correction,
+    uniVision applies it to the pixel values before the normalization, like to the rest of the image.
+
+    Args:
+        model: The float model, with a single input (N, C, H, W) or (N, H, W, C) of fixed height and width
+            feeding a Conv with constant weights. It is not modified. Quantized (QDQ) models are not
+            supported, the scale of their quantized input covers the normalized values.
+        unit_scaling: Whether the input is divided by 255.
+        standardization_mean: Mean per channel, after the unit scaling.
+        standardization_std: Standard deviation per channel, after the unit scaling.
+
+    Returns:
+        The model with the folded normalization, to be exported with `unit_scaling=False` and without
+        standardization.
+    """
+    model = copy_model(model)
+    conv, conv_input = _first_conv(model)
+    initializers = {i.name: i for i in model.graph.initializer}
+    if conv.input[1] not in initializers or (
+        len(conv.input) > 2 and conv.input[2] and conv.input[2] not in initializers
+    ):
+        raise ValueError("The first Conv must have constant weights and bias.")
+    weight = numpy_helper.to_array(initializers[conv.input[1]]).astype(np.float32)
+    bias = (
+        numpy_helper.to_array(initializers[conv.input[2]]).astype(np.float32)
+        if len(conv.input) > 2 and conv.input[2]
+        else np.zeros(weight.shape[0], dtype=np.float32)
+    )
+
+    out_channels, group_channels = weight.shape[:2]
+    group = next((a.i for a in conv.attribute if a.name == "group"), 1)
+    in_channels = group_channels * group
+    scale = np.full(in_channels, 1 / 255 if unit_scaling else 1.0, dtype=np.float64)
+    mean = (
+        np.zeros(in_channels)
+        if standardization_mean is None
+        else np.array(standardization_mean, dtype=np.float64)
+    )
+    std = (
+        np.ones(in_channels)
+        if standardization_std is None
+        else np.array(standardization_std, dtype=np.float64)
+    )
+    a = scale / std
+    b = -mean / std
+    # input channel of every (output channel, weight channel) pair
+    channel = (
+        np.arange(out_channels)[:, None] // (out_channels // group)
+    ) * group_channels + np.arange(group_channels)
+    folded_weight = (weight * a[channel][:, :, None, None]).astype(np.float32)
+    folded_bias = (
+        bias
+        + (weight.astype(np.float64) * b[channel][:, :, None, None]).sum(axis=(1, 2, 3))
+    ).astype(np.float32)
+
+    weight_name = f"{conv.input[1]}_folded"
+    bias_name = f"{conv.output[0]}_bias_folded"
+    model.graph.initializer.extend(
+        [
+            numpy_helper.from_array(folded_weight, weight_name),
+            numpy_helper.from_array(folded_bias, bias_name),
+        ]
+    )
+    conv.input[1] = weight_name
+    if len(conv.input) > 2:
+        conv.input[2] = bias_name
+    else:
+        conv.input.append(bias_name)
+
+    dims = [d.dim_value for d in model.graph.input[0].type.tensor_type.shape.dim]
+    if conv_input != model.graph.input[0].name:
+        dims = [dims[0], dims[3], dims[1], dims[2]]
+    batch, height, width = dims[0], dims[2], dims[3]
+    top, left, bottom, right = _conv_pads(conv, weight, height, width)
+    if any((top, left, bottom, right)) and np.any(b != 0):
+        if not height or not width:
+            raise ValueError(
+                "The input normalization can only be folded into a padded Conv for a fixed input size."
+            )
+        # pad with the pixel value -b / a, which normalizes to the 0 the original Conv padded with
+        value = (-b / a).astype(np.float32)[:, None, None]
+        columns = f"{conv_input}_padded_columns"
+        padded = f"{conv_input}_padded"
+        strips = {
+            "left": np.broadcast_to(value, (in_channels, height, left)),
+            "right": np.broadcast_to(value, (in_channels, height, right)),
+            "top": np.broadcast_to(value, (in_channels, top, width + left + right)),
+            "bottom": np.broadcast_to(
+                value, (in_channels, bottom, width + left + right)
+            ),
+        }
+        names = {}
+        nodes = []
+        if batch != 1:
+            # the strips are stored for one image and expanded to the batch size of the input
+            batch_shape = f"{padded}_batch_shape"
+            model.graph.initializer.extend(
+                [
+                    numpy_helper.from_array(np.array([0], np.int64), f"{padded}_start"),
+                    numpy_helper.from_array(np.array([1], np.int64), f"{padded}_end"),
+                    numpy_helper.from_array(
+                        np.array([1, 1, 1], np.int64), f"{padded}_ones"
+                    ),
+                ]
+            )
+            nodes += [
+                helper.make_node(
+                    "Shape",
+                    [conv_input],
+                    [f"{padded}_shape"],
+                    name=f"{conv.name}_pad_shape",
+                ),
+                helper.make_node(
+                    "Slice",
+                    [f"{padded}_shape", f"{padded}_start", f"{padded}_end"],
+                    [f"{padded}_batch"],
+                    name=f"{conv.name}_pad_batch",
+                ),
+                helper.make_node(
+                    "Concat",
+                    [f"{padded}_batch", f"{padded}_ones"],
+                    [batch_shape],
+                    name=f"{conv.name}_pad_batch_shape",
+                    axis=0,
+                ),
+            ]
+        for side, strip in strips.items():
+            # sides without padding are left out of the Concat
+            names[side] = [f"{padded}_{side}"] if strip.size else []
+            if not strip.size:
+                continue
+            strip_name = f"{padded}_{side}" if batch == 1 else f"{padded}_{side}_strip"
+            model.graph.initializer.append(
+                numpy_helper.from_array(
+                    np.ascontiguousarray(strip[np.newaxis]), strip_name
+                )
+            )
+            if batch != 1:
+                nodes.append(
+                    helper.make_node(
+                        "Expand",
+                        [strip_name, batch_shape],
+                        [f"{padded}_{side}"],
+                        name=f"{conv.name}_pad_{side}",
+                    )
+                )
+        nodes += [
+            helper.make_node(
+                "Concat",
+                names["left"] + [conv_input] + names["right"],
+                [columns],
+                name=f"{conv.name}_pad_columns",
+                axis=3,
+            ),
+            helper.make_node(
+                "Concat",
+                names["top"] + [columns] + names["bottom"],
+                [padded],
+                name=f"{conv.name}_pad_rows",
+                axis=2,
+            ),
+        ]
+        position = list(model.graph.node).index(conv)
+        for node in reversed(nodes):
+            model.graph.node.insert(position, node)
+        conv.input[0] = padded
+        attributes = [a for a in conv.attribute if a.name not in ("pads", "auto_pad")]
+        del conv.attribute[:]
+        conv.attribute.extend(attributes)
+        conv.attribute.append(helper.make_attribute("pads", [0, 0, 0, 0]))
+
+    # drop the original weights and bias if nothing else uses them
+    used = {name for node in model.graph.node for name in node.input}
+    kept = [i for i in model.graph.initializer if i.name in used]
+    del model.graph.initializer[:]
+    model.graph.initializer.extend(kept)
+    return model
+
+
+def verify_folding(
+    model: onnx.ModelProto,
+    folded_model: onnx.ModelProto,
+    input_example: np.ndarray,
+    input_metadata: Dict,
+    rtol: float = 1e-3,
+    atol: float = 1e-5,
+) -> float:
+    """
+    Runs the model with the normalized input example and the folded model with the pixel values, and checks
+    that the outputs match.
+
+    Args:
+        model: The original model.
+        folded_model: The model returned by `fold_input_normalization`.
+        input_example: Image (H, W, C) as passed to `export_univision_model_v3`.
+        input_metadata: The `input` metadata of the original model, see `preprocess_from_metadata`.
+
+    Returns:
+        The maximum absolute difference of the outputs.
+
+    Raises:
+        ValueError: If the outputs differ.
+    """
+    folded_metadata = folded_input_metadata(input_metadata)
+    outputs = []
+    for onnx_model, metadata in (
+        (model, input_metadata),
+        (folded_model, folded_metadata),
+    ):
+        session = create_session_from_model(onnx_model)
+        x, _ = preprocess_from_metadata(input_example, metadata)
+        outputs.append(session.run(None, {session.get_inputs()[0].name: x}))
+    difference = 0.0
+    for expected, actual in zip(*outputs):
+        if expected.shape != actual.shape or not np.allclose(
+            actual, expected, rtol, atol
+        ):
+            raise ValueError(
+                "The outputs of the model with the folded input normalization differ from the original "
+                f"model, shapes {expected.shape} and {actual.shape}."
+            )
+        if expected.size:
+            difference = max(
+                difference,
+                float(np.abs(actual.astype(np.float64) - expected).max()),
+            )
+    return difference
+
+
+def folded_input_metadata(input_metadata: Dict) -> Dict:
+    """Returns the `input` metadata without unit scaling and standardization."""
+    metadata = {
+        k: v
+        for k, v in input_metadata.items()
+        if k not in ("standardization_mean", "standardization_std")
+    }
+    metadata["unit_scaling"] = False
+    return metadata
+
+
+def benchmark_folding(
+    model: onnx.ModelProto,
+    folded_model: onnx.ModelProto,
+    input_example: np.ndarray,
+    input_metadata: Dict,
+    repeat: int = 50,
+) -> Dict[str, float]:
+    """
+    Measures the time per frame of the preprocessing and the inference, end to end, of the model with the
+    normalized input and of the folded model with the pixel values. The folded model saves the
+    normalization, but its first Conv may read an explicitly padded input.
+
+    Args:
+        model: The original model.
+        folded_model: The model returned by `fold_input_normalization`.
+        input_example: Image (H, W, C) as passed to `export_univision_model_v3`.
+        input_metadata: The `input` metadata of the original model, see `preprocess_from_metadata`.
+        repeat: Number of timed frames.
+
+    Returns:
+        Dictionary with the mean `normalized_ms`, `folded_ms` and the `saved_ms`.
+    """
+    timings = {}
+    for name, onnx_model, metadata in (
+        ("normalized_ms", model, input_metadata),
+        ("folded_ms", folded_model, folded_input_metadata(input_metadata)),
+    ):
+        session = create_session_from_model(onnx_model)
+        input_name = session.get_inputs()[0].name
+
+        def frame():
+            x, _ = preprocess_from_metadata(input_example, metadata)
+            session.run(None, {input_name: x})
+
+        frame()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            frame()
+        timings[name] = 1000 * (time.perf_counter() - start) / repeat
+    timings["saved_ms"] = timings["normalized_ms"] - timings["folded_ms"]
+    return timings
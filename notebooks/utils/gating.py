@@ -0,0 +1,189 @@
+import time
+from typing import Any, Callable, Dict, Optional
+
+import cv2
+import numpy as np
+from utils.image import read_image_file
+from utils.pipeline import list_image_files
+
+GATE_METHODS = ("diff", "phash")
+
+
+def downsampled_signature(image: np.ndarray, size: int = 32) -> np.ndarray:
+    """Returns a small grayscale thumbnail of an image, area-averaged so sensor noise cancels out."""
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA).astype(
+        np.float32
+    )
+
+
+def perceptual_hash(image: np.ndarray, hash_size: int = 8) -> np.ndarray:
+    """
+    Returns the perceptual hash (pHash) of an image: the signs of the lowest DCT frequencies of a 32x32
+    thumbnail relative to their median, as a boolean array of `hash_size**2` bits.
+    """
+    thumbnail = downsampled_signature(image, 4 * hash_size)
+    low_frequencies = cv2.dct(thumbnail)[:hash_size, :hash_size].flatten()
+    return low_frequencies > np.median(low_frequencies[1:])
+
+
+class ChangeGate:
+    def __init__(
+        self,
+        method: str = "diff",
+        threshold: Optional[float] = None,
+        max_staleness: int = 30,
+        size: Optional[int] = None,
+    ):
+        """
+        Decides whether a frame differs enough from the last inferred frame to run the model again.
+
+        The frame is compared with the frame of the last inference, not with the previous frame, so a slow
+        drift adds up until it crosses the threshold.
+
+        Args:
+            method: "diff" compares downsampled frames by their mean absolute difference in gray levels,
+                "phash" compares perceptual hashes by their Hamming distance in bits.
+            threshold: Change up to which the previous result is reused. Defaults to 2 gray levels for
+                "diff" and 4 bits for "phash".
+            max_staleness: Maximum number of consecutive frames which reuse a result, 0 disables the gate.
+            size: Thumbnail size of "diff", 32 by default, or hash size of "phash", 8 by default.
+        """
+        if method not in GATE_METHODS:
+            raise ValueError(f"method must be one of {GATE_METHODS}, got {method}.")
+        self.method = method
+        self.threshold = (
+            threshold if threshold is not None else (2.0 if method == "diff" else 4)
+        )
+        self.max_staleness = max_staleness
+        self.size = size or (32 if method == "diff" else 8)
+        self.reset()
+
+    def reset(self):
+        """Forgets the reference frame, the next frame is always inferred."""
+        self.reference = None
+        self.staleness = 0
+
+    def signature(self, image: np.ndarray) -> np.ndarray:
+        if self.method == "diff":
+            return downsampled_signature(image, self.size)
+        return perceptual_hash(image, self.size)
+
+    def change(self, signature: np.ndarray) -> float:
+        """Returns the change of a signature relative to the reference frame."""
+        if self.method == "diff":
+            return float(np.abs(signature - self.reference).mean())
+        return float(np.count_nonzero(signature != self.reference))
+
+    def should_run(self, image: np.ndarray) -> bool:
+        """Returns whether the model has to run on a frame and updates the reference frame if so."""
+        signature = self.signature(image)
+        if (
+            self.reference is None
+            or self.staleness >= self.max_staleness
+            or self.change(signature) > self.threshold
+        ):
+            self.reference = signature
+            self.staleness = 0
+            return True
+        self.staleness += 1
+        return False
+
+
+class GatedInference:
+    def __init__(self, infer: Callable[[np.ndarray], Any], gate: ChangeGate):
+        """
+        Puts a ChangeGate in front of an inference function. Frames which did not change reuse the previous
+        result, without preprocessing and without running the model.
+
+        Example:
+        gated = GatedInference(
+            lambda image: session.run(preprocess(image)[np.newaxis]), ChangeGate(max_staleness=10)
+        )
+        for path in list_image_files("frames/"):
+            outputs = gated(read_image_file(path))
+
+        Args:
+            infer: Function mapping a decoded frame to the result, including the preprocessing.
+            gate: The gate.
+        """
+        self.infer = infer
+        self.gate = gate
+        self.result = None
+        self.frames = 0
+        self.skipped = 0
+
+    def __call__(self, image: np.ndarray):
+        self.frames += 1
+        if self.gate.should_run(image):
+            self.result = self.infer(image)
+        else:
+            self.skipped += 1
+        return self.result
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.skipped / self.frames if self.frames else 0.0
+
+
+def evaluate_change_gate(
+    frame_directory,
+    infer: Callable[[np.ndarray], Any],
+    gate: ChangeGate,
+    read: Callable[[str], np.ndarray] = read_image_file,
+) -> Dict[str, float]:
+    """
+    Replays a recorded frame directory with and without the gate and reports the skip ratio and the
+    latency savings.
+
+    Every frame is inferred for the ungated latency, the gated latency is the gate time plus the inference
+    time of the frames the gate lets through. Decoding is the same for both paths and not counted.
+
+    Args:
+        frame_directory: Directory of the frames, replayed in file name order.
+        infer: Function mapping a decoded frame to the result, including the preprocessing.
+        gate: The gate to evaluate, it is reset first.
+        read: Function decoding a frame file.
+
+    Returns:
+        Dictionary with `frames`, `skip_ratio`, the mean `ungated_ms` and `gated_ms` per frame, `gate_ms`,
+        the mean overhead of the gate, and `savings`, the relative latency reduction.
+    """
+    gate.reset()
+    ungated_s = gated_s = gate_s = 0.0
+    frames = skipped = 0
+    for path in list_image_files(frame_directory):
+        image = read(str(path))
+        start = time.perf_counter()
+        run = gate.should_run(image)
+        gate_time = time.perf_counter() - start
+        start = time.perf_counter()
+        infer(image)
+        infer_time = time.perf_counter() - start
+
+        frames += 1
+        skipped += not run
+        gate_s += gate_time
+        ungated_s += infer_time
+        gated_s += gate_time + (infer_time if run else 0.0)
+    if not frames:
+        raise ValueError(f"No frames found in {frame_directory}.")
+
+    report = {
+        "frames": frames,
+        "skip_ratio": skipped / frames,
+        "ungated_ms": 1000 * ungated_s / frames,
+        "gated_ms": 1000 * gated_s / frames,
+        "gate_ms": 1000 * gate_s / frames,
+        "savings": 1 - gated_s / ungated_s,
+    }
+    print(
+        f"{frames} frames, {report['skip_ratio']:.1%} skipped "
+        f"(method {gate.method}, threshold {gate.threshold}, max staleness {gate.max_staleness})"
+    )
+    print(
+        f"ungated {report['ungated_ms']:.2f} ms/frame, gated {report['gated_ms']:.2f} ms/frame "
+        f"(gate {report['gate_ms']:.3f} ms), {report['savings']:.1%} saved"
+    )
+    return report
@@ -118,3 +118,118 @@ def is_rgb_image(image_path: str) -> bool:
 
 def ensure_3ch_image(img):
     return img if img.ndim == 3 and img.shape[2] == 3 else np.dstack([img] * 3)
+
+
+def preprocess_from_metadata(image: np.ndarray, input_metadata: dict):
+    """
+    Preprocesses an image like uniVision does for an exported model, see the input section of model.yaml
+    written by `export_univision_model_v3`.
+
+    Args:
+        image: Image (H, W, C) in RGB or grayscale, e.g. from `read_image_file`.
+        input_metadata: The `input` dictionary of the model metadata.
+
+    Returns:
+        The batched float32 model input and the transform (scale_x, scale_y, offset_x, offset_y) which maps
+        model input coordinates back to the image, `(x - offset_x) / scale_x`.
+    """
+    if input_metadata["color_space"] == "GRAYSCALE":
+        if image.ndim == 3 and image.shape[2] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    else:
+        image = ensure_3ch_image(image.reshape(image.shape[:2] + (-1,)))
+        if input_metadata["color_space"] == "BGR":
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+
+    h, w = image.shape[:2]
+    target_h, target_w = input_metadata["height"], input_metadata["width"]
+    resize = input_metadata["resize"]
+    if resize["mode"] == "FIT_WITH_PADDING":
+        scale = min(target_h / h, target_w / w)
+        new_h, new_w = int(h * scale), int(w * scale)
+        alignment = resize.get("image_alignment", {})
+        # the fraction of the padding before the image
+        before = {"LEFT": 0, "TOP": 0, "CENTER": 0.5, "RIGHT": 1, "BOTTOM": 1}
+        offset_x = int(
+            (target_w - new_w) * before[alignment.get("horizontal", "CENTER")]
+        )
+        offset_y = int((target_h - new_h) * before[alignment.get("vertical", "CENTER")])
+        image = cv2.copyMakeBorder(
+            cv2.resize(image, (new_w, new_h)),
+            offset_y,
+            target_h - new_h - offset_y,
+            offset_x,
+            target_w - new_w - offset_x,
+            cv2.BORDER_CONSTANT,
+            value=tuple(resize.get("padding_value", (0,) * 3)),
+        )
+        transform = (scale, scale, offset_x, offset_y)
+    else:
+        image = cv2.resize(image, (target_w, target_h))
+        transform = (target_w / w, target_h / h, 0, 0)
+
+    x = image.reshape(target_h, target_w, -1).astype(np.float32)
+    if input_metadata.get("unit_scaling"):
+        x /= 255
+    if input_metadata.get("standardization_mean") is not None:
+        x -= np.asarray(input_metadata["standardization_mean"], dtype=np.float32)
+    if input_metadata.get("standardization_std") is not None:
+        x /= np.asarray(input_metadata["standardization_std"], dtype=np.float32)
+    if input_metadata.get("channel_order", "NCHW") == "NCHW":
+        x = np.moveaxis(x, -1, 0)
+    return np.ascontiguousarray(x[np.newaxis]), transform
+
+
+def decode_boxes(boxes: np.ndarray, output_metadata=None, input_metadata=None):
+    """
+    Converts the boxes output of a detector to xyxy boxes in model input pixels, according to the
+    `boxes_format` and `boxes_coordinates` of its output metadata.
+
+    Example:
+    boxes = decode_boxes(outputs[output["boxes_output_index"]], output, metadata["input"])
+    boxes = boxes_to_image(boxes, transform, image.shape[:2])
+
+    Args:
+        boxes: The boxes output, with 4 values per box.
+        output_metadata: The detection entry of the `outputs` of the model metadata. Defaults to absolute
+            left_top_right_bottom boxes, as uniVision does.
+        input_metadata: The `input` dictionary of the model metadata, its width and height scale relative
+            boxes.
+
+    Returns:
+        Float32 array (N, 4) of x1, y1, x2, y2 in model input pixels.
+    """
+    output_metadata = output_metadata or {}
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    boxes_format = output_metadata.get("boxes_format") or "left_top_right_bottom"
+    if boxes_format == "center_size":
+        boxes = np.concatenate(
+            [boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], axis=1
+        )
+    elif boxes_format == "top_left_size":
+        boxes = np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+    elif boxes_format != "left_top_right_bottom":
+        raise ValueError(f"Unknown boxes_format {boxes_format}.")
+
+    if output_metadata.get("boxes_coordinates") == "relative":
+        if input_metadata is None:
+            raise ValueError("Relative boxes need the input metadata to be decoded.")
+        width, height = input_metadata["width"], input_metadata["height"]
+        boxes = boxes * np.array([width, height, width, height], dtype=np.float32)
+    return boxes
+
+
+def boxes_to_image(boxes: np.ndarray, transform, image_shape) -> np.ndarray:
+    """
+    Maps xyxy boxes in model input pixels, see `decode_boxes`, to the image with the transform of
+    `preprocess_from_metadata`, clipped to the image of shape (H, W).
+    """
+    scale_x, scale_y, offset_x, offset_y = transform
+    h, w = image_shape[:2]
+    boxes = (boxes - [offset_x, offset_y, offset_x, offset_y]) / [
+        scale_x,
+        scale_y,
+        scale_x,
+        scale_y,
+    ]
+    return np.clip(boxes, 0, [w, h, w, h])
@@ -0,0 +1,432 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import threading
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+from onnxruntime.quantization import CalibrationDataReader
+from utils.runtime import (
+    create_session,
+    create_session_options,
+    load_session_config,
+    random_feeds,
+    read_external_initializers,
+    read_univision_model,
+)
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss() -> int:
+    """Returns the resident set size of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        # no procfs, fall back to the peak RSS, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _RssSampler(threading.Thread):
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self) -> int:
+        self._stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+# Peak Python memory of the open stages, outermost first. tracemalloc has a single peak per process, which a
+# nested stage resets, so the peaks seen before the reset are kept here.
+_python_peaks: List[int] = []
+
+
+def _mib(size: int) -> str:
+    return f"{size / 2**20:.1f}"
+
+
+class MemoryTracker:
+    def __init__(self, interval: float = 0.005, trace_python: bool = True):
+        """
+        Measures the memory of the stages of a pipeline, e.g. model loading, inference, export or quantization.
+
+        For every stage the RSS of the process is recorded before and after, and sampled by a background
+        thread for its peak. With `trace_python`, tracemalloc additionally reports the current and peak
+        memory allocated by Python objects, numpy arrays included, which separates them from the native
+        allocations of ONNX Runtime and PyTorch.
+
+        Example:
+        tracker = MemoryTracker()
+        with tracker.stage("export"):
+            export_univision_model_v3(...)
+        with tracker.stage("quantize"):
+            quantize_static(...)
+        tracker.print_report()
+
+        Args:
+            interval: RSS sampling interval in seconds. Peaks shorter than the interval may be missed.
+            trace_python: Whether to trace the Python allocations, which slows down Python code.
+        """
+        self.interval = interval
+        self.trace_python = trace_python
+        self.stages: List[Dict] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures the memory of the code in the block as a stage called `name`. Stages can be nested, e.g. the
+        quantization within a whole export, the spikes of the enclosing stage include those of the nested one.
+        """
+        started_tracing = self.trace_python and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_python:
+            if _python_peaks:
+                _python_peaks[-1] = max(
+                    _python_peaks[-1], tracemalloc.get_traced_memory()[1]
+                )
+            tracemalloc.reset_peak()
+            python_before = tracemalloc.get_traced_memory()[0]
+            _python_peaks.append(python_before)
+        rss_before = current_rss()
+        sampler = _RssSampler(self.interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            rss_peak = sampler.stop()
+            rss_after = current_rss()
+            row = {
+                "stage": name,
+                "rss_before": rss_before,
+                "rss_after": rss_after,
+                "rss_peak": rss_peak,
+                "rss_delta": rss_after - rss_before,
+                "rss_spike": rss_peak - rss_before,
+            }
+            if self.trace_python:
+                python_current, python_peak = tracemalloc.get_traced_memory()
+                python_peak = max(python_peak, _python_peaks.pop())
+                if _python_peaks:
+                    # the enclosing stage includes the peak of this one
+                    _python_peaks[-1] = max(_python_peaks[-1], python_peak)
+                row["python_delta"] = python_current - python_before
+                row["python_spike"] = python_peak - python_before
+            if started_tracing:
+                tracemalloc.stop()
+            self.stages.append(row)
+
+    @property
+    def peak_rss(self) -> int:
+        return max((row["rss_peak"] for row in self.stages), default=current_rss())
+
+    def print_report(self):
+        """Prints the RSS and Python memory of every stage in MiB."""
+        print(
+            f"{'stage':<20} {'RSS MiB':>9} {'delta':>9} {'peak':>9} {'spike':>9} "
+            f"{'py delta':>9} {'py spike':>9}"
+        )
+        for row in self.stages:
+            print(
+                f"{row['stage']:<20} {_mib(row['rss_after']):>9} {_mib(row['rss_delta']):>9} "
+                f"{_mib(row['rss_peak']):>9} {_mib(row['rss_spike']):>9} "
+                f"{_mib(row.get('python_delta', 0)):>9} {_mib(row.get('python_spike', 0)):>9}"
+            )
+
+
+def measure_model_memory(
+    model_path,
+    x: Optional[np.ndarray] = None,
+    batch_size: int = 1,
+    steady_runs: int = 20,
+    zip_password: Optional[str] = None,
+    tracker: Optional[MemoryTracker] = None,
+) -> Dict:
+    """
+    Measures the memory footprint of serving a model with ONNX Runtime, in the stages "load" (reading the
+    model file), "optimize" (creating the session), "first run" and "steady state".
+
+    The session uses the configuration saved next to the model, if any, so the effect of the memory arena
+    and memory pattern settings of `utils.tuning.tune_session` shows in the steady state. Run it in a fresh
+    process for absolute numbers, see `main`.
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+        x: Representative batch. Defaults to random inputs of `batch_size` samples.
+        batch_size: Batch size of the random inputs.
+        steady_runs: Number of runs of the steady state stage.
+        zip_password: Password of an encrypted uniVision model.
+        tracker: Tracker recording the stages, a new one by default.
+
+    Returns:
+        Dictionary with the `model`, the `stages` of the tracker, the `peak_rss` and the `steady_rss`, the
+        RSS growth from before loading the model to after the steady state, i.e. the memory one more
+        deployed model costs.
+    """
+    tracker = tracker or MemoryTracker()
+    first_stage = len(tracker.stages)
+    with tracker.stage("load"):
+        model_bytes, _ = read_univision_model(model_path, zip_password)
+        external_initializers = read_external_initializers(
+            model_path, model_bytes, zip_password
+        )
+    with tracker.stage("optimize"):
+        session = create_session(
+            model_bytes,
+            create_session_options(load_session_config(model_path)),
+            external_initializers=external_initializers,
+        )
+        del model_bytes, external_initializers
+    feeds = (
+        random_feeds(session, batch_size)
+        if x is None
+        else {session.get_inputs()[0].name: x}
+    )
+    with tracker.stage("first run"):
+        session.run(None, feeds)
+    with tracker.stage("steady state"):
+        for _ in range(steady_runs):
+            session.run(None, feeds)
+    stages = tracker.stages[first_stage:]
+    return {
+        "model": Path(model_path).name,
+        "stages": stages,
+        "peak_rss": max(row["rss_peak"] for row in stages),
+        "steady_rss": stages[-1]["rss_after"] - stages[0]["rss_before"],
+    }
+
+
+class RandomCalibrationDataReader(CalibrationDataReader):
+    def __init__(self, model_path, samples: int = 32):
+        """
+        Calibration data reader with random inputs, see `random_feeds`. The ranges it gives are useless for
+        accuracy, it is meant to measure the memory and time of the quantization without a dataset.
+
+        Args:
+            model_path: Path to the ONNX model to be quantized.
+            samples: Number of calibration samples.
+        """
+        self.session = create_session(
+            Path(model_path).read_bytes(), model_path=model_path
+        )
+        self.samples = samples
+        self.counter = 0
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        if self.counter >= self.samples:
+            return None
+        self.counter += 1
+        return random_feeds(self.session, seed=self.counter)
+
+
+def measure_export_memory(
+    model_path,
+    output_dir,
+    calibration_data_reader=None,
+    calibration_samples: int = 32,
+    quantize_kwargs: Optional[Dict] = None,
+    export_kwargs: Optional[Dict] = None,
+    tracker: Optional[MemoryTracker] = None,
+) -> Dict:
+    """
+    Measures the memory of preparing a model for uniVision, in the stages "quant pre-processing",
+    "calibration and quantization" and, with `export_kwargs`, "export" of the int8 model, all nested in the
+    stage "pipeline".
+
+    Example:
+    result = measure_export_memory(
+        "model.onnx",
+        "memory-export",
+        export_kwargs={
+            "classes": ["paper", "rock", "scissors"],
+            "input_example": input_example,
+            "output_type": "MULTI_CLASS_CLASSIFICATION",
+        },
+    )
+
+    Args:
+        model_path: Path to the fp32 ONNX model.
+        output_dir: Directory of the pre-processed, quantized and exported models.
+        calibration_data_reader: Calibration data reader of the quantization. Defaults to a
+            `RandomCalibrationDataReader` of the pre-processed model, which is enough to measure the memory.
+        calibration_samples: Number of samples of the default calibration data reader.
+        quantize_kwargs: Further arguments of `quantize_static`, e.g. per_channel or calibrate_method.
+        export_kwargs: Arguments of `export_univision_model_v3` other than the model paths. The export is
+            skipped without them.
+        tracker: Tracker recording the stages, a new one by default.
+
+    Returns:
+        Dictionary with the `model`, the `stages` of the tracker, the `peak_rss` and the paths of the
+        `quantized_model` and of the `univision_model`, None without export.
+    """
+    # imported here, so that measuring the serving of a model does not load PyTorch
+    from utils.export import export_univision_model_v3
+    from utils.quantization import quant_pre_process, quantize_static
+
+    tracker = tracker or MemoryTracker()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    preprocessed_path = output_dir / "preprocessed.onnx"
+    quantized_path = output_dir / "int8.onnx"
+    univision_path = output_dir / "model.u3o" if export_kwargs is not None else None
+    first_stage = len(tracker.stages)
+    with tracker.stage("pipeline"):
+        with tracker.stage("quant pre-processing"):
+            quant_pre_process(str(model_path), str(preprocessed_path))
+        with tracker.stage("calibration and quantization"):
+            quantize_static(
+                str(preprocessed_path),
+                str(quantized_path),
+                calibration_data_reader
+                or RandomCalibrationDataReader(preprocessed_path, calibration_samples),
+                **(quantize_kwargs or {}),
+            )
+        if export_kwargs is not None:
+            with tracker.stage("export"):
+                export_univision_model_v3(
+                    str(univision_path), str(quantized_path), **export_kwargs
+                )
+    stages = tracker.stages[first_stage:]
+    return {
+        "model": Path(model_path).name,
+        "stages": stages,
+        "peak_rss": max(row["rss_peak"] for row in stages),
+        "quantized_model": quantized_path,
+        "univision_model": univision_path,
+    }
+
+
+def _random_input_example(model_path, channel_order: str) -> np.ndarray:
+    """Random image (H, W, C) of the input size of a model."""
+    session = create_session(Path(model_path).read_bytes(), model_path=model_path)
+    shape = session.get_inputs()[0].shape
+    height, width, channels = shape[2], shape[3], shape[1]
+    if channel_order == "NHWC":
+        height, width, channels = shape[1], shape[2], shape[3]
+    return np.random.default_rng(0).integers(
+        0, 256, (height, width, channels), dtype=np.uint8
+    )
+
+
+def _measure_export_in_process(
+    model_path, output_dir, calibration_samples: int, export_kwargs: Optional[Dict]
+) -> Dict:
+    if export_kwargs is not None:
+        export_kwargs = {
+            **export_kwargs,
+            "input_example": _random_input_example(
+                model_path, export_kwargs["channel_order"]
+            ),
+        }
+    return measure_export_memory(
+        model_path,
+        output_dir,
+        calibration_samples=calibration_samples,
+        export_kwargs=export_kwargs,
+    )
+
+
+def _measure_in_process(model_path, batch_size: int, steady_runs: int) -> Dict:
+    # the tracing of Python allocations is not worth its cost for the native ONNX Runtime allocations
+    return measure_model_memory(
+        model_path,
+        batch_size=batch_size,
+        steady_runs=steady_runs,
+        tracker=MemoryTracker(trace_python=False),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Peak and steady-state memory of serving ONNX or uniVision models, or of quantizing and "
+        "exporting ONNX models with --quantize."
+    )
+    parser.add_argument("models", nargs="+", help="Models to measure.")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--steady-runs", type=int, default=20)
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Measure the quant pre-processing and the quantization of fp32 ONNX models, with random "
+        "calibration data, instead of serving the models.",
+    )
+    parser.add_argument("--calibration-samples", type=int, default=32)
+    parser.add_argument(
+        "--output-dir",
+        default="memory-export",
+        help="Directory of the quantized and exported models, one subdirectory per model.",
+    )
+    parser.add_argument(
+        "--export-classes",
+        nargs="+",
+        help="With --quantize, also measure the export of the int8 model with these classes and a random "
+        "input example.",
+    )
+    parser.add_argument("--output-type", default="MULTI_CLASS_CLASSIFICATION")
+    parser.add_argument("--channel-order", default="NCHW")
+    parser.add_argument("--resize-mode", default="STRETCH")
+    args = parser.parse_args()
+
+    export_kwargs = None
+    if args.export_classes:
+        export_kwargs = {
+            "classes": args.export_classes,
+            "output_type": args.output_type,
+            "channel_order": args.channel_order,
+            "resize_mode": args.resize_mode,
+        }
+
+    results = []
+    for model_path in args.models:
+        # every model is measured in a fresh process, so the numbers do not depend on the previous models
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            if args.quantize:
+                future = executor.submit(
+                    _measure_export_in_process,
+                    model_path,
+                    Path(args.output_dir) / Path(model_path).stem,
+                    args.calibration_samples,
+                    export_kwargs,
+                )
+            else:
+                future = executor.submit(
+                    _measure_in_process, model_path, args.batch_size, args.steady_runs
+                )
+            result = future.result()
+        results.append(result)
+        print(result["model"])
+        tracker = MemoryTracker()
+        tracker.stages = result["stages"]
+        tracker.print_report()
+
+    if args.quantize:
+        print(f"{'model':<40} {'peak MiB':>9}")
+        for result in results:
+            print(f"{result['model'][-40:]:<40} {_mib(result['peak_rss']):>9}")
+        return
+    print(f"{'model':<40} {'peak MiB':>9} {'steady MiB':>10}")
+    for result in results:
+        print(
+            f"{result['model'][-40:]:<40} {_mib(result['peak_rss']):>9} {_mib(result['steady_rss']):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
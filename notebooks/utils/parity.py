@@ -0,0 +1,311 @@
+from itertools import combinations
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+import onnx
+import torch
+from utils.quantization import GraphIndex
+from utils.runtime import create_cpu_session
+from utils.sensitivity import (
+    ErrorAccumulator,
+    add_graph_outputs,
+    quantized_tensor_names,
+)
+
+# Bins of the absolute error histogram, in powers of ten.
+_LOG_ERROR_BINS = np.linspace(-12, 6, 181)
+
+
+class DriftStatistics:
+    def __init__(self):
+        """
+        Streaming statistics of the element-wise absolute error of a tensor against its reference.
+
+        The percentiles come from a histogram of the error on a log scale with 10 bins per decade, so the
+        memory use does not depend on the number of samples.
+        """
+        self.error = ErrorAccumulator()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.histogram = np.zeros(len(_LOG_ERROR_BINS) + 1, dtype=np.int64)
+
+    def update(self, reference: np.ndarray, actual: np.ndarray):
+        self.error.update(reference, actual)
+        if reference.shape != actual.shape:
+            return
+        difference = np.abs(
+            reference.astype(np.float64, copy=False) - actual.astype(np.float64)
+        ).ravel()
+        if not difference.size:
+            return
+        self.count += difference.size
+        self.sum += float(difference.sum())
+        self.max = max(self.max, float(difference.max()))
+        with np.errstate(divide="ignore"):
+            bins = np.searchsorted(_LOG_ERROR_BINS, np.log10(difference))
+        self.histogram += np.bincount(bins, minlength=len(self.histogram))
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else float("nan")
+
+    def percentile(self, q: float) -> float:
+        """Upper bound of the q-th percentile of the absolute error, within a tenth of a decade."""
+        if not self.count:
+            return float("nan")
+        position = np.searchsorted(np.cumsum(self.histogram), q / 100 * self.count)
+        if position == 0:
+            return 0.0 if self.histogram[0] else 10.0 ** _LOG_ERROR_BINS[0]
+        return min(
+            10.0 ** _LOG_ERROR_BINS[min(position, len(_LOG_ERROR_BINS) - 1)], self.max
+        )
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max if self.count else float("nan"),
+            "sqnr": self.error.sqnr(),
+            "cosine": self.error.cosine(),
+            "mismatches": self.error.mismatches,
+        }
+
+
+def _as_numpy(batch) -> np.ndarray:
+    if isinstance(batch, (tuple, list)):
+        # (inputs, *targets) batches of a DataLoader
+        batch = batch[0]
+    if isinstance(batch, torch.Tensor):
+        batch = batch.detach().cpu().numpy()
+    return np.asarray(batch, dtype=np.float32)
+
+
+class ParityChecker:
+    def __init__(
+        self,
+        fp32_model_path,
+        int8_model_path,
+        torch_model: Optional[torch.nn.Module] = None,
+        intermediate_tensors: Union[bool, Sequence[str]] = False,
+        intra_op_num_threads: int = 0,
+    ):
+        """
+        Compares the PyTorch model, the fp32 ONNX model and the int8 ONNX model on the same batches.
+
+        The errors are accumulated per output and, optionally, per intermediate tensor of the fp32 model,
+        with `DriftStatistics`. Only the activations of the current batch are held in memory.
+
+        Example:
+        checker = ParityChecker(FP32_ONNX_MODEL_PATH, INT8_ONNX_MODEL_PATH, model, intermediate_tensors=True)
+        checker.run(valid_dataloader)
+        checker.print_report()
+        checker.find_drift_explosion()
+
+        Args:
+            fp32_model_path: Path to the fp32 ONNX model, preferably the preprocessed one which has the
+                shape information of the intermediate tensors.
+            int8_model_path: Path to the quantized ONNX model.
+            torch_model: The PyTorch model, its outputs must be in the order of the ONNX outputs.
+            intermediate_tensors: True to compare every float tensor of the fp32 model which still exists in
+                the int8 model, or the names of the tensors to compare.
+            intra_op_num_threads: Threads per operator of the ONNX Runtime sessions.
+        """
+        fp32_model = onnx.load(fp32_model_path)
+        if not len(fp32_model.graph.value_info):
+            fp32_model = onnx.shape_inference.infer_shapes(fp32_model)
+        self.index = GraphIndex.from_model(fp32_model)
+        self.output_names = [o.name for o in fp32_model.graph.output]
+        int8_model = onnx.load(int8_model_path)
+        int8_names = quantized_tensor_names(
+            GraphIndex.from_model(int8_model), self._float_tensors(fp32_model)
+        )
+
+        if intermediate_tensors is True:
+            intermediate_tensors = [
+                name for name in int8_names if name not in self.output_names
+            ]
+        self.intermediate_tensors = list(intermediate_tensors or [])
+        missing = set(self.intermediate_tensors) - set(int8_names)
+        if missing:
+            raise ValueError(f"Tensors not found in the int8 model: {sorted(missing)}")
+        self.tensor_names = self.output_names + self.intermediate_tensors
+        self.int8_names = [int8_names.get(n, n) for n in self.tensor_names]
+
+        self.fp32_session = create_cpu_session(
+            add_graph_outputs(fp32_model, self.intermediate_tensors),
+            intra_op_num_threads,
+        )
+        self.int8_session = create_cpu_session(
+            add_graph_outputs(int8_model, self.int8_names), intra_op_num_threads
+        )
+        self.input_name = self.fp32_session.get_inputs()[0].name
+        self.batchable = not isinstance(self.fp32_session.get_inputs()[0].shape[0], int)
+        self.torch_model = torch_model.eval() if torch_model is not None else None
+        self.statistics: Dict[tuple, DriftStatistics] = {}
+
+    @staticmethod
+    def _float_tensors(model: onnx.ModelProto) -> List[str]:
+        """Float tensors produced by the nodes, in node order."""
+        float_tensors = {
+            vi.name
+            for vi in list(model.graph.value_info) + list(model.graph.output)
+            if vi.type.tensor_type.elem_type == onnx.TensorProto.FLOAT
+        }
+        return [
+            name
+            for node in model.graph.node
+            for name in node.output
+            if name in float_tensors
+        ]
+
+    def _run_onnx(self, session, names, x: np.ndarray) -> List[np.ndarray]:
+        if self.batchable or len(x) == 1:
+            return session.run(names, {self.input_name: x})
+        # fixed batch size of 1, the samples run one by one
+        per_sample = [
+            session.run(names, {self.input_name: x[i : i + 1]}) for i in range(len(x))
+        ]
+        return [np.concatenate(outputs) for outputs in zip(*per_sample)]
+
+    def _update(self, pair, name, reference, actual):
+        key = pair + (name,)
+        if key not in self.statistics:
+            self.statistics[key] = DriftStatistics()
+        self.statistics[key].update(reference, actual)
+
+    def run(self, batches: Iterable):
+        """
+        Runs the models over preprocessed batches and accumulates the errors. Can be called several times.
+
+        Args:
+            batches: Iterable of input batches (N, C, H, W), numpy arrays, torch tensors or the
+                `(inputs, *targets)` batches of a DataLoader.
+        """
+        for batch in batches:
+            x = _as_numpy(batch)
+            fp32 = dict(
+                zip(
+                    self.tensor_names,
+                    self._run_onnx(self.fp32_session, self.tensor_names, x),
+                )
+            )
+            int8 = dict(
+                zip(
+                    self.tensor_names,
+                    self._run_onnx(self.int8_session, self.int8_names, x),
+                )
+            )
+            results = {"fp32": fp32, "int8": int8}
+            if self.torch_model is not None:
+                with torch.no_grad():
+                    outputs = self.torch_model(torch.from_numpy(x))
+                if isinstance(outputs, torch.Tensor):
+                    outputs = [outputs]
+                results["torch"] = {
+                    name: output.detach().cpu().numpy()
+                    for name, output in zip(self.output_names, outputs)
+                }
+
+            for name in self.tensor_names:
+                self._update(("fp32", "int8"), name, fp32[name], int8[name])
+            if "torch" in results:
+                for reference, actual in combinations(("torch", "fp32", "int8"), 2):
+                    if (reference, actual) == ("fp32", "int8"):
+                        continue
+                    for name in self.output_names:
+                        self._update(
+                            (reference, actual),
+                            name,
+                            results[reference][name],
+                            results[actual][name],
+                        )
+
+    def report(self) -> List[Dict]:
+        """
+        Returns one row per compared pair of models and tensor, with the `reference` and `actual` model, the
+        `tensor`, whether it is a graph `output`, and the `DriftStatistics.summary` values.
+        """
+        return [
+            {
+                "reference": reference,
+                "actual": actual,
+                "tensor": name,
+                "output": name in self.output_names,
+                **statistics.summary(),
+            }
+            for (reference, actual, name), statistics in self.statistics.items()
+        ]
+
+    def print_report(self, intermediate: bool = False):
+        """Prints the statistics of the outputs, and of the intermediate tensors if `intermediate` is True."""
+        print(
+            f"{'models':<14} {'tensor':<40} {'mean':>10} {'p50':>10} {'p99':>10} {'max':>10} "
+            f"{'sqnr dB':>8} {'cosine':>8}"
+        )
+        for row in self.report():
+            if not (row["output"] or intermediate):
+                continue
+            print(
+                f"{row['reference'] + '/' + row['actual']:<14} {row['tensor'][-40:]:<40} "
+                f"{row['mean']:>10.3g} {row['p50']:>10.3g} {row['p99']:>10.3g} {row['max']:>10.3g} "
+                f"{row['sqnr']:>8.1f} {row['cosine']:>8.4f}"
+            )
+
+    def find_drift_explosion(self, max_drop_db: float = 10.0) -> Optional[Dict]:
+        """
+        Finds the first tensor, in execution order, where the int8 error jumps.
+
+        The SQNR of the int8 model normally decreases slowly along the network as the quantization noise
+        accumulates. A tensor whose SQNR is more than `max_drop_db` below the lowest SQNR of the tensors
+        before it marks the layer where the drift explodes, e.g. an op with a badly calibrated range.
+        Tensors whose shape differed between the fp32 and the int8 model on some sample, e.g. the detections
+        after NMS, have no SQNR. They are skipped and listed separately.
+
+        Returns:
+            The `tensor`, its producing `node` and `op_type`, its `sqnr`, the `previous_sqnr` and the `drop`,
+            or None if the SQNR never drops by more than `max_drop_db`.
+        """
+        compared = sorted(
+            (
+                name
+                for name in self.tensor_names
+                if name in self.index.producer
+                and ("fp32", "int8", name) in self.statistics
+            ),
+            key=self.index.producer.get,
+        )
+        mismatched = [
+            name
+            for name in compared
+            if self.statistics["fp32", "int8", name].error.mismatches
+        ]
+        if mismatched:
+            print(
+                f"Skipped {len(mismatched)} tensors whose shape differs between fp32 and int8: "
+                f"{', '.join(mismatched)}"
+            )
+        lowest = float("inf")
+        for name in compared:
+            if name in mismatched:
+                continue
+            sqnr = self.statistics["fp32", "int8", name].error.sqnr()
+            if np.isfinite(lowest) and lowest - sqnr > max_drop_db:
+                node = self.index.producer.get(name)
+                explosion = {
+                    "tensor": name,
+                    "node": self.index.names[node] if node is not None else None,
+                    "op_type": self.index.op_types[node] if node is not None else None,
+                    "sqnr": sqnr,
+                    "previous_sqnr": lowest,
+                    "drop": lowest - sqnr,
+                }
+                print(
+                    f"Drift explodes at {explosion['node']} ({explosion['op_type']}): SQNR {sqnr:.1f} dB "
+                    f"after {lowest:.1f} dB, output {name}"
+                )
+                return explosion
+            lowest = min(lowest, sqnr)
+        print(f"No SQNR drop larger than {max_drop_db} dB")
+        return None
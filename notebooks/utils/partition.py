@@ -0,0 +1,311 @@
+from pathlib import Path
+from typing import Dict, List, Union
+
+import numpy as np
+import onnx
+from onnx.utils import Extractor
+from utils.benchmark import measure
+from utils.quantization import GraphIndex, sort_nodes_topologically
+from utils.runtime import create_cpu_session, random_feeds
+
+INT8 = "int8"
+FP32 = "fp32"
+
+
+def tensor_shapes(model: onnx.ModelProto) -> Dict[str, onnx.TypeProto]:
+    """
+    Collects the type of every tensor with known type information: graph inputs and outputs, value infos
+    and initializers.
+    """
+    graph = model.graph
+    types = {}
+    for vi in list(graph.input) + list(graph.value_info) + list(graph.output):
+        if vi.type.HasField("tensor_type"):
+            types[vi.name] = vi.type
+    for initializer in graph.initializer:
+        types[initializer.name] = onnx.helper.make_tensor_type_proto(
+            initializer.data_type, list(initializer.dims)
+        )
+    return types
+
+
+def tensor_dims(tensor_type: onnx.TypeProto) -> List[int]:
+    """Dimensions of a tensor type, symbolic or unknown dimensions (e.g. the batch) are counted as 1."""
+    return [
+        d.dim_value if d.HasField("dim_value") else 1
+        for d in tensor_type.tensor_type.shape.dim
+    ]
+
+
+def tensor_bytes(tensor_type: onnx.TypeProto) -> int:
+    """Size of a tensor in bytes, 0 if its type is unknown."""
+    elem_type = tensor_type.tensor_type.elem_type
+    if not elem_type or not tensor_type.tensor_type.HasField("shape"):
+        return 0
+    itemsize = onnx.helper.tensor_dtype_to_np_dtype(elem_type).itemsize
+    return int(np.prod(tensor_dims(tensor_type), dtype=np.int64)) * itemsize
+
+
+def node_macs(node: onnx.NodeProto, types: Dict[str, onnx.TypeProto]) -> int:
+    """
+    Estimates the multiply-accumulate operations of a Conv, ConvTranspose, Gemm or MatMul node.
+
+    Other nodes and nodes with unknown shapes count as 0.
+    """
+    if node.op_type not in ("Conv", "ConvTranspose", "Gemm", "MatMul"):
+        return 0
+    if any(
+        name not in types for name in (node.input[0], node.input[1], node.output[0])
+    ):
+        return 0
+    x = tensor_dims(types[node.input[0]])
+    w = tensor_dims(types[node.input[1]])
+    y = tensor_dims(types[node.output[0]])
+    if node.op_type == "Conv":
+        # W: (M, C/group, kH, kW)
+        return int(np.prod(y, dtype=np.int64) * np.prod(w[1:], dtype=np.int64))
+    if node.op_type == "ConvTranspose":
+        # W: (C, M/group, kH, kW)
+        return int(np.prod(x, dtype=np.int64) * np.prod(w[1:], dtype=np.int64))
+    if node.op_type == "Gemm":
+        trans_a = next((a.i for a in node.attribute if a.name == "transA"), 0)
+        k = x[0] if trans_a else x[-1]
+        return int(np.prod(y, dtype=np.int64)) * k
+    return int(np.prod(y, dtype=np.int64)) * x[-1]
+
+
+def classify_nodes(index: GraphIndex) -> List[str]:
+    """
+    Assigns every node of a QDQ model to the int8 or the fp32 side.
+
+    QuantizeLinear nodes are int8. A compute node is int8 if, like a QDQ node unit, its activation inputs
+    come from DequantizeLinear nodes, it has no float weights (excluded nodes keep theirs) and its outputs
+    only feed QuantizeLinear nodes. DequantizeLinear and Constant nodes, and nodes without activation inputs,
+    follow their consumers: they are int8 if any consumer is int8, so weights and the dequantization of
+    boundary tensors stay on the side that uses them.
+    """
+    producer = index.producer
+    consumers = index.consumers
+    constant_types = {i.name: i.data_type for i in index.graph.initializer}
+    for node_id in index.find("Constant"):
+        for attribute in index.nodes[node_id].attribute:
+            if attribute.name == "value":
+                constant_types[index.outputs[node_id][0]] = attribute.t.data_type
+    float_types = {
+        onnx.TensorProto.FLOAT,
+        onnx.TensorProto.FLOAT16,
+        onnx.TensorProto.BFLOAT16,
+        onnx.TensorProto.DOUBLE,
+    }
+
+    def is_quantized_node(node_id):
+        activations = 0
+        for tensor in index.inputs[node_id]:
+            if not tensor:
+                continue
+            if tensor in constant_types:
+                if constant_types[tensor] in float_types:
+                    return False
+            elif (
+                tensor in producer
+                and index.op_types[producer[tensor]] == "DequantizeLinear"
+            ):
+                activations += 1
+            else:
+                return False
+        return activations > 0 and all(
+            tensor not in index.graph_output_names
+            and all(
+                index.op_types[c] == "QuantizeLinear" for c in consumers.get(tensor, ())
+            )
+            for tensor in index.outputs[node_id]
+            if tensor
+        )
+
+    kinds = [None] * len(index)
+    for node_id, op_type in enumerate(index.op_types):
+        if op_type == "QuantizeLinear":
+            kinds[node_id] = INT8
+        elif op_type in ("DequantizeLinear", "Constant"):
+            continue
+        elif any(t and t not in constant_types for t in index.inputs[node_id]):
+            kinds[node_id] = INT8 if is_quantized_node(node_id) else FP32
+
+    # neutral nodes follow their consumers, which are later in the topologically sorted graph
+    for node_id in reversed(range(len(index))):
+        if kinds[node_id] is not None:
+            continue
+        successors = index.successors(node_id)
+        kinds[node_id] = (
+            INT8
+            if any(kinds[s] == INT8 for s in successors) or not successors
+            else FP32
+        )
+    return kinds
+
+
+def plan_partitions(model: Union[str, Path, onnx.ModelProto]) -> List[Dict]:
+    """
+    Partitions a quantized model into maximal contiguous int8 QDQ regions and fp32 regions.
+
+    The nodes are first reordered with `sort_nodes_topologically`, like before the sequential split of the
+    model, and consecutive nodes of the same kind (see `classify_nodes`) form a partition.
+
+    Args:
+        model: Path to the quantized ONNX model or the loaded model. A loaded model is reordered in place.
+
+    Returns:
+        One dictionary per partition with the keys
+        - `index`, `kind` ("int8" or "fp32"),
+        - `nodes`: names of the nodes,
+        - `macs`: estimated multiply-accumulate operations, see `node_macs`,
+        - `inputs`, `outputs`: boundary tensors mapped to their size in bytes. Initializers are not counted,
+          unknown dimensions are counted as 1.
+    """
+    if not isinstance(model, onnx.ModelProto):
+        model = onnx.load(model)
+    sort_nodes_topologically(model)
+    model = onnx.shape_inference.infer_shapes(model)
+    index = GraphIndex.from_model(model)
+    types = tensor_shapes(model)
+    kinds = classify_nodes(index)
+
+    partitions = []
+    for node_id, kind in enumerate(kinds):
+        if not partitions or partitions[-1]["kind"] != kind:
+            partitions.append({"index": len(partitions), "kind": kind, "node_ids": []})
+        partitions[-1]["node_ids"].append(node_id)
+
+    partition_of = {}
+    for partition in partitions:
+        for node_id in partition["node_ids"]:
+            partition_of[node_id] = partition["index"]
+
+    weights = index.initializer_names
+    for partition in partitions:
+        node_ids = partition["node_ids"]
+        produced = {t for node_id in node_ids for t in index.outputs[node_id] if t}
+        inputs = {}
+        outputs = {}
+        for node_id in node_ids:
+            for tensor in index.inputs[node_id]:
+                if tensor and tensor not in produced and tensor not in weights:
+                    inputs[tensor] = (
+                        tensor_bytes(types[tensor]) if tensor in types else 0
+                    )
+            for tensor in index.outputs[node_id]:
+                if not tensor:
+                    continue
+                leaves = tensor in index.graph_output_names or any(
+                    partition_of[c] != partition["index"]
+                    for c in index.consumers.get(tensor, ())
+                )
+                if leaves:
+                    outputs[tensor] = (
+                        tensor_bytes(types[tensor]) if tensor in types else 0
+                    )
+        partition.update(
+            nodes=[index.names[node_id] for node_id in node_ids],
+            macs=sum(node_macs(index.nodes[node_id], types) for node_id in node_ids),
+            inputs=inputs,
+            outputs=outputs,
+        )
+        del partition["node_ids"]
+    return partitions
+
+
+def find_fragmenting_exclusions(partitions: List[Dict]) -> List[Dict]:
+    """
+    Finds the fp32 partitions enclosed by int8 partitions.
+
+    Each of them, typically caused by nodes_to_exclude in the middle of the network, splits the int8 region
+    and adds a round trip between the int8 and the fp32 side.
+
+    Returns:
+        The enclosed fp32 partitions, with the additional key `transfer_bytes` holding the bytes moved
+        into and out of the partition.
+    """
+    fragmenting = []
+    for before, partition, after in zip(partitions, partitions[1:], partitions[2:]):
+        if partition["kind"] == FP32 and before["kind"] == after["kind"] == INT8:
+            fragmenting.append(
+                {
+                    **partition,
+                    "transfer_bytes": sum(partition["inputs"].values())
+                    + sum(partition["outputs"].values()),
+                }
+            )
+    return fragmenting
+
+
+def print_partition_plan(partitions: List[Dict]):
+    """Prints a summary of the partitions and warns about fp32 partitions fragmenting the int8 region."""
+    total_macs = sum(p["macs"] for p in partitions) or 1
+    print(
+        f"{'#':>3} {'kind':<5} {'nodes':>6} {'MMACs':>10} {'share':>6} {'in KiB':>9} {'out KiB':>9}"
+    )
+    for p in partitions:
+        print(
+            f"{p['index']:>3} {p['kind']:<5} {len(p['nodes']):>6} {p['macs'] / 1e6:>10.1f} "
+            f"{p['macs'] / total_macs:>6.1%} {sum(p['inputs'].values()) / 1024:>9.1f} "
+            f"{sum(p['outputs'].values()) / 1024:>9.1f}"
+        )
+    for p in find_fragmenting_exclusions(partitions):
+        print(
+            f"WARNING: fp32 partition {p['index']} ({', '.join(p['nodes'][:3])}"
+            f"{', ...' if len(p['nodes']) > 3 else ''}) splits the int8 region and moves "
+            f"{p['transfer_bytes'] / 1024:.1f} KiB across the boundary."
+        )
+
+
+def export_partitions(
+    model: Union[str, Path, onnx.ModelProto], partitions: List[Dict], output_dir
+) -> List[Path]:
+    """
+    Saves every partition as a standalone ONNX model named `partition_<index>_<kind>.onnx`.
+
+    Args:
+        model: Path to the quantized ONNX model or the loaded model the partitions were planned on.
+        partitions: Result of `plan_partitions`.
+        output_dir: Directory for the sub-models, it is created if needed.
+
+    Returns:
+        Paths of the sub-models in partition order.
+    """
+    if not isinstance(model, onnx.ModelProto):
+        model = onnx.load(model)
+    extractor = Extractor(onnx.shape_inference.infer_shapes(model))
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+    for partition in partitions:
+        sub_model = extractor.extract_model(
+            list(partition["inputs"]), list(partition["outputs"])
+        )
+        path = (
+            output_dir / f"partition_{partition['index']:02d}_{partition['kind']}.onnx"
+        )
+        onnx.save(sub_model, path)
+        paths.append(path)
+    return paths
+
+
+def benchmark_partitions(paths: List[Path], repeat: int = 20) -> List[Dict[str, float]]:
+    """
+    Measures the CPU latency of the partition sub-models with random inputs, see `random_feeds`.
+
+    Unknown input dimensions are set to 1. The models are run single threaded, so the numbers are
+    comparable between partitions.
+
+    Returns:
+        The timings of each sub-model, see `utils.benchmark.measure`.
+    """
+    timings = []
+    for path in paths:
+        session = create_cpu_session(path, intra_op_num_threads=1)
+        feeds = random_feeds(session)
+        timing = measure(lambda: session.run(None, feeds), repeat)
+        print(f"{path.name:<30} {timing['mean'] * 1000:>8.2f} ms")
+        timings.append(timing)
+    return timings
@@ -0,0 +1,280 @@
+import heapq
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+IMAGE_EXTENSIONS = (".bmp", ".jpeg", ".jpg", ".png", ".tif", ".tiff")
+
+# Marks the end of the stream in the queues between the stages.
+_STOP = object()
+
+
+class _Failure:
+    def __init__(self, stage: str, exception: Exception):
+        self.stage = stage
+        self.exception = exception
+
+
+def _run_in_pool(executor, fn, value):
+    return executor.submit(fn, value).result()
+
+
+def list_image_files(
+    directory, extensions: Sequence[str] = IMAGE_EXTENSIONS
+) -> List[Path]:
+    """Returns the image files of a directory, sorted by name."""
+    return sorted(
+        path
+        for path in Path(directory).iterdir()
+        if path.is_file() and path.suffix.lower() in extensions
+    )
+
+
+class Stage:
+    def __init__(
+        self, name: str, fn: Callable, workers: int = 1, use_processes: bool = False
+    ):
+        """
+        A step of a StreamingPipeline.
+
+        Args:
+            name: Name shown in the statistics.
+            fn: Callable applied to every item. It must be picklable if `use_processes` is True.
+            workers: Number of threads, or processes if `use_processes` is True, running the stage.
+            use_processes: Runs the stage in a process pool, for CPU bound Python code which holds the GIL.
+                Stages calling into OpenCV, NumPy or ONNX Runtime release the GIL and are fine with threads.
+        """
+        if workers < 1:
+            raise ValueError("A stage needs at least one worker.")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.use_processes = use_processes
+
+
+class StreamingPipeline:
+    def __init__(
+        self,
+        stages: Sequence[Stage],
+        queue_size: int = 8,
+        max_in_flight: Optional[int] = None,
+    ):
+        """
+        Runs items through stages connected by bounded queues, so that e.g. decoding, preprocessing,
+        inference and postprocessing of different images overlap.
+
+        The results are yielded in input order. At most `max_in_flight` items are between the source and the
+        consumer at any time, so a slow consumer or a slow stage stops the source instead of filling memory.
+
+        Example:
+        pipeline = StreamingPipeline(
+            [
+                Stage("decode", read_image_file, workers=2),
+                Stage("preprocess", lambda image: preprocess_img_yolox(ensure_3ch_image(image), IMAGE_SIZE)),
+                Stage("infer", lambda x: session.run(x[np.newaxis])),
+                Stage("postprocess", postprocess),
+            ]
+        )
+        for result in pipeline.run("images/"):
+            ...
+        pipeline.print_stats()
+
+        Args:
+            stages: The stages in processing order.
+            queue_size: Capacity of each queue between two stages.
+            max_in_flight: Maximum number of items in the pipeline. Defaults to the capacity of the queues
+                plus the number of workers.
+        """
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = list(stages)
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight or (
+            queue_size * len(self.stages) + sum(s.workers for s in self.stages)
+        )
+        self._init_stats()
+
+    def _init_stats(self):
+        self._stats = {
+            stage.name: {
+                "workers": stage.workers,
+                "items": 0,
+                "busy_s": 0.0,
+                "starved_s": 0.0,
+                "blocked_s": 0.0,
+            }
+            for stage in self.stages
+        }
+        self._stats_lock = threading.Lock()
+
+    def _worker(self, stage, call, in_queue, out_queue, next_workers, remaining):
+        busy = starved = blocked = 0.0
+        items = 0
+        while True:
+            start = time.perf_counter()
+            item = in_queue.get()
+            starved += time.perf_counter() - start
+            if item is _STOP:
+                break
+            sequence, value = item
+            if not isinstance(value, _Failure):
+                start = time.perf_counter()
+                try:
+                    value = call(value)
+                except Exception as exception:
+                    value = _Failure(stage.name, exception)
+                busy += time.perf_counter() - start
+                items += 1
+            start = time.perf_counter()
+            out_queue.put((sequence, value))
+            blocked += time.perf_counter() - start
+
+        with self._stats_lock:
+            stats = self._stats[stage.name]
+            stats["items"] += items
+            stats["busy_s"] += busy
+            stats["starved_s"] += starved
+            stats["blocked_s"] += blocked
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            # the last worker of a stage ends the stream of the next one
+            for _ in range(next_workers):
+                out_queue.put(_STOP)
+
+    def _feed(self, source, first_queue, first_workers, in_flight, cancelled):
+        sequence = 0
+        try:
+            for value in source:
+                in_flight.acquire()
+                if cancelled.is_set():
+                    break
+                first_queue.put((sequence, value))
+                sequence += 1
+        except Exception as exception:
+            in_flight.acquire()
+            first_queue.put((sequence, _Failure("source", exception)))
+        finally:
+            for _ in range(first_workers):
+                first_queue.put(_STOP)
+
+    def run(self, source: Union[Iterable, str, Path]) -> Iterator:
+        """
+        Runs the pipeline over a source and yields the results in input order.
+
+        Args:
+            source: Iterable of items, or a directory whose image files (see `list_image_files`) are the items.
+
+        Raises:
+            ValueError: If the source is a str or Path which is not a directory.
+            RuntimeError: If a stage raised an exception, the exception is chained.
+        """
+        if isinstance(source, (str, Path)):
+            if not Path(source).is_dir():
+                raise ValueError(f"The source {source} is not a directory.")
+            source = list_image_files(source)
+        self._init_stats()
+
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        # the consumer limits the items in flight, so the result queue does not need a bound
+        queues.append(queue.Queue())
+        in_flight = threading.Semaphore(self.max_in_flight)
+        cancelled = threading.Event()
+        executors = []
+        threads = [
+            threading.Thread(
+                target=self._feed,
+                args=(source, queues[0], self.stages[0].workers, in_flight, cancelled),
+                daemon=True,
+            )
+        ]
+        for stage_id, stage in enumerate(self.stages):
+            call = stage.fn
+            if stage.use_processes:
+                executor = ProcessPoolExecutor(max_workers=stage.workers)
+                executors.append(executor)
+                call = partial(_run_in_pool, executor, stage.fn)
+            next_workers = (
+                self.stages[stage_id + 1].workers
+                if stage_id + 1 < len(self.stages)
+                else 1
+            )
+            remaining = [stage.workers]
+            threads += [
+                threading.Thread(
+                    target=self._worker,
+                    args=(
+                        stage,
+                        call,
+                        queues[stage_id],
+                        queues[stage_id + 1],
+                        next_workers,
+                        remaining,
+                    ),
+                    daemon=True,
+                )
+                for _ in range(stage.workers)
+            ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        pending = []
+        next_sequence = 0
+        try:
+            while True:
+                item = queues[-1].get()
+                if item is _STOP:
+                    break
+                heapq.heappush(pending, item)
+                while pending and pending[0][0] == next_sequence:
+                    _, value = heapq.heappop(pending)
+                    next_sequence += 1
+                    in_flight.release()
+                    if isinstance(value, _Failure):
+                        raise RuntimeError(
+                            f"Stage {value.stage} failed on item {next_sequence - 1}"
+                        ) from value.exception
+                    yield value
+        finally:
+            cancelled.set()
+            # unblock the source if it waits for a free slot, the remaining items are dropped
+            in_flight.release()
+            for executor in executors:
+                executor.shutdown(wait=False, cancel_futures=True)
+            self._elapsed_s = time.perf_counter() - start
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Returns the statistics of the last run per stage: processed `items`, `busy_s` spent in the stage
+        function, `starved_s` waiting for input, `blocked_s` waiting for space in the next queue, summed over
+        the workers, and `utilization`, the busy share of the workers during the run.
+
+        The bottleneck is the stage with the highest utilization, the stages before it are blocked and the
+        stages after it are starved.
+        """
+        elapsed = getattr(self, "_elapsed_s", 0.0) or float("inf")
+        with self._stats_lock:
+            return {
+                name: {
+                    **stats,
+                    "utilization": stats["busy_s"] / (elapsed * stats["workers"]),
+                }
+                for name, stats in self._stats.items()
+            }
+
+    def print_stats(self):
+        """Prints the statistics of the last run, see `stats`."""
+        print(
+            f"{'stage':<15} {'workers':>7} {'items':>7} {'busy s':>8} {'starved s':>10} "
+            f"{'blocked s':>10} {'utilization':>12}"
+        )
+        for name, stats in self.stats().items():
+            print(
+                f"{name:<15} {stats['workers']:>7} {stats['items']:>7} {stats['busy_s']:>8.2f} "
+                f"{stats['starved_s']:>10.2f} {stats['blocked_s']:>10.2f} {stats['utilization']:>12.1%}"
+            )
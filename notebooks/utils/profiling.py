@@ -0,0 +1,323 @@
+import argparse
+import json
+import re
+import tempfile
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import onnx
+from utils.quantization import (
+    GraphIndex,
+    find_postprocess_nodes_to_exclude,
+    get_nodes_to_exclude,
+)
+from utils.runtime import (
+    create_session,
+    create_session_options,
+    load_session_config,
+    random_feeds,
+    read_univision_model,
+)
+
+# Kernel categories of the executed op types, the other op types are "compute".
+QDQ_OP_TYPES = {"QuantizeLinear", "DequantizeLinear", "DynamicQuantizeLinear"}
+LAYOUT_OP_TYPES = {"Transpose", "ReorderInput", "ReorderOutput"}
+NMS_OP_TYPES = {"NonMaxSuppression"}
+INTEGER_OP_TYPES = {"QGemm", "ConvInteger", "MatMulInteger", "DynamicQuantizeMatMul"}
+
+# suffix ORT appends to the names of the nodes it creates while optimizing the graph
+_TOKEN_SUFFIX = re.compile(r"_token_\d+$")
+
+
+def kernel_category(op_type: str) -> str:
+    if op_type in QDQ_OP_TYPES:
+        return "qdq"
+    if op_type in LAYOUT_OP_TYPES:
+        return "layout"
+    if op_type in NMS_OP_TYPES:
+        return "nms"
+    return "compute"
+
+
+def kernel_precision(op_type: str) -> str:
+    """Returns "int8" for the integer kernels of a quantized model, "qdq" for Q/DQ and "fp32" otherwise."""
+    if op_type in QDQ_OP_TYPES:
+        return "qdq"
+    if op_type.startswith("QLinear") or op_type in INTEGER_OP_TYPES:
+        return "int8"
+    return "fp32"
+
+
+def _original_node(
+    name: str, op_type: str, index: GraphIndex, node_ids: Dict[str, int]
+) -> Optional[int]:
+    """
+    Maps the name of a kernel of the optimized graph to the id of the node of the model it comes from.
+
+    Fused nodes keep the name of their main node, possibly with a `_token_<n>` suffix, NCHWc convolutions are
+    named after the output tensor of the fused activation, and unnamed nodes are named `<op type>_<node id>`.
+    Nodes which ORT inserted, e.g. layout conversions, map to None.
+    """
+    name = _TOKEN_SUFFIX.sub("", name)
+    if name in node_ids:
+        return node_ids[name]
+    if name.endswith("_nchwc") and name[: -len("_nchwc")] in index.producer:
+        node_id = index.producer[name[: -len("_nchwc")]]
+        # walk back from the fused activation to the convolution
+        candidate = node_id
+        for _ in range(3):
+            if index.op_types[candidate] == op_type:
+                return candidate
+            predecessors = index.predecessors(candidate)
+            if not predecessors:
+                break
+            candidate = predecessors[0]
+        return node_id
+    match = re.fullmatch(r"(\w+?)_(\d+)", name)
+    if match:
+        node_id = int(match.group(2))
+        if (
+            node_id < len(index)
+            and not index.names[node_id]
+            and index.op_types[node_id] == match.group(1)
+        ):
+            return node_id
+    return None
+
+
+class ModelProfile:
+    def __init__(self, name: str, nodes: List[Dict], runs: int):
+        """
+        Per-kernel timings of a model from the ONNX Runtime profiler, see `profile_model`.
+
+        Args:
+            name: Name of the model in the reports.
+            nodes: One row per kernel with the `kernel` name, the executed `op_type`, the `node` and
+                `node_op_type` of the model it comes from (None for nodes inserted by ORT), the `category`
+                ("compute", "qdq", "layout" or "nms"), the `precision` ("int8", "qdq" or "fp32"), whether
+                the node is `excluded` from quantization and in the `postprocess` region, and the `mean_us`
+                per run.
+            runs: Number of profiled runs.
+        """
+        self.name = name
+        self.nodes = nodes
+        self.runs = runs
+
+    @property
+    def total_us(self) -> float:
+        return sum(row["mean_us"] for row in self.nodes)
+
+    def table(self, key: str) -> List[Dict]:
+        """
+        Aggregates the kernel timings by a column, e.g. "op_type", "node_op_type", "category", "precision",
+        "excluded" or "postprocess".
+
+        Returns:
+            One row per value with the `count` of kernels, `mean_us` per run and `share` of the total, sorted
+            by decreasing time.
+        """
+        groups = defaultdict(lambda: {"count": 0, "mean_us": 0.0})
+        for row in self.nodes:
+            group = groups[row[key]]
+            group["count"] += 1
+            group["mean_us"] += row["mean_us"]
+        total = self.total_us or 1.0
+        return sorted(
+            (
+                {key: value, **group, "share": group["mean_us"] / total}
+                for value, group in groups.items()
+            ),
+            key=lambda row: -row["mean_us"],
+        )
+
+    def print_report(self, top: int = 20):
+        """Prints the time per op type, per region and the `top` slowest kernels."""
+        print(f"{self.name}: {self.total_us / 1000:.3f} ms in kernels per run")
+        print(f"{'op type':<28} {'kernels':>7} {'us/run':>10} {'share':>7}")
+        for row in self.table("op_type"):
+            print(
+                f"{row['op_type']:<28} {row['count']:>7} {row['mean_us']:>10.1f} {row['share']:>7.1%}"
+            )
+        print(f"{'region':<28} {'kernels':>7} {'us/run':>10} {'share':>7}")
+        for row in self.table("postprocess"):
+            region = "post-processing" if row["postprocess"] else "backbone and head"
+            print(
+                f"{region:<28} {row['count']:>7} {row['mean_us']:>10.1f} {row['share']:>7.1%}"
+            )
+        print(
+            f"{'kernel':<40} {'op type':<18} {'precision':<9} {'excluded':<8} {'post':<5} {'us/run':>10}"
+        )
+        for row in sorted(self.nodes, key=lambda row: -row["mean_us"])[:top]:
+            print(
+                f"{row['kernel'][-40:]:<40} {row['op_type']:<18} {row['precision']:<9} "
+                f"{str(row['excluded']):<8} {str(row['postprocess']):<5} {row['mean_us']:>10.1f}"
+            )
+
+
+def profile_model(
+    model_path,
+    x: Optional[np.ndarray] = None,
+    batch_size: int = 1,
+    repeat: int = 20,
+    warmup: int = 5,
+    nodes_to_exclude: Optional[Sequence[str]] = None,
+    zip_password: Optional[str] = None,
+) -> ModelProfile:
+    """
+    Profiles a model with the ONNX Runtime profiler and attributes the kernel time to the nodes of the model.
+
+    The session uses the configuration saved next to the model, if any, like `UnivisionSession`. The first
+    `warmup` runs are profiled but not counted.
+
+    Example:
+    fp32_profile = profile_model(FP32_ONNX_MODEL_PATH)
+    int8_profile = profile_model(INT8_ONNX_MODEL_PATH)
+    int8_profile.print_report()
+    print_profile_diff(fp32_profile, int8_profile)
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+        x: Representative batch. Defaults to random inputs of `batch_size` samples.
+        batch_size: Batch size of the random inputs.
+        repeat: Number of counted runs.
+        warmup: Number of runs before the counted ones.
+        nodes_to_exclude: Nodes excluded from quantization. Defaults to `find_postprocess_nodes_to_exclude`
+            for detection models and to `get_nodes_to_exclude` otherwise, as in the export notebooks.
+        zip_password: Password of an encrypted uniVision model.
+    """
+    model_bytes, _ = read_univision_model(model_path, zip_password)
+    index = GraphIndex.from_model(onnx.load_from_string(model_bytes))
+    postprocess = set(find_postprocess_nodes_to_exclude(index))
+    if nodes_to_exclude is None:
+        nodes_to_exclude = postprocess or get_nodes_to_exclude(index)
+    nodes_to_exclude = set(nodes_to_exclude)
+
+    sess_options = create_session_options(load_session_config(model_path))
+    sess_options.enable_profiling = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sess_options.profile_file_prefix = str(Path(tmp_dir) / "profile")
+        session = create_session(
+            model_bytes, sess_options, model_path=model_path, zip_password=zip_password
+        )
+        feeds = (
+            random_feeds(session, batch_size)
+            if x is None
+            else {session.get_inputs()[0].name: x}
+        )
+        for _ in range(warmup + repeat):
+            session.run(None, feeds)
+        with open(session.end_profiling()) as file:
+            events = json.load(file)
+
+    runs = sorted(
+        (event["ts"], event["ts"] + event["dur"])
+        for event in events
+        if event.get("cat") == "Session" and event["name"] == "model_run"
+    )[warmup:]
+    kernel_us = defaultdict(float)
+    op_types = {}
+    for event in events:
+        if event.get("cat") != "Node" or not event["name"].endswith("_kernel_time"):
+            continue
+        if any(start <= event["ts"] <= end for start, end in runs):
+            kernel = event["name"][: -len("_kernel_time")]
+            kernel_us[kernel] += event["dur"]
+            op_types[kernel] = event["args"].get("op_name", "")
+
+    node_ids = {name: node_id for node_id, name in enumerate(index.names) if name}
+    nodes = []
+    for kernel, duration in kernel_us.items():
+        op_type = op_types[kernel]
+        node_id = _original_node(kernel, op_type, index, node_ids)
+        node = index.names[node_id] if node_id is not None else None
+        nodes.append(
+            {
+                "kernel": kernel,
+                "op_type": op_type,
+                "node": node,
+                "node_op_type": (
+                    index.op_types[node_id] if node_id is not None else op_type
+                ),
+                "category": kernel_category(op_type),
+                "precision": kernel_precision(op_type),
+                "excluded": node in nodes_to_exclude,
+                "postprocess": node in postprocess,
+                "mean_us": duration / max(1, len(runs)),
+            }
+        )
+    return ModelProfile(Path(model_path).name, nodes, len(runs))
+
+
+def diff_profiles(
+    reference: ModelProfile, actual: ModelProfile, key: str = "node_op_type"
+) -> List[Dict]:
+    """
+    Compares the kernel time of two profiles of the same model, e.g. fp32 and int8, aggregated by a column
+    of `ModelProfile.nodes`. The default groups the kernels by the op type of the model node they come from,
+    so a QLinearConv of the int8 model is compared with the Conv of the fp32 model.
+
+    Returns:
+        One row per value with the `reference_us` and `actual_us` per run and their `delta_us`, sorted by
+        decreasing difference.
+    """
+    reference_us = {row[key]: row["mean_us"] for row in reference.table(key)}
+    actual_us = {row[key]: row["mean_us"] for row in actual.table(key)}
+    rows = [
+        {
+            key: value,
+            "reference_us": reference_us.get(value, 0.0),
+            "actual_us": actual_us.get(value, 0.0),
+            "delta_us": actual_us.get(value, 0.0) - reference_us.get(value, 0.0),
+        }
+        for value in dict.fromkeys(list(reference_us) + list(actual_us))
+    ]
+    return sorted(rows, key=lambda row: -abs(row["delta_us"]))
+
+
+def print_profile_diff(reference: ModelProfile, actual: ModelProfile):
+    """Prints the kernel time of two profiles side by side, per op type of the model and per region."""
+    print(
+        f"{reference.name} {reference.total_us / 1000:.3f} ms -> {actual.name} {actual.total_us / 1000:.3f} ms "
+        "in kernels per run"
+    )
+    for key, label in (
+        ("node_op_type", "op type"),
+        ("category", "category"),
+        ("postprocess", "post-processing"),
+    ):
+        print(
+            f"{label:<28} {reference.name[-10:]:>10} {actual.name[-10:]:>10} {'delta us':>10}"
+        )
+        for row in diff_profiles(reference, actual, key):
+            print(
+                f"{str(row[key]):<28} {row['reference_us']:>10.1f} {row['actual_us']:>10.1f} "
+                f"{row['delta_us']:>+10.1f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-operator latency profile of an ONNX or uniVision model."
+    )
+    parser.add_argument("model", help="Model to profile, e.g. the int8 model.")
+    parser.add_argument(
+        "--compare", help="Reference model to compare with, e.g. the fp32 model."
+    )
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    profile = profile_model(args.model, batch_size=args.batch_size, repeat=args.repeat)
+    profile.print_report(args.top)
+    if args.compare:
+        reference = profile_model(
+            args.compare, batch_size=args.batch_size, repeat=args.repeat
+        )
+        print_profile_diff(reference, profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,11 @@
+import gc
+import mmap
 import os
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import cached_property
 from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
 
 import onnx
 import onnxruntime
@@ -9,11 +15,14 @@ from onnxruntime.quantization.quantize import (
     CalibrationMethod,
     QuantFormat,
     QuantType,
-    quantize_static,
 )
-from onnxruntime.quantization.shape_inference import quant_pre_process
+from onnxruntime.quantization.quantize import quantize_static as _quantize_static
+from onnxruntime.quantization.shape_inference import (
+    quant_pre_process as _quant_pre_process,
+)
 from PIL import Image
 from torchvision import transforms
+from utils.tracing import span, traced
 
 
 class TorchCalibrationDataReader(CalibrationDataReader):
@@ -47,6 +56,316 @@ class TorchCalibrationDataReader(CalibrationDataReader):
         return output
 
 
+def quant_pre_process(*args, **kwargs):
+    """`onnxruntime.quantization.shape_inference.quant_pre_process`, traced as the span "quant pre-processing"."""
+    with span("quant pre-processing"):
+        return _quant_pre_process(*args, **kwargs)
+
+
+def quantize_static(*args, **kwargs):
+    """
+    `onnxruntime.quantization.quantize_static`, traced as the span "calibration and quantization", which
+    includes reading the calibration data.
+    """
+    with span("calibration and quantization"):
+        return _quantize_static(*args, **kwargs)
+
+
+# Field numbers of the ONNX protobuf messages, see onnx/onnx.proto.
+_MODEL_GRAPH_FIELD = 7
+_GRAPH_INITIALIZER_FIELD = 5
+# float_data, int32_data, string_data, int64_data, raw_data, double_data and uint64_data of TensorProto.
+_TENSOR_DATA_FIELDS = {4, 5, 6, 7, 9, 10, 11}
+# Smaller initializers such as scales, zero points and shapes are loaded with their data.
+_MIN_STRIPPED_TENSOR_BYTES = 1024
+# Smaller model files are parsed by onnx.load, which is faster than the pure Python walk of the fields.
+_MIN_STRIPPED_MODEL_BYTES = 2**26
+
+
+def _read_varint(buffer, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _encode_varint(value):
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _iter_proto_fields(buffer, start, end):
+    """Yields (field_number, field_start, value_start, field_end) of the serialized message buffer[start:end]."""
+    pos = start
+    while pos < end:
+        field_start = pos
+        key, pos = _read_varint(buffer, pos)
+        field_number, wire_type = key >> 3, key & 0x7
+        value_start = pos
+        if wire_type == 0:
+            _, pos = _read_varint(buffer, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, value_start = _read_varint(buffer, pos)
+            pos = value_start + length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}.")
+        yield field_number, field_start, value_start, pos
+
+
+def _length_delimited_field(field_number, payload):
+    return (
+        _encode_varint(field_number << 3 | 2) + _encode_varint(len(payload)) + payload
+    )
+
+
+def _strip_graph_weights(buffer, start, end):
+    fields = []
+    for field_number, field_start, value_start, field_end in _iter_proto_fields(
+        buffer, start, end
+    ):
+        if (
+            field_number == _GRAPH_INITIALIZER_FIELD
+            and field_end - value_start >= _MIN_STRIPPED_TENSOR_BYTES
+        ):
+            tensor = b"".join(
+                buffer[tensor_field_start:tensor_field_end]
+                for tensor_field, tensor_field_start, _, tensor_field_end in _iter_proto_fields(
+                    buffer, value_start, field_end
+                )
+                if tensor_field not in _TENSOR_DATA_FIELDS
+            )
+            fields.append(_length_delimited_field(_GRAPH_INITIALIZER_FIELD, tensor))
+        else:
+            fields.append(buffer[field_start:field_end])
+    return b"".join(fields)
+
+
+@traced()
+def load_model_without_weights(onnx_model_path) -> onnx.ModelProto:
+    """
+    Loads the structure of an ONNX model without reading the tensor data of its initializers.
+
+    Files of 64 MiB and more are memory mapped and the initializer payloads are skipped at the protobuf wire
+    level, so the memory use does not depend on the size of the weights. The initializers of the returned
+    model keep their name, data type and dims, external data references are kept as they are. Initializers
+    smaller than 1 KiB (scales, zero points, shapes), Constant node attributes and subgraphs are loaded
+    completely.
+
+    The walk over the fields runs in Python, its time grows with the number of nodes and initializers, while
+    onnx.load parses in C++ and its time grows with the file size. A QDQ graph of 100k nodes with small
+    initializers (6 MiB) takes 0.17 s to walk and 0.03 s to load, 320 MiB of weights in 8 initializers
+    0.05 s to walk and 0.4 s to load. Smaller files, including models with external data, are therefore
+    loaded with `onnx.load(..., load_external_data=False)` and keep their embedded initializer data.
+
+    Args:
+        onnx_model_path: Path to the ONNX model.
+
+    Returns:
+        The ONNX model, without the data of its large initializers if the file was walked. It is meant for
+        graph analysis only, it may not pass onnx.checker and may not run.
+    """
+    if os.path.getsize(onnx_model_path) < _MIN_STRIPPED_MODEL_BYTES:
+        return onnx.load(onnx_model_path, load_external_data=False)
+    with open(onnx_model_path, "rb") as file, mmap.mmap(
+        file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as buffer:
+        fields = []
+        for field_number, field_start, value_start, field_end in _iter_proto_fields(
+            buffer, 0, len(buffer)
+        ):
+            if field_number == _MODEL_GRAPH_FIELD:
+                graph = _strip_graph_weights(buffer, value_start, field_end)
+                fields.append(_length_delimited_field(_MODEL_GRAPH_FIELD, graph))
+            else:
+                fields.append(buffer[field_start:field_end])
+    return onnx.ModelProto.FromString(b"".join(fields))
+
+
+@contextmanager
+def _gc_paused():
+    """
+    Pauses the garbage collector, e.g. while building an index of a graph. The hundreds of thousands of lists
+    of a large graph trigger collections which scan every node of the graph, but cannot free anything.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class GraphIndex:
+    def __init__(self, graph: onnx.GraphProto):
+        """
+        Indexes the nodes of an ONNX graph for repeated graph analysis queries.
+
+        Nodes are identified by their position in `graph.node`, tensors by their name. Op types are indexed
+        on construction, the names and tensor indexes are built once on first use, traversals use deques.
+
+        Args:
+            graph: The ONNX graph to index. The index becomes stale if the graph is modified.
+        """
+        self.graph = graph
+        self.nodes = list(graph.node)
+        self.op_types = [node.op_type for node in self.nodes]
+
+        # op type -> node ids in graph order
+        self.nodes_by_op_type = defaultdict(list)
+        for node_id, op_type in enumerate(self.op_types):
+            self.nodes_by_op_type[op_type].append(node_id)
+
+    @cached_property
+    def names(self) -> List[str]:
+        return [node.name for node in self.nodes]
+
+    @cached_property
+    def inputs(self) -> List[List[str]]:
+        return [list(node.input) for node in self.nodes]
+
+    @cached_property
+    def outputs(self) -> List[List[str]]:
+        return [list(node.output) for node in self.nodes]
+
+    # The tensor indexes iterate the protobuf fields directly: copying the inputs and outputs of every node to
+    # Python lists first doubles the time of a cold query on a large graph.
+    @cached_property
+    def producer(self) -> Dict[str, int]:
+        """Maps a tensor name to the id of the node producing it."""
+        producer = {
+            tensor: node_id
+            for node_id, node in enumerate(self.nodes)
+            for tensor in node.output
+        }
+        producer.pop("", None)
+        return producer
+
+    @cached_property
+    def consumers(self) -> Dict[str, List[int]]:
+        """Maps a tensor name to the ids of the nodes consuming it, in graph order."""
+        consumers = defaultdict(list)
+        with _gc_paused():
+            for node_id, node in enumerate(self.nodes):
+                for tensor in node.input:
+                    consumers[tensor].append(node_id)
+        consumers.pop("", None)
+        return consumers
+
+    @cached_property
+    def graph_input_names(self) -> Set[str]:
+        return {i.name for i in self.graph.input}
+
+    @cached_property
+    def graph_output_names(self) -> Set[str]:
+        return {o.name for o in self.graph.output}
+
+    @cached_property
+    def initializer_names(self) -> Set[str]:
+        return {i.name for i in self.graph.initializer}
+
+    @classmethod
+    def from_model(cls, onnx_model: onnx.ModelProto) -> "GraphIndex":
+        return cls(onnx_model.graph)
+
+    @classmethod
+    def from_path(cls, onnx_model_path) -> "GraphIndex":
+        """Indexes an ONNX model file without loading its weights."""
+        return cls(load_model_without_weights(onnx_model_path).graph)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def find(self, op_type: str) -> List[int]:
+        """Returns the ids of all nodes with the given op type in graph order."""
+        return self.nodes_by_op_type.get(op_type, [])
+
+    def predecessors(self, node_id: int) -> List[int]:
+        """Returns the ids of the nodes producing the inputs of a node, in input order."""
+        producer = self.producer
+        return [
+            producer[tensor]
+            for tensor in self.nodes[node_id].input
+            if tensor in producer
+        ]
+
+    def successors(self, node_id: int) -> List[int]:
+        """Returns the ids of the nodes consuming the outputs of a node, in output order."""
+        consumers = self.consumers
+        return [
+            consumer
+            for tensor in self.nodes[node_id].output
+            for consumer in consumers.get(tensor, [])
+        ]
+
+    def _traverse(self, start_ids, neighbours, stop_op_types, visited):
+        queue = deque(start_ids)
+        order = []
+        while queue:
+            node_id = queue.popleft()
+            if node_id in visited:
+                continue
+            visited.add(node_id)
+            if self.op_types[node_id] in stop_op_types:
+                continue
+            order.append(node_id)
+            queue.extend(neighbours(node_id))
+        return order
+
+    def traverse_backward(
+        self,
+        start_ids: Iterable[int],
+        stop_op_types: Iterable[str] = (),
+        visited: Optional[Set[int]] = None,
+    ) -> List[int]:
+        """
+        Breadth-first search towards the graph inputs.
+
+        Args:
+            start_ids: Ids of the nodes to start from, they are part of the result.
+            stop_op_types: Nodes of these op types are marked as visited, but neither returned nor expanded.
+            visited: Optional set of already visited node ids. It is updated in place, so it can be shared
+                between several traversals.
+
+        Returns:
+            The ids of the reached nodes in visiting order.
+        """
+        return self._traverse(
+            start_ids,
+            self.predecessors,
+            set(stop_op_types),
+            set() if visited is None else visited,
+        )
+
+    def traverse_forward(
+        self,
+        start_ids: Iterable[int],
+        stop_op_types: Iterable[str] = (),
+        visited: Optional[Set[int]] = None,
+    ) -> List[int]:
+        """Breadth-first search towards the graph outputs, see `traverse_backward`."""
+        return self._traverse(
+            start_ids,
+            self.successors,
+            set(stop_op_types),
+            set() if visited is None else visited,
+        )
+
+
+@traced()
 def find_postprocess_nodes_to_exclude(onnx_model_path):
     """
     Auto-discover post-processing node names to exclude from quantization.
@@ -60,106 +379,62 @@ def find_postprocess_nodes_to_exclude(onnx_model_path):
     inputs, which is critical for correct NMS behavior.
 
     Args:
-        onnx_model_path: Path to the preprocessed fp32 ONNX model.
+        onnx_model_path: Path to the preprocessed fp32 ONNX model or its GraphIndex.
 
     Returns:
         List of node names to pass to quantize_static(nodes_to_exclude=...).
         Returns empty list if no NonMaxSuppression op is found.
     """
-    from collections import defaultdict
-
-    model = onnx.load(str(onnx_model_path))
-    nodes = list(model.graph.node)
-
-    # Map output tensor → producing node index
-    out_to_idx = {}
-    for i, node in enumerate(nodes):
-        for o in node.output:
-            out_to_idx[o] = i
-
-    # Map input tensor → consuming node indices
-    inp_to_nodes = defaultdict(list)
-    for i, node in enumerate(nodes):
-        for inp in node.input:
-            inp_to_nodes[inp].append(i)
-
-    # Find NMS node
-    nms_idx = None
-    for i, n in enumerate(nodes):
-        if n.op_type == "NonMaxSuppression":
-            nms_idx = i
-            break
-    if nms_idx is None:
-        return []
+    index = (
+        onnx_model_path
+        if isinstance(onnx_model_path, GraphIndex)
+        else GraphIndex.from_path(onnx_model_path)
+    )
 
-    visited = set()
-    exclude_names = []
+    nms_ids = index.find("NonMaxSuppression")
+    if not nms_ids:
+        return []
+    nms_id = nms_ids[0]
 
     # Include the NMS node itself
-    if nodes[nms_idx].name:
-        exclude_names.append(nodes[nms_idx].name)
-    visited.add(nms_idx)
+    visited = {nms_id}
+    excluded_ids = [nms_id]
 
     # BFS backward from NMS inputs, stop at Conv/Sigmoid boundaries
-    stop_types = {"Conv", "Sigmoid"}
-    queue = list(nodes[nms_idx].input)
-    while queue:
-        tensor = queue.pop(0)
-        if tensor not in out_to_idx:
-            continue
-        idx = out_to_idx[tensor]
-        if idx in visited:
-            continue
-        visited.add(idx)
-        node = nodes[idx]
-        if node.op_type in stop_types:
-            continue
-        if node.name:
-            exclude_names.append(node.name)
-        for inp in node.input:
-            queue.append(inp)
-
+    excluded_ids += index.traverse_backward(
+        index.predecessors(nms_id), stop_op_types={"Conv", "Sigmoid"}, visited=visited
+    )
     # BFS forward from NMS outputs (output-gathering nodes)
-    fwd_queue = []
-    for o in nodes[nms_idx].output:
-        for consumer_idx in inp_to_nodes.get(o, []):
-            fwd_queue.append(consumer_idx)
-    while fwd_queue:
-        idx = fwd_queue.pop(0)
-        if idx in visited:
-            continue
-        visited.add(idx)
-        node = nodes[idx]
-        if node.name:
-            exclude_names.append(node.name)
-        for o in node.output:
-            for consumer_idx in inp_to_nodes.get(o, []):
-                fwd_queue.append(consumer_idx)
-
-    return exclude_names
+    excluded_ids += index.traverse_forward(index.successors(nms_id), visited=visited)
 
+    return [index.names[i] for i in excluded_ids if index.names[i]]
 
+
+@traced()
 def get_nodes_to_exclude(onnx_model):
     """Finds the node names of first conv, softmax and last gemm.
     Excluding these nodes is a best practice for minimizing quantization degradation"""
 
-    all_nodes = onnx_model.graph.node
-    first_conv_name = next(
-        (node.name for node in all_nodes if node.op_type == "Conv"), None
+    index = (
+        onnx_model
+        if isinstance(onnx_model, GraphIndex)
+        else GraphIndex.from_model(onnx_model)
     )
-    gemm_nodes = [node.name for node in all_nodes if node.op_type == "Gemm"]
-    last_gemm_name = gemm_nodes[-1] if gemm_nodes else None
+    conv_ids = index.find("Conv")
+    gemm_ids = index.find("Gemm")
+    boundary_names = set()
+    if conv_ids:
+        boundary_names.add(index.names[conv_ids[0]])
+    if gemm_ids:
+        boundary_names.add(index.names[gemm_ids[-1]])
 
     nodes_to_exclude = [
-        node.name
-        for node in onnx_model.graph.node
-        if "Softmax" in node.name
-        or node.name == first_conv_name
-        or node.name == last_gemm_name
+        name for name in index.names if "Softmax" in name or name in boundary_names
     ]
     return nodes_to_exclude
 
 
+@traced()
 def sort_nodes_topologically(model: onnx.ModelProto):
     """Reorder graph nodes into "latest-possible" topological order.
 
@@ -182,55 +457,50 @@ def sort_nodes_topologically(model: onnx.ModelProto):
     Returns:
         the same model with graph.node reordered in-place.
     """
+    index = GraphIndex.from_model(model)
     graph = model.graph
 
-    # Map each output tensor to the node that produces it.
-    producer = {out: node for node in graph.node for out in node.output}
+    # Outputs that feed into graph outputs or are initializer-produced are
+    # treated as already "consumed".
+    external = (
+        index.graph_output_names | index.initializer_names | index.graph_input_names
+    )
 
-    # For each node, count how many of its outputs are consumed by other nodes
-    # (i.e. reverse out-degree).  Outputs that feed into graph outputs or are
-    # initializer-produced are treated as already "consumed".
-    graph_output_names = {o.name for o in graph.output}
-    initializer_names = {i.name for i in graph.initializer}
-    graph_input_names = {i.name for i in graph.input}
-    external = graph_output_names | initializer_names | graph_input_names
+    # consumers[node_id] = ids of the nodes reading any of this node's outputs
+    # (i.e. reverse out-degree).
+    consumers = [set() for _ in range(len(index))]
+    for node_id, inputs in enumerate(index.inputs):
+        for inp in inputs:
+            if inp not in external and inp in index.producer:
+                consumers[index.producer[inp]].add(node_id)
 
-    # pending[node_id] = number of this node's outputs still waiting to be scheduled.
+    # pending[node_id] = number of this node's consumers still waiting to be scheduled.
     # A node is "ready" (in reverse order) when pending reaches 0.
-    consumers: dict = {id(n): set() for n in graph.node}
-    for node in graph.node:
-        for inp in node.input:
-            if inp and inp not in external and inp in producer:
-                prod = producer[inp]
-                consumers[id(prod)].add(id(node))
+    pending = [len(c) for c in consumers]
 
     # Reverse Kahn's: start from nodes whose outputs are only consumed by external
     # sinks (i.e. graph outputs or nothing).
-    pending = {id(n): len(consumers[id(n)]) for n in graph.node}
-    node_by_id = {id(n): n for n in graph.node}
-
-    stack = [nid for nid, cnt in pending.items() if cnt == 0]
+    stack = [node_id for node_id, count in enumerate(pending) if count == 0]
     reverse_order = []
 
     while stack:
-        nid = stack.pop()
-        node = node_by_id[nid]
-        reverse_order.append(node)
-        seen_producers: set = set()
-        for inp in node.input:
-            if inp and inp not in external and inp in producer:
-                prod_id = id(producer[inp])
+        node_id = stack.pop()
+        reverse_order.append(node_id)
+        seen_producers = set()
+        for inp in index.inputs[node_id]:
+            if inp not in external and inp in index.producer:
+                prod_id = index.producer[inp]
                 if prod_id not in seen_producers:
                     seen_producers.add(prod_id)
                     pending[prod_id] -= 1
                     if pending[prod_id] == 0:
                         stack.append(prod_id)
 
-    if len(reverse_order) != len(graph.node):
+    if len(reverse_order) != len(index):
         raise RuntimeError(
             f"sort_nodes_topologically: only sorted {len(reverse_order)} of "
-            f"{len(graph.node)} nodes — the graph may contain a cycle."
+            f"{len(index)} nodes — the graph may contain a cycle."
         )
 
     del graph.node[:]
-    graph.node.extend(reversed(reverse_order))
+    graph.node.extend(index.nodes[node_id] for node_id in reversed(reverse_order))
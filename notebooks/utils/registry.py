@@ -0,0 +1,395 @@
+import argparse
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import pyzipper
+from ruamel.yaml import YAML
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    error TEXT,
+    encrypted INTEGER,
+    model_bytes INTEGER,
+    external_data_files INTEGER,
+    metadata_version TEXT,
+    model_uuid TEXT,
+    model_name TEXT,
+    creation_time TEXT,
+    quantization TEXT,
+    inference_device TEXT,
+    dataset_color_mode TEXT,
+    input_width INTEGER,
+    input_height INTEGER,
+    input_channels INTEGER,
+    channel_order TEXT,
+    color_space TEXT,
+    resize_mode TEXT,
+    unit_scaling INTEGER,
+    metadata TEXT
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT NOT NULL REFERENCES models(path) ON DELETE CASCADE,
+    output_index INTEGER NOT NULL,
+    type TEXT,
+    num_classes INTEGER
+);
+CREATE TABLE IF NOT EXISTS classes (
+    path TEXT NOT NULL REFERENCES models(path) ON DELETE CASCADE,
+    output_index INTEGER NOT NULL,
+    class_index INTEGER NOT NULL,
+    uuid TEXT,
+    name TEXT,
+    default_threshold REAL
+);
+CREATE INDEX IF NOT EXISTS outputs_path ON outputs(path);
+CREATE INDEX IF NOT EXISTS classes_path ON classes(path);
+CREATE INDEX IF NOT EXISTS classes_name ON classes(name);
+"""
+
+_MODEL_COLUMNS = (
+    "path",
+    "mtime_ns",
+    "size",
+    "error",
+    "encrypted",
+    "model_bytes",
+    "external_data_files",
+    "metadata_version",
+    "model_uuid",
+    "model_name",
+    "creation_time",
+    "quantization",
+    "inference_device",
+    "dataset_color_mode",
+    "input_width",
+    "input_height",
+    "input_channels",
+    "channel_order",
+    "color_space",
+    "resize_mode",
+    "unit_scaling",
+    "metadata",
+)
+
+# members of a uniVision model which are not external data of the ONNX model
+_KNOWN_MEMBERS = {"model.yaml", "model.onnx", "input_example.png"}
+
+
+def read_registry_entry(
+    path: str, mtime_ns: int, size: int, zip_password: Optional[str] = None
+) -> Dict:
+    """
+    Reads the index entry of a uniVision model: the sizes of its members from the central directory of the
+    archive and the metadata from model.yaml. The ONNX model is not read.
+
+    Returns:
+        Dictionary with the `model` row, and the `outputs` and `classes` rows. Unreadable models get a row
+        with the `error`, so they are only read again once they change.
+    """
+    row = {"path": path, "mtime_ns": mtime_ns, "size": size}
+    entry = {"model": row, "outputs": [], "classes": []}
+    try:
+        with pyzipper.AESZipFile(path) as archive:
+            infos = {info.filename: info for info in archive.infolist()}
+            if "model.yaml" not in infos or "model.onnx" not in infos:
+                raise ValueError("model.yaml or model.onnx is missing.")
+            row["encrypted"] = bool(infos["model.yaml"].flag_bits & 0x1)
+            row["model_bytes"] = infos["model.onnx"].file_size
+            row["external_data_files"] = len(set(infos) - _KNOWN_MEMBERS)
+            if row["encrypted"]:
+                if zip_password is None:
+                    raise ValueError("The model is encrypted.")
+                archive.setpassword(zip_password.encode())
+            metadata = YAML(typ="safe").load(archive.read("model.yaml"))
+    except Exception as error:
+        row["error"] = f"{type(error).__name__}: {error}"
+        return entry
+
+    model_input = metadata.get("input", {})
+    row.update(
+        {
+            "metadata_version": metadata.get("metadata_version"),
+            "model_uuid": metadata.get("model_uuid"),
+            "model_name": metadata.get("model_name"),
+            "creation_time": metadata.get("creation_time"),
+            "quantization": metadata.get("quantization"),
+            "inference_device": metadata.get("inference_device"),
+            "dataset_color_mode": metadata.get("dataset_color_mode"),
+            "input_width": model_input.get("width"),
+            "input_height": model_input.get("height"),
+            "input_channels": model_input.get("channels"),
+            "channel_order": model_input.get("channel_order"),
+            "color_space": model_input.get("color_space"),
+            "resize_mode": model_input.get("resize", {}).get("mode"),
+            "unit_scaling": model_input.get("unit_scaling"),
+            "metadata": json.dumps(metadata, default=str),
+        }
+    )
+    for output_index, output in enumerate(metadata.get("outputs", [])):
+        classes = output.get("classes", [])
+        entry["outputs"].append((path, output_index, output.get("type"), len(classes)))
+        for class_index, c in enumerate(classes):
+            entry["classes"].append(
+                (
+                    path,
+                    output_index,
+                    class_index,
+                    c.get("uuid"),
+                    c.get("name"),
+                    c.get("default_threshold"),
+                )
+            )
+    return entry
+
+
+def _read_entries(files: List[tuple], zip_password: Optional[str]) -> List[Dict]:
+    return [read_registry_entry(*file, zip_password) for file in files]
+
+
+class ModelRegistry:
+    def __init__(self, index_path):
+        """
+        Queryable index of the metadata of uniVision models (.u3o), e.g. of the exports on a shared volume, in
+        an SQLite database.
+
+        The table `models` has one row per file with the model.yaml fields, the input fields prefixed with
+        `input_`, and the full metadata as JSON. The tables `outputs` and `classes` have one row per output and
+        per class of an output.
+
+        Example:
+        registry = ModelRegistry("models.sqlite")
+        registry.refresh(["/mnt/models"])
+        for model in registry.find(
+            output_type="OBJECT_DETECTION", class_name="screw", quantization="INT8", width=416, height=416
+        ):
+            print(model["path"])
+
+        Args:
+            index_path: Path to the SQLite database, created if it does not exist.
+        """
+        self.index_path = Path(index_path)
+        self.connection = sqlite3.connect(self.index_path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def refresh(
+        self,
+        roots: Sequence,
+        num_workers: Optional[int] = None,
+        zip_password: Optional[str] = None,
+        chunk_size: int = 64,
+    ) -> Dict[str, int]:
+        """
+        Updates the index with the uniVision models under the root folders. Only new models and models whose
+        modification time or size changed are read, in parallel processes. Models which no longer exist under
+        the roots are removed from the index.
+
+        Args:
+            roots: Folders searched recursively for .u3o files, or .u3o files.
+            num_workers: Number of processes reading the models. Defaults to the number of CPUs.
+            zip_password: Password of encrypted models. Encrypted models are indexed with an error without it.
+            chunk_size: Number of models read by a process at once.
+
+        Returns:
+            Dictionary with the number of `added`, `updated`, `removed` and `unchanged` models, and of the read
+            models with `errors`.
+        """
+        roots = [Path(root).resolve() for root in roots]
+        files = {}
+        for root in roots:
+            paths = [root] if root.is_file() else root.rglob("*.u3o")
+            for path in paths:
+                stat = path.stat()
+                files[str(path)] = (stat.st_mtime_ns, stat.st_size)
+
+        indexed = {
+            row["path"]: (row["mtime_ns"], row["size"])
+            for row in self.connection.execute(
+                "SELECT path, mtime_ns, size FROM models"
+            )
+        }
+        changed = [
+            (path, *signature)
+            for path, signature in files.items()
+            if indexed.get(path) != signature
+        ]
+        removed = [
+            path
+            for path in indexed
+            if path not in files
+            and any(
+                path == str(root) or path.startswith(str(root) + os.sep)
+                for root in roots
+            )
+        ]
+
+        chunks = [
+            changed[i : i + chunk_size] for i in range(0, len(changed), chunk_size)
+        ]
+        entries = []
+        if len(chunks) > 1:
+            with ProcessPoolExecutor(num_workers) as executor:
+                for chunk_entries in executor.map(
+                    _read_entries, chunks, [zip_password] * len(chunks)
+                ):
+                    entries.extend(chunk_entries)
+        elif chunks:
+            entries = _read_entries(chunks[0], zip_password)
+
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM models WHERE path = ?",
+                [(path,) for path in removed + [path for path, *_ in changed]],
+            )
+            self.connection.executemany(
+                f"INSERT INTO models ({', '.join(_MODEL_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(_MODEL_COLUMNS))})",
+                [
+                    tuple(entry["model"].get(column) for column in _MODEL_COLUMNS)
+                    for entry in entries
+                ],
+            )
+            self.connection.executemany(
+                "INSERT INTO outputs VALUES (?, ?, ?, ?)",
+                [row for entry in entries for row in entry["outputs"]],
+            )
+            self.connection.executemany(
+                "INSERT INTO classes VALUES (?, ?, ?, ?, ?, ?)",
+                [row for entry in entries for row in entry["classes"]],
+            )
+
+        stats = {
+            "added": sum(path not in indexed for path, *_ in changed),
+            "updated": sum(path in indexed for path, *_ in changed),
+            "removed": len(removed),
+            "unchanged": len(files) - len(changed),
+            "errors": sum("error" in entry["model"] for entry in entries),
+        }
+        print(
+            f"Indexed {len(files)} models: {stats['added']} added, {stats['updated']} updated, "
+            f"{stats['removed']} removed, {stats['unchanged']} unchanged, {stats['errors']} errors"
+        )
+        return stats
+
+    def query(self, sql: str, parameters: Sequence = ()) -> List[Dict]:
+        """Runs an SQL query on the index and returns the rows as dictionaries."""
+        return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def find(
+        self,
+        output_type: Optional[str] = None,
+        class_name: Optional[str] = None,
+        quantization: Optional[str] = None,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        model_name: Optional[str] = None,
+    ) -> List[Dict]:
+        """
+        Finds the models matching all the given criteria.
+
+        Args:
+            output_type: Type of an output, e.g. "OBJECT_DETECTION".
+            class_name: Name of a class of that output.
+            quantization: "INT8" or "FLOAT16". "NONE" finds the models without quantization.
+            width: Input width.
+            height: Input height.
+            model_name: Pattern of the model name, with the SQL LIKE wildcards % and _.
+
+        Returns:
+            The matching rows of the `models` table, without the full metadata, sorted by path.
+        """
+        conditions = ["m.error IS NULL"]
+        parameters = []
+        if output_type is not None or class_name is not None:
+            output = ["o.path = m.path"]
+            if output_type is not None:
+                output.append("o.type = ?")
+                parameters.append(str(output_type))
+            if class_name is not None:
+                output.append(
+                    "EXISTS (SELECT 1 FROM classes c WHERE c.path = o.path "
+                    "AND c.output_index = o.output_index AND c.name = ?)"
+                )
+                parameters.append(class_name)
+            conditions.append(
+                f"EXISTS (SELECT 1 FROM outputs o WHERE {' AND '.join(output)})"
+            )
+        if quantization is not None:
+            if str(quantization) == "NONE":
+                conditions.append("m.quantization IS NULL")
+            else:
+                conditions.append("m.quantization = ?")
+                parameters.append(str(quantization))
+        for column, value in (
+            ("m.input_width", width),
+            ("m.input_height", height),
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        if model_name is not None:
+            conditions.append("m.model_name LIKE ?")
+            parameters.append(model_name)
+        columns = ", ".join(f"m.{c}" for c in _MODEL_COLUMNS if c != "metadata")
+        return self.query(
+            f"SELECT {columns} FROM models m WHERE {' AND '.join(conditions)} ORDER BY m.path",
+            parameters,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index the metadata of uniVision models and search it."
+    )
+    parser.add_argument("index", help="SQLite database of the index.")
+    parser.add_argument(
+        "--refresh", nargs="+", default=[], help="Folders or .u3o files to index."
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--zip-password", default=None)
+    parser.add_argument("--output-type", default=None)
+    parser.add_argument("--class-name", default=None)
+    parser.add_argument("--quantization", default=None)
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--model-name", default=None)
+    args = parser.parse_args()
+
+    with ModelRegistry(args.index) as registry:
+        if args.refresh:
+            registry.refresh(args.refresh, args.workers, args.zip_password)
+        models = registry.find(
+            args.output_type,
+            args.class_name,
+            args.quantization,
+            args.width,
+            args.height,
+            args.model_name,
+        )
+        for model in models:
+            print(
+                f"{model['path']}  {model['quantization'] or '-'}  "
+                f"{model['input_width']}x{model['input_height']}  {model['model_name'] or ''}"
+            )
+        print(f"{len(models)} models")
+
+
+if __name__ == "__main__":
+    main()
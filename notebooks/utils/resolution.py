@@ -0,0 +1,278 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import onnx
+from utils.benchmark import measure
+from utils.cost import LatencyModel, analyze_model, with_input_shapes
+from utils.enums import (
+    ResizeImageAlignmentHorizontal,
+    ResizeImageAlignmentVertical,
+    ResizeMode,
+)
+from utils.image import get_image_size
+from utils.quantization import load_model_without_weights
+from utils.runtime import create_cpu_session
+
+# Aspect distortion of STRETCH, as a relative change of the aspect ratio, up to which the images are
+# stretched instead of padded.
+MAX_STRETCH_DISTORTION = 0.05
+
+
+def image_size_statistics(image_paths: Sequence, num_workers: int = 8) -> np.ndarray:
+    """
+    Reads the sizes of images from their headers and prints their distribution.
+
+    Returns:
+        Array (N, 2) of the (height, width) of the images.
+    """
+    with ThreadPoolExecutor(num_workers) as executor:
+        sizes = np.array(list(executor.map(get_image_size, map(str, image_paths))))
+    aspects = sizes[:, 1] / sizes[:, 0]
+    print(f"{len(sizes)} images")
+    for name, values in (
+        ("height", sizes[:, 0]),
+        ("width", sizes[:, 1]),
+        ("aspect", aspects),
+    ):
+        low, median, high = np.percentile(values, [5, 50, 95])
+        print(
+            f"{name:<7} min {values.min():.4g}, 5% {low:.4g}, median {median:.4g}, 95% {high:.4g}, "
+            f"max {values.max():.4g}"
+        )
+    return sizes
+
+
+def candidate_shapes(
+    sizes: np.ndarray,
+    max_dimensions: Sequence[int] = (224, 256, 320, 416, 512, 640),
+    stride: int = 32,
+) -> List[Tuple[int, int]]:
+    """
+    Proposes input shapes (height, width) divisible by `stride`: for every maximum dimension a square shape
+    and the shapes with the minimal padding for the median aspect ratio and for the aspect ratio of the
+    largest image, like `get_image_size_with_minimal_padding` of the detection notebook.
+    """
+    aspects = sizes[:, 1] / sizes[:, 0]
+    largest = np.argmax(sizes[:, 0] * sizes[:, 1])
+    shapes = []
+    for max_dimension in max_dimensions:
+        if max_dimension % stride:
+            raise ValueError(
+                f"Max dimension {max_dimension} must be divisible by {stride}."
+            )
+        for aspect in (1.0, float(np.median(aspects)), float(aspects[largest])):
+            if aspect >= 1:
+                shape = (
+                    math.ceil(max_dimension / aspect / stride) * stride,
+                    max_dimension,
+                )
+            else:
+                shape = (
+                    max_dimension,
+                    math.ceil(max_dimension * aspect / stride) * stride,
+                )
+            if shape not in shapes:
+                shapes.append(shape)
+    return shapes
+
+
+def shape_statistics(sizes: np.ndarray, shape: Tuple[int, int]) -> Dict[str, float]:
+    """
+    Describes how the images of a dataset fit into an input shape.
+
+    Returns:
+        Dictionary with the `padding_waste`, the mean share of the input covered by padding with
+        FIT_WITH_PADDING, the `median_scale` of the images with FIT_WITH_PADDING, the `stretch_distortion`,
+        the 90th percentile of the relative aspect ratio change with STRETCH, and the `effective_pixels`,
+        the mean number of input pixels carrying image detail (padding and upscaling do not count).
+    """
+    height, width = shape
+    scales = np.minimum(height / sizes[:, 0], width / sizes[:, 1])
+    content = sizes[:, 0] * sizes[:, 1] * scales**2
+    aspects = sizes[:, 1] / sizes[:, 0]
+    return {
+        "padding_waste": float(1 - np.mean(content / (height * width))),
+        "median_scale": float(np.median(scales)),
+        "stretch_distortion": float(
+            np.percentile(np.abs(np.log((width / height) / aspects)), 90)
+        ),
+        "effective_pixels": float(
+            np.mean(np.minimum(content, sizes[:, 0] * sizes[:, 1]))
+        ),
+    }
+
+
+def _measure_at_shape(
+    model: onnx.ModelProto,
+    input_name: str,
+    shape,
+    repeat: int,
+    intra_op_num_threads: int,
+) -> Optional[float]:
+    try:
+        resized = with_input_shapes(model, {input_name: shape})
+        session = create_cpu_session(resized, intra_op_num_threads)
+        x = np.random.default_rng(0).random(shape, dtype=np.float32)
+        return (
+            1000 * measure(lambda: session.run(None, {input_name: x}), repeat, 2)["min"]
+        )
+    except Exception as error:
+        # models with shape-dependent constants, e.g. the YOLOX post-processing, only run at their size
+        print(f"Could not run the model at {shape[2:]}: {str(error).splitlines()[0]}")
+        return None
+
+
+def plan_input_resolution(
+    sizes: np.ndarray,
+    model_path=None,
+    latency_budget_ms: Optional[float] = None,
+    latency_model: Optional[LatencyModel] = None,
+    measure_latency: bool = False,
+    shapes: Optional[Sequence[Tuple[int, int]]] = None,
+    letterbox: bool = False,
+    repeat: int = 10,
+    intra_op_num_threads: Optional[int] = None,
+) -> Dict:
+    """
+    Evaluates candidate input shapes for a dataset and recommends the shape and resize settings for the
+    export.
+
+    Every shape is described by `shape_statistics`, and with a model by its MACs at that shape, see
+    `utils.cost.analyze_model`, the latency predicted by `latency_model` and, with `measure_latency`, the
+    measured latency of the model run at that shape. The recommended shape is the one with the most
+    effective pixels, i.e. image detail, whose latency (measured if available, else predicted) is within
+    the budget. Its resize mode is STRETCH if stretching changes the aspect ratio of 90% of the images by
+    at most `MAX_STRETCH_DISTORTION`, FIT_WITH_PADDING otherwise.
+
+    Example:
+    sizes = image_size_statistics(list_image_files(TRAIN_IMAGE_FOLDER))
+    plan = plan_input_resolution(
+        sizes, FP32_ONNX_MODEL_PATH, latency_budget_ms=30, latency_model=LatencyModel.calibrate(REFERENCE_MODELS)
+    )
+    AI_INPUT_IMAGE_SIZE = plan["image_size"]
+
+    Args:
+        sizes: (height, width) of the dataset images, see `image_size_statistics`.
+        model_path: ONNX model with a (N, C, H, W) input, e.g. the fp32 export at any size.
+        latency_budget_ms: Maximum latency of a shape.
+        latency_model: Latency model of the target CPU, see `utils.cost.LatencyModel.calibrate`.
+        measure_latency: Whether to run the model at every shape, which only works for fully convolutional
+            models.
+        shapes: Candidate shapes (height, width). Defaults to `candidate_shapes`.
+        letterbox: Whether the model is trained on images padded at the bottom and right, like YOLOX in
+            mmdetection. The padding alignment is then LEFT/TOP, otherwise CENTER/CENTER.
+        repeat: Number of measured runs per shape.
+        intra_op_num_threads: Threads of the measured runs. Defaults to the threads of `latency_model`, so
+            that the measured and predicted latencies compare, else 1.
+
+    Returns:
+        Dictionary with the recommended `image_size` (height, width), `resize_mode`, `alignment_horizontal`
+        and `alignment_vertical` (None for STRETCH), and the `candidates` with their numbers.
+    """
+    shapes = list(shapes or candidate_shapes(sizes))
+    if intra_op_num_threads is None:
+        intra_op_num_threads = (
+            latency_model.intra_op_num_threads if latency_model is not None else 1
+        )
+    model = input_name = channels = None
+    if model_path is not None:
+        model = load_model_without_weights(model_path)
+        graph_input = model.graph.input[0]
+        input_name = graph_input.name
+        channels = graph_input.type.tensor_type.shape.dim[1].dim_value or 3
+        if measure_latency:
+            model = onnx.load(model_path)
+
+    candidates = []
+    for shape in shapes:
+        candidate = {"image_size": tuple(shape), **shape_statistics(sizes, shape)}
+        if model is not None:
+            input_shape = [1, channels, *shape]
+            cost = analyze_model(model, {input_name: input_shape})
+            candidate["macs"] = cost.totals()["macs"]
+            if latency_model is not None:
+                candidate["predicted_ms"] = latency_model.predict(cost)
+            if measure_latency:
+                candidate["measured_ms"] = _measure_at_shape(
+                    model, input_name, input_shape, repeat, intra_op_num_threads
+                )
+        latency = candidate.get("measured_ms")
+        if latency is None:
+            latency = candidate.get("predicted_ms")
+        candidate["latency_ms"] = latency
+        candidates.append(candidate)
+
+    if latency_budget_ms is not None and all(
+        c["latency_ms"] is None for c in candidates
+    ):
+        print("No latency model and no measurement, the latency budget is ignored.")
+    feasible = [
+        c
+        for c in candidates
+        if latency_budget_ms is None
+        or c["latency_ms"] is None
+        or c["latency_ms"] <= latency_budget_ms
+    ]
+    if not feasible:
+        print(f"No shape meets {latency_budget_ms} ms, recommending the fastest one.")
+        feasible = [min(candidates, key=lambda c: c["latency_ms"])]
+    best = max(
+        feasible,
+        key=lambda c: (c["effective_pixels"], -(c["latency_ms"] or 0.0)),
+    )
+
+    stretch = best["stretch_distortion"] <= math.log1p(MAX_STRETCH_DISTORTION)
+    plan = {
+        "image_size": best["image_size"],
+        "resize_mode": ResizeMode.STRETCH if stretch else ResizeMode.FIT_WITH_PADDING,
+        "alignment_horizontal": (
+            None
+            if stretch
+            else (
+                ResizeImageAlignmentHorizontal.LEFT
+                if letterbox
+                else ResizeImageAlignmentHorizontal.CENTER
+            )
+        ),
+        "alignment_vertical": (
+            None
+            if stretch
+            else (
+                ResizeImageAlignmentVertical.TOP
+                if letterbox
+                else ResizeImageAlignmentVertical.CENTER
+            )
+        ),
+        "candidates": candidates,
+    }
+    _print_plan(plan, latency_budget_ms)
+    return plan
+
+
+def _print_plan(plan: Dict, latency_budget_ms: Optional[float]):
+    def optional(value, spec):
+        return format(value, spec) if value is not None else "-"
+
+    print(
+        f"{'size (h, w)':<12} {'padding':>8} {'scale':>6} {'stretch':>8} {'eff. Mpx':>9} {'GMACs':>8} "
+        f"{'pred. ms':>9} {'meas. ms':>9}"
+    )
+    for c in plan["candidates"]:
+        marker = "*" if c["image_size"] == plan["image_size"] else " "
+        print(
+            f"{marker}{str(c['image_size']):<11} {c['padding_waste']:>8.1%} {c['median_scale']:>6.2f} "
+            f"{math.expm1(c['stretch_distortion']):>8.1%} {c['effective_pixels'] / 1e6:>9.3f} "
+            f"{optional(c.get('macs') and c['macs'] / 1e9, '>8.3f'):>8} "
+            f"{optional(c.get('predicted_ms'), '>9.2f'):>9} {optional(c.get('measured_ms'), '>9.2f'):>9}"
+        )
+    print(
+        f"Recommended: image size {plan['image_size']}, resize mode {plan['resize_mode']}"
+        + (
+            f", alignment {plan['alignment_horizontal']}/{plan['alignment_vertical']}"
+            if plan["alignment_horizontal"] is not None
+            else ""
+        )
+        + (f", latency budget {latency_budget_ms} ms" if latency_budget_ms else "")
+    )
@@ -0,0 +1,535 @@
+import hashlib
+import json
+import queue
+import threading
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import onnx
+import onnxruntime
+import pyzipper
+from onnx import numpy_helper
+from ruamel.yaml import YAML
+
+# Sessions shared by all UnivisionSession objects, keyed by (model hash, external data, providers, session
+# config).
+_session_cache: Dict[Tuple, onnxruntime.InferenceSession] = {}
+_session_cache_lock = threading.Lock()
+
+# Protobuf limit of a serialized model.
+MAX_SERIALIZED_MODEL_SIZE = 2**31 - 1
+# Initializers of models over the limit which are passed to ONNX Runtime as external initializers.
+_MIN_EXTERNAL_INITIALIZER_BYTES = 2**20
+
+# Suffix of the session configuration saved next to a model by `utils.tuning.tune_session`.
+SESSION_CONFIG_SUFFIX = ".session.json"
+
+
+def read_univision_model(
+    model_path, zip_password: Optional[str] = None
+) -> Tuple[bytes, Optional[dict]]:
+    """
+    Reads the ONNX model and the metadata of a uniVision model file.
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to a plain ONNX model.
+        zip_password: Password of an encrypted uniVision model.
+
+    Returns:
+        The serialized ONNX model and the content of model.yaml, None for a plain ONNX model. The initializers
+        stored as external data are not included, see `read_external_initializers`.
+    """
+    if not zipfile.is_zipfile(model_path):
+        return Path(model_path).read_bytes(), None
+    with pyzipper.AESZipFile(model_path) as archive:
+        if zip_password is not None:
+            archive.setpassword(zip_password.encode())
+        metadata = YAML(typ="safe").load(archive.read("model.yaml"))
+        return archive.read("model.onnx"), metadata
+
+
+def external_data_locations(
+    model: onnx.ModelProto,
+) -> Dict[str, List[onnx.TensorProto]]:
+    """Maps the files of the external data of a model to the initializers stored in them."""
+    locations = {}
+    for initializer in model.graph.initializer:
+        if initializer.data_location == onnx.TensorProto.EXTERNAL:
+            location = next(
+                entry.value
+                for entry in initializer.external_data
+                if entry.key == "location"
+            )
+            locations.setdefault(location, []).append(initializer)
+    return locations
+
+
+def read_external_initializers(
+    model_path, model_bytes: bytes, zip_password: Optional[str] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Reads the initializers of a model stored as external data, e.g. of models over the 2 GB protobuf limit.
+
+    The tensor files of a plain ONNX model are memory mapped. In a uniVision model they are read tensor by
+    tensor from the archive, without extracting it. The tensor files are stored uncompressed by
+    `export_univision_model_v3`, so the reads seek directly to the tensors.
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+        model_bytes: The serialized ONNX model, see `read_univision_model`.
+        zip_password: Password of an encrypted uniVision model.
+
+    Returns:
+        The initializers by name, empty if the model has no external data.
+    """
+    locations = external_data_locations(onnx.load_from_string(model_bytes))
+    if not locations:
+        return {}
+
+    def tensor_info(initializer):
+        entries = {entry.key: entry.value for entry in initializer.external_data}
+        dtype = onnx.helper.tensor_dtype_to_np_dtype(initializer.data_type)
+        return dtype, int(entries.get("offset", 0)), tuple(initializer.dims)
+
+    initializers = {}
+    if not zipfile.is_zipfile(model_path):
+        directory = Path(model_path).parent
+        for location, tensors in locations.items():
+            for initializer in tensors:
+                dtype, offset, shape = tensor_info(initializer)
+                initializers[initializer.name] = np.memmap(
+                    directory / location, dtype, mode="r", offset=offset, shape=shape
+                )
+        return initializers
+    with pyzipper.AESZipFile(model_path) as archive:
+        if zip_password is not None:
+            archive.setpassword(zip_password.encode())
+        for location, tensors in locations.items():
+            with archive.open(location) as file:
+                for initializer in sorted(tensors, key=lambda t: tensor_info(t)[1]):
+                    dtype, offset, shape = tensor_info(initializer)
+                    file.seek(offset)
+                    size = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+                    initializers[initializer.name] = np.frombuffer(
+                        file.read(size), dtype
+                    ).reshape(shape)
+    return initializers
+
+
+def clear_session_cache():
+    """Releases the cached sessions, sessions of existing UnivisionSession objects stay alive."""
+    with _session_cache_lock:
+        _session_cache.clear()
+
+
+def session_config_path(model_path) -> Path:
+    """Returns the path of the session configuration of a model, e.g. model.u3o.session.json."""
+    return Path(f"{model_path}{SESSION_CONFIG_SUFFIX}")
+
+
+def load_session_config(model_path) -> Optional[dict]:
+    """Loads the session configuration saved next to a model, None if there is none."""
+    path = session_config_path(model_path)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())["session_options"]
+
+
+def create_session_options(
+    session_config: Optional[dict] = None,
+) -> onnxruntime.SessionOptions:
+    """
+    Creates the SessionOptions of a session configuration.
+
+    Args:
+        session_config: Dictionary with any of `intra_op_num_threads`, `inter_op_num_threads`,
+            `execution_mode` ("sequential" or "parallel"), `enable_cpu_mem_arena`, `enable_mem_pattern` and
+            `allow_spinning`. Missing settings keep the ONNX Runtime defaults.
+    """
+    config = session_config or {}
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    sess_options.intra_op_num_threads = config.get("intra_op_num_threads", 0)
+    sess_options.inter_op_num_threads = config.get("inter_op_num_threads", 0)
+    if config.get("execution_mode") == "parallel":
+        sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+    if "enable_cpu_mem_arena" in config:
+        sess_options.enable_cpu_mem_arena = config["enable_cpu_mem_arena"]
+    if "enable_mem_pattern" in config:
+        sess_options.enable_mem_pattern = config["enable_mem_pattern"]
+    if "allow_spinning" in config:
+        sess_options.add_session_config_entry(
+            "session.intra_op.allow_spinning", str(int(config["allow_spinning"]))
+        )
+    return sess_options
+
+
+def create_session(
+    model_bytes: bytes,
+    sess_options: Optional[onnxruntime.SessionOptions] = None,
+    providers: Sequence[str] = ("CPUExecutionProvider",),
+    model_path=None,
+    zip_password: Optional[str] = None,
+    external_initializers: Optional[Dict[str, np.ndarray]] = None,
+) -> onnxruntime.InferenceSession:
+    """
+    Creates an InferenceSession for a serialized model, with the initializers stored as external data.
+
+    Args:
+        model_bytes: The serialized ONNX model, see `read_univision_model`.
+        sess_options: Session options, see `create_session_options`.
+        providers: ONNX Runtime execution providers.
+        model_path: Path of the model, the external data is read from it, see `read_external_initializers`.
+        zip_password: Password of an encrypted uniVision model.
+        external_initializers: The external initializers if they are already read, `model_path` is then
+            not used.
+    """
+    if external_initializers is None:
+        external_initializers = (
+            read_external_initializers(model_path, model_bytes, zip_password)
+            if model_path is not None
+            else {}
+        )
+    sess_options = sess_options or create_session_options()
+    values = [
+        onnxruntime.OrtValue.ortvalue_from_numpy(np.ascontiguousarray(array))
+        for array in external_initializers.values()
+    ]
+    if values:
+        sess_options.add_external_initializers(list(external_initializers), values)
+    session = onnxruntime.InferenceSession(
+        model_bytes, sess_options, providers=list(providers)
+    )
+    # the OrtValues must outlive the session
+    session._external_initializers = values
+    return session
+
+
+def create_session_from_model(
+    model: onnx.ModelProto,
+    sess_options: Optional[onnxruntime.SessionOptions] = None,
+    providers: Sequence[str] = ("CPUExecutionProvider",),
+) -> onnxruntime.InferenceSession:
+    """
+    Creates an InferenceSession for a loaded model, also for models over the 2 GB protobuf limit. The
+    initializers of such models larger than `_MIN_EXTERNAL_INITIALIZER_BYTES` are passed to ONNX Runtime as
+    external initializers instead of being serialized. The model is not modified.
+    """
+    if model.ByteSize() < MAX_SERIALIZED_MODEL_SIZE:
+        return create_session(
+            model.SerializeToString(), sess_options, providers, external_initializers={}
+        )
+    external_initializers = {}
+    initializers = []
+    for initializer in model.graph.initializer:
+        if initializer.data_location == onnx.TensorProto.EXTERNAL:
+            raise ValueError(
+                f"The data of the initializer {initializer.name} is not loaded."
+            )
+        if initializer.ByteSize() < _MIN_EXTERNAL_INITIALIZER_BYTES:
+            initializers.append(initializer)
+            continue
+        external_initializers[initializer.name] = numpy_helper.to_array(initializer)
+        # a declaration without data, replaced by the external initializer
+        placeholder = onnx.TensorProto(
+            name=initializer.name,
+            data_type=initializer.data_type,
+            dims=initializer.dims,
+            data_location=onnx.TensorProto.EXTERNAL,
+        )
+        placeholder.external_data.add(key="location", value="external_initializer")
+        initializers.append(placeholder)
+    graph = model.graph
+    light_model = onnx.helper.make_model(
+        onnx.helper.make_graph(
+            graph.node,
+            graph.name,
+            graph.input,
+            graph.output,
+            initializers,
+            value_info=graph.value_info,
+        ),
+        ir_version=model.ir_version,
+        opset_imports=model.opset_import,
+        functions=model.functions,
+    )
+    return create_session(
+        light_model.SerializeToString(),
+        sess_options,
+        providers,
+        external_initializers=external_initializers,
+    )
+
+
+def copy_model(model: onnx.ModelProto) -> onnx.ModelProto:
+    """Deep copy of a model, also of models over the 2 GB protobuf limit, which cannot be serialized."""
+    copy = onnx.ModelProto()
+    copy.CopyFrom(model)
+    return copy
+
+
+def create_cpu_session(
+    model: Union[str, Path, bytes, onnx.ModelProto],
+    intra_op_num_threads: int = 0,
+    session_config: Optional[dict] = None,
+) -> onnxruntime.InferenceSession:
+    """
+    Creates a CPU InferenceSession with the default optimizations, e.g. to compare or score models.
+
+    Args:
+        model: Path to an ONNX model, which may have external data, the serialized model or a loaded model,
+            see `create_session_from_model`.
+        intra_op_num_threads: Number of threads of the operators, 0 for the ONNX Runtime default.
+        session_config: Session configuration, e.g. from `load_session_config`, see
+            `create_session_options`. `intra_op_num_threads` takes precedence over its thread count.
+    """
+    sess_options = create_session_options(
+        {**(session_config or {}), "intra_op_num_threads": intra_op_num_threads}
+    )
+    if isinstance(model, onnx.ModelProto):
+        return create_session_from_model(model, sess_options)
+    return onnxruntime.InferenceSession(
+        model if isinstance(model, bytes) else str(model),
+        sess_options,
+        providers=["CPUExecutionProvider"],
+    )
+
+
+def _external_data_fingerprint(model_path, model_bytes: bytes) -> Optional[Tuple]:
+    """
+    Identifies the external data of a model, which is not part of the serialized model: the resolved path,
+    modification time and size of the uniVision model, or of the tensor files of a plain ONNX model. None
+    if the model has no external data.
+    """
+    if model_path is None:
+        return None
+    locations = external_data_locations(onnx.load_from_string(model_bytes))
+    if not locations:
+        return None
+    model_path = Path(model_path).resolve()
+    if zipfile.is_zipfile(model_path):
+        files = [model_path]
+    else:
+        files = [model_path.parent / location for location in sorted(locations)]
+    return tuple(
+        (str(file), file.stat().st_mtime_ns, file.stat().st_size) for file in files
+    )
+
+
+def get_cached_session(
+    model_bytes: bytes,
+    providers: Sequence[str] = ("CPUExecutionProvider",),
+    intra_op_num_threads: int = 0,
+    inter_op_num_threads: int = 0,
+    session_config: Optional[dict] = None,
+    model_path=None,
+    zip_password: Optional[str] = None,
+) -> onnxruntime.InferenceSession:
+    """
+    Returns an InferenceSession for a serialized model, created once per model hash, external data files,
+    providers and session configuration, see `create_session_options`. Thread counts other than 0 override
+    the configuration. The external data of the model is read from `model_path`, see
+    `read_external_initializers`.
+    """
+    config = dict(session_config or {})
+    if intra_op_num_threads:
+        config["intra_op_num_threads"] = intra_op_num_threads
+    if inter_op_num_threads:
+        config["inter_op_num_threads"] = inter_op_num_threads
+    key = (
+        hashlib.sha256(model_bytes).hexdigest(),
+        _external_data_fingerprint(model_path, model_bytes),
+        tuple(providers),
+        json.dumps(config, sort_keys=True),
+    )
+    with _session_cache_lock:
+        session = _session_cache.get(key)
+        if session is None:
+            session = create_session(
+                model_bytes,
+                create_session_options(config),
+                providers,
+                model_path,
+                zip_password,
+            )
+            _session_cache[key] = session
+    return session
+
+
+def _numpy_dtype(ort_type: str) -> np.dtype:
+    # e.g. "tensor(float)" -> np.float32
+    return onnx.helper.tensor_dtype_to_np_dtype(
+        getattr(onnx.TensorProto, ort_type[len("tensor(") : -1].upper())
+    )
+
+
+def random_feeds(
+    session: onnxruntime.InferenceSession, batch_size: int = 1, seed: int = 0
+) -> Dict[str, np.ndarray]:
+    """
+    Returns random inputs in [0, 1) for every input of a session, e.g. to measure its latency or memory.
+    Dynamic dimensions are set to `batch_size` for the first dimension and to 1 otherwise. The inputs only
+    depend on the `seed`.
+    """
+    rng = np.random.default_rng(seed)
+    feeds = {}
+    for model_input in session.get_inputs():
+        shape = [
+            dim if isinstance(dim, int) else (batch_size if i == 0 else 1)
+            for i, dim in enumerate(model_input.shape)
+        ]
+        feeds[model_input.name] = rng.random(shape).astype(
+            _numpy_dtype(model_input.type)
+        )
+    return feeds
+
+
+class BoundRun:
+    def __init__(self, session: onnxruntime.InferenceSession):
+        """
+        IOBinding of a session with preallocated input and output buffers.
+
+        Outputs whose shape is fully known are written into preallocated arrays, the others (e.g. the
+        detections after NonMaxSuppression) are allocated by ONNX Runtime. The buffers are reused by every
+        call, so a BoundRun must only be used by one thread at a time.
+        """
+        self.session = session
+        self.binding = session.io_binding()
+        self.input = session.get_inputs()[0]
+        self.input_dtype = _numpy_dtype(self.input.type)
+        self.input_buffer = None
+        self.outputs = session.get_outputs()
+        self.output_buffers: List[Optional[np.ndarray]] = []
+        for output in self.outputs:
+            if all(isinstance(d, int) for d in output.shape):
+                buffer = np.empty(output.shape, dtype=_numpy_dtype(output.type))
+                self.binding.bind_output(
+                    output.name,
+                    "cpu",
+                    0,
+                    buffer.dtype,
+                    list(buffer.shape),
+                    buffer.ctypes.data,
+                )
+            else:
+                buffer = None
+                self.binding.bind_output(output.name, "cpu")
+            self.output_buffers.append(buffer)
+
+    def _bind_input(self, shape):
+        self.input_buffer = np.empty(shape, dtype=self.input_dtype)
+        self.binding.bind_input(
+            self.input.name,
+            "cpu",
+            0,
+            self.input_dtype,
+            list(shape),
+            self.input_buffer.ctypes.data,
+        )
+
+    def run(self, x: np.ndarray) -> List[np.ndarray]:
+        """
+        Runs the model on a batched input.
+
+        Returns:
+            The outputs. Preallocated outputs are overwritten by the next call.
+        """
+        if self.input_buffer is None or self.input_buffer.shape != x.shape:
+            self._bind_input(x.shape)
+        np.copyto(self.input_buffer, x, casting="same_kind")
+        for output, buffer in zip(self.outputs, self.output_buffers):
+            if buffer is None:
+                # otherwise ONNX Runtime reuses the output of the previous call, which may have another shape
+                self.binding.bind_output(output.name, "cpu")
+        self.session.run_with_iobinding(self.binding)
+        if all(buffer is not None for buffer in self.output_buffers):
+            return list(self.output_buffers)
+        ort_outputs = self.binding.get_outputs()
+        return [
+            buffer if buffer is not None else ort_output.numpy()
+            for buffer, ort_output in zip(self.output_buffers, ort_outputs)
+        ]
+
+
+class UnivisionSession:
+    def __init__(
+        self,
+        model_path,
+        providers: Sequence[str] = ("CPUExecutionProvider",),
+        intra_op_num_threads: int = 0,
+        inter_op_num_threads: int = 0,
+        pool_size: int = 2,
+        zip_password: Optional[str] = None,
+        session_config: Union[None, bool, dict] = None,
+    ):
+        """
+        Runtime for exported uniVision models and plain ONNX models.
+
+        The model is loaded once, the InferenceSession is shared by all UnivisionSession objects with the same
+        model, providers and session configuration. Every call runs through an IOBinding with preallocated
+        buffers taken from a pool, so `run` can be called concurrently from up to `pool_size` threads, further
+        threads wait for a free binding.
+
+        Example:
+        session = UnivisionSession("model.u3o", intra_op_num_threads=4)
+        boxes, labels, scores = session.run(preprocessed_image[np.newaxis])
+
+        Args:
+            model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+            providers: ONNX Runtime execution providers.
+            intra_op_num_threads: Threads per operator, 0 lets ONNX Runtime decide.
+            inter_op_num_threads: Threads for parallel operators, 0 lets ONNX Runtime decide.
+            pool_size: Number of bindings, i.e. of concurrent calls.
+            zip_password: Password of an encrypted uniVision model.
+            session_config: Session configuration, see `create_session_options`. By default the
+                configuration saved next to the model by `utils.tuning.tune_session` is used if there is one,
+                False disables it.
+        """
+        model_bytes, self.metadata = read_univision_model(model_path, zip_password)
+        if session_config is None:
+            session_config = load_session_config(model_path)
+        self.session_config = session_config or None
+        self.session = get_cached_session(
+            model_bytes,
+            providers,
+            intra_op_num_threads,
+            inter_op_num_threads,
+            self.session_config,
+            model_path,
+            zip_password,
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_names = [o.name for o in self.session.get_outputs()]
+        self.pool_size = pool_size
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(BoundRun(self.session))
+
+    @contextmanager
+    def binding(self):
+        """
+        Borrows a binding from the pool. Its outputs stay valid until the block exits, which avoids the
+        copies made by `run`.
+        """
+        bound_run = self._pool.get()
+        try:
+            yield bound_run
+        finally:
+            self._pool.put(bound_run)
+
+    def run(self, x: np.ndarray) -> List[np.ndarray]:
+        """
+        Runs the model on a batched input and returns outputs which are not reused by later calls.
+
+        The preallocated outputs are copied for that, in hot loops `binding` avoids the copies.
+        """
+        with self.binding() as bound_run:
+            return [
+                output.copy() if buffer is not None else output
+                for output, buffer in zip(bound_run.run(x), bound_run.output_buffers)
+            ]
@@ -0,0 +1,513 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import onnx
+import onnxruntime
+from onnxruntime.quantization.calibrate import CalibrationMethod, TensorsData
+from onnxruntime.quantization.registry import QDQRegistry, QLinearOpsRegistry
+from utils.calibration import (
+    collect_calibration_ranges,
+    quantize_static_with_ranges,
+    select_calibration_indices,
+)
+from utils.quantization import GraphIndex
+from utils.runtime import create_cpu_session
+
+
+def add_graph_outputs(model: onnx.ModelProto, tensor_names: Sequence[str]):
+    """
+    Exposes intermediate tensors of a model as additional graph outputs, in place.
+
+    Args:
+        model: The loaded ONNX model.
+        tensor_names: Names of the tensors to expose. Existing graph outputs are skipped.
+
+    Returns:
+        The same model.
+    """
+    value_infos = {vi.name: vi for vi in model.graph.value_info}
+    existing = {o.name for o in model.graph.output}
+    for name in tensor_names:
+        if name in existing:
+            continue
+        if name in value_infos:
+            model.graph.output.append(value_infos[name])
+        else:
+            model.graph.output.append(
+                onnx.helper.make_tensor_value_info(name, onnx.TensorProto.FLOAT, None)
+            )
+        existing.add(name)
+    return model
+
+
+class ErrorAccumulator:
+    def __init__(self):
+        """
+        Accumulates the error statistics of a tensor compared to its reference over several samples.
+
+        Only sums are stored, so the memory use does not depend on the number of samples.
+        """
+        self.signal = 0.0
+        self.noise = 0.0
+        self.dot = 0.0
+        self.norm = 0.0
+        self.mismatches = 0
+
+    def update(self, reference: np.ndarray, actual: np.ndarray):
+        if reference.shape != actual.shape:
+            # e.g. a different number of detections after NMS
+            self.mismatches += 1
+            return
+        reference = reference.astype(np.float64, copy=False).ravel()
+        actual = actual.astype(np.float64, copy=False).ravel()
+        self.signal += float(reference @ reference)
+        self.noise += float((reference - actual) @ (reference - actual))
+        self.dot += float(reference @ actual)
+        self.norm += float(actual @ actual)
+
+    def sqnr(self) -> float:
+        """Signal to quantization noise ratio in dB, -inf if any sample had a different shape."""
+        if self.mismatches:
+            return float("-inf")
+        if self.noise == 0.0:
+            return float("inf")
+        if self.signal == 0.0:
+            return float("-inf")
+        return 10.0 * np.log10(self.signal / self.noise)
+
+    def cosine(self) -> float:
+        """Cosine similarity of the concatenated samples, -inf if any sample had a different shape."""
+        if self.mismatches:
+            return float("-inf")
+        if self.signal == 0.0 or self.norm == 0.0:
+            return 1.0 if self.signal == self.norm else 0.0
+        return self.dot / np.sqrt(self.signal * self.norm)
+
+
+METRICS = {"sqnr": ErrorAccumulator.sqnr, "cosine": ErrorAccumulator.cosine}
+
+
+def default_compare_tensors(index: GraphIndex) -> List[str]:
+    """
+    Returns the tensors used to score a quantized model.
+
+    These are the graph outputs, except for object detection models with NonMaxSuppression, whose outputs
+    depend on the number of detections. For them the boxes and scores inputs of the NMS are used.
+    """
+    nms_ids = index.find("NonMaxSuppression")
+    if nms_ids:
+        return index.inputs[nms_ids[0]][:2]
+    return [o.name for o in index.graph.output]
+
+
+def quantized_tensor_names(
+    quantized_index: GraphIndex, tensor_names: Iterable[str]
+) -> Dict[str, str]:
+    """
+    Maps tensors of the fp32 model to the tensors of the quantized model holding the same values.
+
+    A quantized tensor is replaced by the output of its DequantizeLinear node. Tensors which no longer
+    exist in the quantized model, e.g. the output of a Conv fused with its Relu, are left out.
+    """
+    graph_outputs = quantized_index.graph_output_names
+    producer = quantized_index.producer
+    consumers = quantized_index.consumers
+    op_types = quantized_index.op_types
+    names = {}
+    for name in tensor_names:
+        if name in graph_outputs:
+            names[name] = name
+            continue
+        if name not in producer:
+            continue
+        names[name] = name
+        for consumer in consumers.get(name, ()):
+            if op_types[consumer] != "QuantizeLinear":
+                continue
+            for dequantize in consumers.get(quantized_index.outputs[consumer][0], ()):
+                if op_types[dequantize] == "DequantizeLinear":
+                    names[name] = quantized_index.outputs[dequantize][0]
+                    break
+    return names
+
+
+def run_and_compare(
+    session: onnxruntime.InferenceSession,
+    inputs: Sequence[np.ndarray],
+    references: Sequence[Dict[str, np.ndarray]],
+    tensor_names: Sequence[str],
+) -> Dict[str, ErrorAccumulator]:
+    """Runs a session over the inputs and accumulates the error of each tensor against the references."""
+    input_name = session.get_inputs()[0].name
+    errors = {name: ErrorAccumulator() for name in tensor_names}
+    for x, reference in zip(inputs, references):
+        outputs = session.run(list(tensor_names), {input_name: x})
+        for name, output in zip(tensor_names, outputs):
+            errors[name].update(reference[name], output)
+    return errors
+
+
+# Shared state of the worker processes, set once by _init_worker.
+_worker_state = {}
+
+
+def _init_worker(state, work_dir=None):
+    _worker_state.update(state)
+    if work_dir is not None:
+        # quantization writes a shape-inferred copy next to the model, so every worker needs its own copy
+        model_path = Path(tempfile.mkdtemp(dir=work_dir)) / "model.onnx"
+        shutil.copy(state["model_path"], model_path)
+        _worker_state["model_path"] = model_path
+
+
+def _evaluate_exclusion(nodes_to_exclude, state: Optional[Dict] = None):
+    """
+    Quantizes the model with the given exclusions and returns the score of every compared tensor. The state
+    defaults to that of the worker process.
+    """
+    state = _worker_state if state is None else state
+    with tempfile.TemporaryDirectory(prefix="sensitivity.") as tmp_dir:
+        model_output = Path(tmp_dir) / "model.onnx"
+        quantize_static_with_ranges(
+            state["model_path"],
+            model_output,
+            state["tensors_range"],
+            nodes_to_exclude=list(nodes_to_exclude),
+            **state["quantization_kwargs"],
+        )
+        model = add_graph_outputs(onnx.load(model_output), state["compare_tensors"])
+    session = create_cpu_session(model, state["intra_op_num_threads"])
+    errors = run_and_compare(
+        session, state["inputs"], state["references"], state["compare_tensors"]
+    )
+    metric = METRICS[state["metric"]]
+    return {name: metric(error) for name, error in errors.items()}
+
+
+class SensitivityAnalyzer:
+    def __init__(
+        self,
+        model_path,
+        dataset,
+        samples: int = 32,
+        tensors_range: Optional[TensorsData] = None,
+        compare_tensors: Optional[Sequence[str]] = None,
+        metric: str = "sqnr",
+        num_workers: Optional[int] = None,
+        seed: int = 0,
+        **quantization_kwargs,
+    ):
+        """
+        Measures how much every node contributes to the quantization error of a model.
+
+        The fp32 model and its QDQ versions are run side by side on a calibration subset and compared on the
+        `compare_tensors`. The calibration ranges are computed once, so every trial quantization only redoes
+        the graph rewrite.
+
+        Example:
+        analyzer = SensitivityAnalyzer(
+            float32_preprocessed_model_path,
+            calibration_dataset,
+            samples=32,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+        nodes_to_exclude = analyzer.propose_nodes_to_exclude(
+            budget=30.0, base_nodes_to_exclude=postprocess_nodes
+        )
+
+        Args:
+            model_path: Path to the preprocessed fp32 ONNX model.
+            dataset: Indexable dataset whose items are `(input, *targets)` tuples, see
+                `utils.calibration.collect_calibration_ranges`.
+            samples: Number of samples used to compare the models. Defaults to 32.
+            tensors_range: Calibration ranges. If None, MinMax ranges are collected on 500 samples.
+            compare_tensors: Tensors used to score a quantized model. Defaults to `default_compare_tensors`.
+            metric: Either "sqnr" (dB) or "cosine", higher is better for both. Defaults to "sqnr".
+            num_workers: Number of worker processes. Defaults to the number of CPU cores.
+            seed: Seed used to draw the samples.
+            **quantization_kwargs: Arguments of `quantize_static_with_ranges`, e.g. activation_type,
+                weight_type, per_channel or quant_format.
+        """
+        if metric not in METRICS:
+            raise ValueError(
+                f"{metric} is not a valid metric. Options are {list(METRICS)}."
+            )
+        if "nodes_to_exclude" in quantization_kwargs:
+            raise ValueError(
+                "Pass nodes_to_exclude to the analysis methods instead of the constructor."
+            )
+
+        self.model_path = Path(model_path)
+        self.index = GraphIndex.from_path(model_path)
+        self.metric = metric
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.quantization_kwargs = quantization_kwargs
+        self.compare_tensors = list(
+            compare_tensors
+            if compare_tensors is not None
+            else default_compare_tensors(self.index)
+        )
+        if tensors_range is None:
+            tensors_range = collect_calibration_ranges(
+                model_path,
+                dataset,
+                calibrate_method=CalibrationMethod.MinMax,
+                num_workers=num_workers,
+                seed=seed,
+            )
+        self.tensors_range = tensors_range
+
+        indices = select_calibration_indices(len(dataset), samples, seed)
+        self.inputs = [
+            np.asarray(dataset[i][0], dtype=np.float32)[np.newaxis] for i in indices
+        ]
+        reference_model = add_graph_outputs(onnx.load(model_path), self.compare_tensors)
+        session = create_cpu_session(reference_model)
+        self.references = [
+            dict(
+                zip(
+                    self.compare_tensors,
+                    session.run(
+                        self.compare_tensors, {session.get_inputs()[0].name: x}
+                    ),
+                )
+            )
+            for x in self.inputs
+        ]
+
+    def _worker_state(self, compare_tensors, references, intra_op_num_threads):
+        return {
+            "model_path": self.model_path,
+            "tensors_range": self.tensors_range,
+            "quantization_kwargs": self.quantization_kwargs,
+            "compare_tensors": compare_tensors,
+            "inputs": self.inputs,
+            "references": references,
+            "metric": self.metric,
+            "intra_op_num_threads": intra_op_num_threads,
+        }
+
+    def evaluate(self, nodes_to_exclude: Sequence[str] = ()) -> float:
+        """Returns the score of the model quantized with the given exclusions, the worst compared tensor counts."""
+        state = self._worker_state(self.compare_tensors, self.references, 0)
+        return min(_evaluate_exclusion(nodes_to_exclude, state).values())
+
+    def candidate_nodes(self, nodes_to_exclude: Sequence[str] = ()) -> List[str]:
+        """Returns the names of the nodes which are quantized and not excluded yet."""
+        excluded = set(nodes_to_exclude)
+        op_types = set(
+            self.quantization_kwargs.get("op_types_to_quantize")
+            or set(QLinearOpsRegistry) | set(QDQRegistry)
+        )
+        return [
+            name
+            for name, op_type in zip(self.index.names, self.index.op_types)
+            if name and op_type in op_types and name not in excluded
+        ]
+
+    def layer_errors(self, nodes_to_exclude: Sequence[str] = ()) -> List[Dict]:
+        """
+        Compares every node output of the fp32 model with the same tensor of the quantized model.
+
+        The quantized tensor is taken after its QuantizeLinear/DequantizeLinear pair, i.e. as seen by the
+        following nodes, so activations fused into the quantization (e.g. Relu) are compared correctly.
+
+        Besides the score of its output, each node gets a local degradation, the error of its output minus
+        the worst error of its inputs. The error is the relative noise power for "sqnr" and 1 - similarity
+        for "cosine". Nodes with a large local degradation are the ones where the error is introduced,
+        nodes with a low score but no local degradation only propagate it.
+
+        Args:
+            nodes_to_exclude: Nodes kept in fp32 for this comparison.
+
+        Returns:
+            One dictionary per compared node in graph order with the keys `node`, `op_type`, `tensor`,
+            `score` and `local_degradation`.
+        """
+        with tempfile.TemporaryDirectory(prefix="sensitivity.") as tmp_dir:
+            model_output = Path(tmp_dir) / "model.onnx"
+            quantize_static_with_ranges(
+                self.model_path,
+                model_output,
+                self.tensors_range,
+                nodes_to_exclude=list(nodes_to_exclude),
+                **self.quantization_kwargs,
+            )
+            quantized_model = onnx.load(model_output)
+        # only float tensors can be compared, the value infos come from the shape inference of the preprocessing
+        graph = self.index.graph
+        float_tensors = [
+            vi.name
+            for vi in list(graph.value_info) + list(graph.output)
+            if vi.type.tensor_type.elem_type == onnx.TensorProto.FLOAT
+            and vi.name in self.index.producer
+        ]
+        quantized_tensors = quantized_tensor_names(
+            GraphIndex.from_model(quantized_model), float_tensors
+        )
+        tensors = list(quantized_tensors)
+
+        reference_session = create_cpu_session(
+            add_graph_outputs(onnx.load(self.model_path), tensors)
+        )
+        # the reference session returns the tensors in graph order
+        session = create_cpu_session(
+            add_graph_outputs(quantized_model, list(quantized_tensors.values()))
+        )
+        input_name = session.get_inputs()[0].name
+        errors = {name: ErrorAccumulator() for name in tensors}
+        for x in self.inputs:
+            references = reference_session.run(tensors, {input_name: x})
+            outputs = session.run(list(quantized_tensors.values()), {input_name: x})
+            for name, reference, output in zip(tensors, references, outputs):
+                errors[name].update(reference, output)
+
+        metric = METRICS[self.metric]
+        scores = {name: metric(error) for name, error in errors.items()}
+        to_error = (
+            (lambda score: 10.0 ** (-score / 10.0))
+            if self.metric == "sqnr"
+            else (lambda score: 1.0 - score)
+        )
+        # error of every tensor, tensors which are not compared inherit the worst error of their inputs
+        tensor_errors = {}
+        report = []
+        # ONNX graphs are topologically sorted, so the inputs of a node are handled before it
+        for node_id, (name, op_type) in enumerate(
+            zip(self.index.names, self.index.op_types)
+        ):
+            input_error = max(
+                (tensor_errors.get(t, 0.0) for t in self.index.inputs[node_id]),
+                default=0.0,
+            )
+            for output in self.index.outputs[node_id]:
+                tensor_errors[output] = (
+                    to_error(scores[output]) if output in scores else input_error
+                )
+            outputs = self.index.outputs[node_id]
+            if not outputs or outputs[0] not in scores:
+                continue
+            report.append(
+                {
+                    "node": name,
+                    "op_type": op_type,
+                    "tensor": outputs[0],
+                    "score": scores[outputs[0]],
+                    "local_degradation": tensor_errors[outputs[0]] - input_error,
+                }
+            )
+        return report
+
+    def exclusion_sensitivity(
+        self,
+        candidates: Optional[Sequence[str]] = None,
+        nodes_to_exclude: Sequence[str] = (),
+    ) -> Dict[str, float]:
+        """
+        Scores the model once per candidate, each time with that single node additionally kept in fp32.
+
+        The trial quantizations run in parallel in `num_workers` processes.
+
+        Args:
+            candidates: Names of the nodes to try. Defaults to `candidate_nodes`.
+            nodes_to_exclude: Nodes which are excluded in every trial.
+
+        Returns:
+            Score of every candidate, sorted from the most to the least improving exclusion.
+        """
+        if candidates is None:
+            candidates = self.candidate_nodes(nodes_to_exclude)
+        num_workers = max(1, min(self.num_workers, len(candidates)))
+        state = self._worker_state(
+            self.compare_tensors,
+            self.references,
+            max(1, (os.cpu_count() or 1) // num_workers),
+        )
+        with (
+            tempfile.TemporaryDirectory(prefix="sensitivity.") as work_dir,
+            ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=_init_worker,
+                initargs=(state, work_dir),
+            ) as executor,
+        ):
+            scores = executor.map(
+                _evaluate_exclusion,
+                [list(nodes_to_exclude) + [candidate] for candidate in candidates],
+            )
+            sensitivity = {
+                candidate: min(score.values())
+                for candidate, score in zip(candidates, scores)
+            }
+        return dict(sorted(sensitivity.items(), key=lambda item: -item[1]))
+
+    def propose_nodes_to_exclude(
+        self,
+        budget: float,
+        base_nodes_to_exclude: Sequence[str] = (),
+        candidates: Optional[Sequence[str]] = None,
+        max_candidates: Optional[int] = None,
+    ) -> List[str]:
+        """
+        Proposes a minimal list of nodes to keep in fp32 so that the quantized model meets an accuracy budget.
+
+        Candidates are ranked by `exclusion_sensitivity` and added greedily as long as they improve the
+        score, until the budget is met. Afterwards every added node whose removal keeps the budget is
+        dropped again, so no node of the result is unnecessary.
+
+        Args:
+            budget: Minimum score of the worst compared tensor, in dB for "sqnr".
+            base_nodes_to_exclude: Nodes which are always excluded, e.g. the post-processing nodes.
+            candidates: Names of the nodes to consider. Defaults to `candidate_nodes`.
+            max_candidates: Only the candidates with the largest local degradation in `layer_errors` are
+                measured. Defaults to all candidates.
+
+        Returns:
+            The base exclusions followed by the proposed nodes, to pass to quantize_static(nodes_to_exclude=...).
+        """
+        nodes_to_exclude = list(base_nodes_to_exclude)
+        score = self.evaluate(nodes_to_exclude)
+        print(f"Score with {len(nodes_to_exclude)} excluded nodes: {score:.4f}")
+        if score >= budget:
+            return nodes_to_exclude
+
+        if candidates is None:
+            candidates = self.candidate_nodes(nodes_to_exclude)
+        if max_candidates is not None and len(candidates) > max_candidates:
+            degradation = {
+                row["node"]: row["local_degradation"]
+                for row in self.layer_errors(nodes_to_exclude)
+            }
+            candidates = sorted(
+                candidates, key=lambda name: -degradation.get(name, float("-inf"))
+            )[:max_candidates]
+
+        added = []
+        for candidate in self.exclusion_sensitivity(candidates, nodes_to_exclude):
+            trial_score = self.evaluate(nodes_to_exclude + added + [candidate])
+            if trial_score > score:
+                added.append(candidate)
+                score = trial_score
+                print(f"Excluding {candidate}: score {score:.4f}")
+            if score >= budget:
+                break
+
+        for candidate in reversed(list(added)):
+            remaining = [name for name in added if name != candidate]
+            trial_score = self.evaluate(nodes_to_exclude + remaining)
+            if trial_score >= budget:
+                added = remaining
+                print(f"{candidate} is not needed: score {trial_score:.4f}")
+
+        if score < budget:
+            print(
+                f"WARNING: The budget {budget} was not met, the best score is {score:.4f}."
+            )
+        print(f"Proposed {len(added)} additional nodes to exclude")
+        return nodes_to_exclude + added
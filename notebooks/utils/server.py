@@ -0,0 +1,383 @@
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional
+
+import numpy as np
+from utils.runtime import UnivisionSession
+
+DEFAULT_SOCKET_PATH = "/tmp/univision-inference.sock"
+
+_HEADER_LENGTH = struct.Struct("!I")
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("The connection was closed.")
+        view = view[received:]
+    return bytes(buffer)
+
+
+def send_message(sock: socket.socket, header: dict, arrays: List[np.ndarray] = ()):
+    """Sends a JSON header followed by the raw data of the arrays, which are described in the header."""
+    header = {
+        **header,
+        "arrays": [{"dtype": a.dtype.str, "shape": list(a.shape)} for a in arrays],
+    }
+    encoded = json.dumps(header, default=str).encode()
+    sock.sendall(
+        b"".join(
+            [_HEADER_LENGTH.pack(len(encoded)), encoded]
+            + [np.ascontiguousarray(a).tobytes() for a in arrays]
+        )
+    )
+
+
+def recv_message(sock: socket.socket):
+    """Receives a message sent by `send_message` and returns the header and the arrays."""
+    (length,) = _HEADER_LENGTH.unpack(_recv_exactly(sock, _HEADER_LENGTH.size))
+    header = json.loads(_recv_exactly(sock, length))
+    arrays = []
+    for spec in header.pop("arrays"):
+        dtype = np.dtype(spec["dtype"])
+        size = int(np.prod(spec["shape"], dtype=np.int64)) * dtype.itemsize
+        arrays.append(
+            np.frombuffer(_recv_exactly(sock, size), dtype).reshape(spec["shape"])
+        )
+    return header, arrays
+
+
+# Segments created by the clients of this process.
+_client_segments = set()
+
+
+def attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """Attaches to a shared memory segment owned by a client."""
+    segment = shared_memory.SharedMemory(name=name)
+    if name not in _client_segments:
+        # Python 3.11 registers attached segments too, the resource tracker would unlink them at exit
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class _Request:
+    def __init__(self, x: np.ndarray):
+        self.x = x
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.outputs = None
+        self.error = None
+
+
+class MicroBatcher:
+    def __init__(
+        self, session: UnivisionSession, max_batch_size: int, max_latency_ms: float
+    ):
+        """
+        Coalesces concurrent requests for a model into batches.
+
+        A batch is run when it has `max_batch_size` requests or when its first request has waited
+        `max_latency_ms`. Models with a fixed batch size of 1, or whose outputs are not batched like the
+        detections after NonMaxSuppression, run the collected requests one after the other. Requests with
+        different input shapes or types, e.g. for models with a dynamic input size, are batched separately.
+        """
+        self.session = session
+        self.max_batch_size = max_batch_size
+        self.max_latency_s = max_latency_ms / 1000
+        self.queue = queue.Queue()
+        input_batch = session.session.get_inputs()[0].shape[0]
+        self.batchable = not isinstance(input_batch, int) and all(
+            output.shape and output.shape[0] == input_batch
+            for output in session.session.get_outputs()
+        )
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.latencies_ms = deque(maxlen=10000)
+        self._lock = threading.Lock()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, x: np.ndarray) -> List[np.ndarray]:
+        request = _Request(x)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def _collect(self) -> List[_Request]:
+        batch = [self.queue.get()]
+        deadline = batch[0].arrival + self.max_latency_s
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, requests: List[_Request]):
+        try:
+            if self.batchable and len(requests) > 1:
+                outputs = self.session.run(np.concatenate([r.x for r in requests]))
+                offsets = np.cumsum([0] + [len(r.x) for r in requests])
+                for request, start, end in zip(requests, offsets, offsets[1:]):
+                    request.outputs = [output[start:end] for output in outputs]
+            else:
+                for request in requests:
+                    request.outputs = self.session.run(request.x)
+        except Exception as exception:
+            for request in requests:
+                request.error = exception
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            with self._lock:
+                self.queue_depths[self.queue.qsize()] += 1
+                self.batch_sizes[len(batch)] += 1
+            # requests of other shapes or types, e.g. of another image size, cannot be concatenated
+            groups = defaultdict(list)
+            for request in batch:
+                groups[request.x.shape[1:], request.x.dtype].append(request)
+            for requests in groups.values():
+                self._run(requests)
+            now = time.perf_counter()
+            with self._lock:
+                for request in batch:
+                    self.latencies_ms.append((now - request.arrival) * 1000)
+            for request in batch:
+                request.done.set()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            latencies = np.asarray(self.latencies_ms)
+            return {
+                "requests": int(sum(k * v for k, v in self.batch_sizes.items())),
+                "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                "queue_depth_histogram": dict(sorted(self.queue_depths.items())),
+                "latency_ms_p50": (
+                    float(np.percentile(latencies, 50)) if len(latencies) else None
+                ),
+                "latency_ms_p99": (
+                    float(np.percentile(latencies, 99)) if len(latencies) else None
+                ),
+            }
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        segments = {}
+        try:
+            while True:
+                try:
+                    header, arrays = recv_message(self.request)
+                except ConnectionError:
+                    break
+                try:
+                    response, outputs = self.server.dispatch(header, arrays, segments)
+                    send_message(self.request, {"ok": True, **response}, outputs)
+                except Exception as exception:
+                    send_message(self.request, {"ok": False, "error": repr(exception)})
+        finally:
+            for segment in segments.values():
+                segment.close()
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        models: Dict[str, str],
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        max_batch_size: int = 8,
+        max_latency_ms: float = 5.0,
+        **session_kwargs,
+    ):
+        """
+        Local inference server for uniVision models over a Unix socket.
+
+        The models are loaded once and shared by all clients. The clients pass the frames in shared memory,
+        only a small header goes through the socket. Concurrent requests for a model are coalesced into
+        micro-batches, see `MicroBatcher`. Use `InferenceClient` to talk to it.
+
+        Example:
+        server = InferenceServer({"detector": "detector.u3o"})
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        Args:
+            models: Model names mapped to the paths of the uniVision (.u3o) or ONNX models.
+            socket_path: Path of the Unix socket, an existing file is replaced.
+            max_batch_size: Maximum number of requests per batch.
+            max_latency_ms: Maximum time a request waits for the batch to fill.
+            **session_kwargs: Arguments of `UnivisionSession`, e.g. providers or intra_op_num_threads.
+        """
+        self.batchers = {
+            name: MicroBatcher(
+                UnivisionSession(path, **session_kwargs), max_batch_size, max_latency_ms
+            )
+            for name, path in models.items()
+        }
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+
+    def dispatch(self, header: dict, arrays: List[np.ndarray], segments: dict):
+        op = header.get("op")
+        if op == "stats":
+            return {
+                "models": {name: b.stats() for name, b in self.batchers.items()}
+            }, []
+        if op == "models":
+            return {
+                "models": {
+                    name: {
+                        "input": b.session.session.get_inputs()[0].shape,
+                        "outputs": b.session.output_names,
+                        "metadata": b.session.metadata,
+                    }
+                    for name, b in self.batchers.items()
+                }
+            }, []
+        if op != "infer":
+            raise ValueError(f"Unknown operation {op}.")
+        if header["model"] not in self.batchers:
+            raise KeyError(f"Unknown model {header['model']}.")
+        if "shm" in header:
+            name = header["shm"]
+            if name not in segments:
+                # a client owns one segment at a time, a new name replaces the old segment
+                for segment in segments.values():
+                    segment.close()
+                segments.clear()
+                segments[name] = attach_shared_memory(name)
+            x = np.ndarray(
+                header["shape"], np.dtype(header["dtype"]), buffer=segments[name].buf
+            )
+        else:
+            x = arrays[0]
+        return {}, self.batchers[header["model"]].submit(x)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class InferenceClient:
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH):
+        """
+        Client of an InferenceServer. A client is meant to be used by one thread, it owns one shared memory
+        segment which holds the current frame.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.segment: Optional[shared_memory.SharedMemory] = None
+
+    def frame_buffer(self, shape, dtype=np.float32) -> np.ndarray:
+        """
+        Returns an array in shared memory. Writing the frame directly into it, e.g. with np.copyto or as the
+        output of the preprocessing, avoids the copy made by `infer`.
+        """
+        nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        if self.segment is None or self.segment.size < nbytes:
+            self._release_segment()
+            self.segment = shared_memory.SharedMemory(create=True, size=nbytes)
+            _client_segments.add(self.segment.name)
+        return np.ndarray(shape, dtype, buffer=self.segment.buf)
+
+    def _request(self, header: dict, arrays=()):
+        send_message(self.sock, header, arrays)
+        response, outputs = recv_message(self.sock)
+        if not response.pop("ok"):
+            raise RuntimeError(f"The inference server failed: {response['error']}")
+        return response, outputs
+
+    def infer(self, model: str, x: np.ndarray) -> List[np.ndarray]:
+        """Runs a model on a batched input and returns its outputs."""
+        if self.segment is None or not np.may_share_memory(
+            x, np.ndarray(self.segment.size, np.uint8, buffer=self.segment.buf)
+        ):
+            np.copyto(self.frame_buffer(x.shape, x.dtype), x)
+        _, outputs = self._request(
+            {
+                "op": "infer",
+                "model": model,
+                "shm": self.segment.name,
+                "dtype": x.dtype.str,
+                "shape": list(x.shape),
+            }
+        )
+        return outputs
+
+    def stats(self) -> Dict:
+        """Returns the queue depth and batch size histograms and the latencies per model."""
+        return self._request({"op": "stats"})[0]["models"]
+
+    def models(self) -> Dict:
+        """Returns the input shape, the output names and the metadata of the served models."""
+        return self._request({"op": "models"})[0]["models"]
+
+    def _release_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            _client_segments.discard(self.segment.name)
+            self.segment = None
+
+    def close(self):
+        self.sock.close()
+        self._release_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local inference server for uniVision models."
+    )
+    parser.add_argument(
+        "--model",
+        action="append",
+        required=True,
+        metavar="NAME=PATH",
+        help="Model to serve, can be repeated.",
+    )
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-latency-ms", type=float, default=5.0)
+    parser.add_argument("--intra-op-num-threads", type=int, default=0)
+    args = parser.parse_args()
+
+    models = dict(model.split("=", 1) for model in args.model)
+    with InferenceServer(
+        models,
+        args.socket,
+        args.max_batch_size,
+        args.max_latency_ms,
+        intra_op_num_threads=args.intra_op_num_threads,
+    ) as server:
+        print(f"Serving {', '.join(models)} on {args.socket}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
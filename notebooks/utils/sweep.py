@@ -0,0 +1,473 @@
+import csv
+import hashlib
+import itertools
+import json
+import math
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+import onnx
+from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType
+from utils.benchmark import measure
+from utils.calibration import (
+    collect_calibration_ranges,
+    quantize_static_with_ranges,
+    select_calibration_indices,
+)
+from utils.quantization import (
+    GraphIndex,
+    find_postprocess_nodes_to_exclude,
+    get_nodes_to_exclude,
+)
+from utils.runtime import (
+    create_cpu_session,
+    create_session_from_model,
+    load_session_config,
+)
+from utils.sensitivity import (
+    METRICS,
+    add_graph_outputs,
+    default_compare_tensors,
+    run_and_compare,
+)
+
+# Strategies for the "nodes_to_exclude" axis of a sweep, each maps the fp32 model path to the node names.
+NODES_TO_EXCLUDE_STRATEGIES = {
+    "none": lambda model_path: [],
+    "postprocess": find_postprocess_nodes_to_exclude,
+    "classification_head": lambda model_path: get_nodes_to_exclude(
+        GraphIndex.from_path(model_path)
+    ),
+}
+
+# Values used for the configuration keys which are not part of the grid.
+DEFAULT_CONFIG = {
+    "calibrate_method": CalibrationMethod.MinMax,
+    "samples": 500,
+    "quant_format": QuantFormat.QDQ,
+    "per_channel": False,
+    "activation_type": QuantType.QUInt8,
+    "weight_type": QuantType.QInt8,
+    "nodes_to_exclude": "none",
+}
+
+
+class ArrayDataset:
+    def __init__(self, inputs: np.ndarray):
+        """Dataset over cached model inputs, its items are `(input, 0)` tuples like the calibration datasets."""
+        self.inputs = inputs
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, index):
+        return self.inputs[index], 0
+
+
+def dataset_fingerprint(dataset, image_paths: Optional[Sequence] = None) -> str:
+    """
+    Returns a short hash identifying the images of a dataset, for the keys of the calibration caches.
+
+    The hash covers the sorted image paths with their sizes and modification times, so adding, removing or
+    replacing an image changes it. The paths default to the `image_paths` attribute of the dataset, or to the
+    `image_path` column of its `df`, like the datasets of the example notebooks. Without image paths it
+    falls back to the length of the dataset and the content of its first input.
+
+    Args:
+        dataset: Indexable dataset whose items are `(input, *targets)` tuples.
+        image_paths: The image files of the dataset.
+    """
+    if image_paths is None:
+        image_paths = getattr(dataset, "image_paths", None)
+    if image_paths is None and hasattr(dataset, "df"):
+        image_paths = getattr(dataset.df, "image_path", None)
+    digest = hashlib.sha1()
+    if image_paths is not None:
+        for path in sorted(str(Path(p).resolve()) for p in image_paths):
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    else:
+        digest.update(str(len(dataset)).encode())
+        digest.update(np.asarray(dataset[0][0], dtype=np.float32).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def cache_calibration_set(
+    dataset, samples: int, cache_path, seed: int = 0
+) -> np.ndarray:
+    """
+    Draws calibration inputs from a dataset once and stores them as a .npy file.
+
+    The inputs are drawn with `select_calibration_indices`, so the first `n` cached inputs are the
+    calibration set of `n` samples. An existing cache file with enough samples is reused, so the cache path
+    should contain the `dataset_fingerprint`.
+
+    Args:
+        dataset: Indexable dataset whose items are `(input, *targets)` tuples.
+        samples: Number of inputs to cache.
+        cache_path: Path of the .npy file.
+        seed: Seed used to draw the samples.
+
+    Returns:
+        The cached inputs, memory mapped.
+    """
+    cache_path = Path(cache_path)
+    if cache_path.exists():
+        inputs = np.load(cache_path, mmap_mode="r")
+        if len(inputs) >= samples:
+            return inputs
+    indices = select_calibration_indices(len(dataset), samples, seed)
+    inputs = np.stack([np.asarray(dataset[i][0], dtype=np.float32) for i in indices])
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(cache_path, inputs)
+    return np.load(cache_path, mmap_mode="r")
+
+
+class ReferenceSQNR:
+    def __init__(
+        self,
+        model_path,
+        inputs: np.ndarray,
+        compare_tensors: Optional[Sequence[str]] = None,
+        metric: str = "sqnr",
+    ):
+        """
+        Accuracy metric scoring a quantized model by its agreement with the fp32 model.
+
+        It can be used when no labelled evaluation set is at hand. The score is the worst SQNR (dB) or cosine
+        similarity of the compared tensors, see `utils.sensitivity`.
+
+        Args:
+            model_path: Path to the fp32 ONNX model.
+            inputs: Batch-less model inputs, e.g. from `cache_calibration_set`.
+            compare_tensors: Tensors to compare. Defaults to `utils.sensitivity.default_compare_tensors`.
+            metric: Either "sqnr" or "cosine".
+        """
+        model = onnx.load(model_path)
+        self.compare_tensors = list(
+            compare_tensors
+            if compare_tensors is not None
+            else default_compare_tensors(GraphIndex.from_model(model))
+        )
+        self.metric = metric
+        self.inputs = [np.asarray(x, dtype=np.float32)[np.newaxis] for x in inputs]
+        session = create_session_from_model(
+            add_graph_outputs(model, self.compare_tensors)
+        )
+        input_name = session.get_inputs()[0].name
+        self.references = [
+            dict(
+                zip(
+                    self.compare_tensors,
+                    session.run(self.compare_tensors, {input_name: x}),
+                )
+            )
+            for x in self.inputs
+        ]
+
+    def __call__(self, model_path) -> float:
+        model = add_graph_outputs(onnx.load(model_path), self.compare_tensors)
+        session = create_session_from_model(model)
+        errors = run_and_compare(
+            session, self.inputs, self.references, self.compare_tensors
+        )
+        return min(METRICS[self.metric](error) for error in errors.values())
+
+
+def expand_grid(grid: Dict[str, Sequence]) -> List[Dict]:
+    """
+    Expands a grid like {"per_channel": [False, True], "samples": [100, 500]} into the list of all its
+    configurations. Keys which are not in the grid get the values of DEFAULT_CONFIG.
+    """
+    unknown = set(grid) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(
+            f"Unknown sweep keys {sorted(unknown)}. Options are {list(DEFAULT_CONFIG)}."
+        )
+    keys = list(grid)
+    return [
+        {**DEFAULT_CONFIG, **dict(zip(keys, values))}
+        for values in itertools.product(*(grid[key] for key in keys))
+    ]
+
+
+def _config_to_row(config: Dict) -> Dict:
+    row = {}
+    for key, value in config.items():
+        if isinstance(value, Enum):
+            value = value.name
+        elif key == "nodes_to_exclude" and not isinstance(value, str):
+            value = f"custom[{len(value)}]"
+        row[key] = value
+    return row
+
+
+def _ranges_cache_path(
+    cache_dir: Path, model_path: Path, fingerprint: str, method, samples, seed
+):
+    stat = model_path.stat()
+    key = f"{model_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}:{fingerprint}:{method.name}:{samples}:{seed}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return cache_dir / f"ranges_{method.name}_{samples}_{digest}.pkl"
+
+
+# Shared state of the worker processes, set once by _init_worker.
+_worker_state = {}
+
+
+def _init_worker(model_path, metric, work_dir):
+    # quantization writes a shape-inferred copy next to the model, so every worker needs its own copy
+    worker_model_path = Path(tempfile.mkdtemp(dir=work_dir)) / "model.onnx"
+    shutil.copy(model_path, worker_model_path)
+    _worker_state.update(model_path=worker_model_path, metric=metric)
+
+
+def _quantize_and_score(output_path, ranges_path, nodes_to_exclude, kwargs):
+    with open(ranges_path, "rb") as file:
+        tensors_range = pickle.load(file)
+    quantize_static_with_ranges(
+        _worker_state["model_path"],
+        output_path,
+        tensors_range,
+        nodes_to_exclude=nodes_to_exclude,
+        **kwargs,
+    )
+    return _worker_state["metric"](output_path)
+
+
+def measure_latency(
+    model_path, inputs: np.ndarray, repeat: int = 20, intra_op_num_threads: int = 1
+):
+    """
+    Measures the CPU latency of a model for a batch of one, cycling through the given inputs. The session
+    configuration saved next to the model, if any, is applied with `intra_op_num_threads` threads.
+
+    Returns:
+        The timing in seconds, see `utils.benchmark.measure`.
+    """
+    session = create_cpu_session(
+        model_path, intra_op_num_threads, load_session_config(model_path)
+    )
+    input_name = session.get_inputs()[0].name
+    batches = itertools.cycle(
+        [
+            np.asarray(x, dtype=np.float32)[np.newaxis]
+            for x in inputs[: max(1, min(len(inputs), 8))]
+        ]
+    )
+    return measure(lambda: session.run(None, {input_name: next(batches)}), repeat)
+
+
+def pareto_frontier(
+    results: List[Dict], accuracy_key: str = "accuracy", latency_key: str = "latency_ms"
+) -> List[Dict]:
+    """
+    Returns the results no other result beats in both accuracy (higher is better) and latency, sorted by
+    latency.
+    """
+    frontier = []
+    best_accuracy = float("-inf")
+    for result in sorted(results, key=lambda r: (r[latency_key], -r[accuracy_key])):
+        if result[accuracy_key] > best_accuracy:
+            frontier.append(result)
+            best_accuracy = result[accuracy_key]
+    return frontier
+
+
+def pick_fastest(
+    results: List[Dict], accuracy_floor: float, accuracy_key: str = "accuracy"
+):
+    """Returns the fastest result meeting the accuracy floor, None if there is none."""
+    candidates = [r for r in results if r[accuracy_key] >= accuracy_floor]
+    return min(candidates, key=lambda r: r["latency_ms"], default=None)
+
+
+def _json_value(value):
+    # JSON has no Infinity or NaN, e.g. the SQNR of an exact model is inf
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    if isinstance(value, dict):
+        return {k: _json_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    return value
+
+
+def save_sweep_results(results: List[Dict], json_path=None, csv_path=None):
+    """
+    Saves sweep results as JSON and/or CSV. Infinite and NaN values are written as the strings "inf", "-inf"
+    and "nan" in the JSON file, which `float` parses back.
+    """
+    if json_path is not None:
+        with open(json_path, "w") as file:
+            json.dump(_json_value(results), file, indent=2, allow_nan=False)
+    if csv_path is not None and results:
+        with open(csv_path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def run_quantization_sweep(
+    model_path,
+    dataset,
+    grid: Dict[str, Sequence],
+    metric: Callable[[Path], float],
+    output_dir,
+    num_workers: Optional[int] = None,
+    latency_repeat: int = 20,
+    intra_op_num_threads: int = 1,
+    seed: int = 0,
+    image_paths: Optional[Sequence] = None,
+) -> List[Dict]:
+    """
+    Quantizes a model with every configuration of a grid and measures accuracy and CPU latency.
+
+    The calibration inputs are drawn once and cached in `output_dir`, keyed by the `dataset_fingerprint`,
+    so a changed dataset is drawn and calibrated again. The calibration ranges only depend on
+    the calibration method and the number of samples, so they are computed (and cached) once per pair and
+    shared by all other settings. The quantization and the accuracy metric run in a process pool, the
+    latency is measured afterwards one model at a time, so the timings are not disturbed by the pool.
+
+    Example:
+    results = run_quantization_sweep(
+        float32_preprocessed_model_path,
+        calibration_dataset,
+        {
+            "calibrate_method": [CalibrationMethod.MinMax, CalibrationMethod.Percentile],
+            "per_channel": [False, True],
+            "nodes_to_exclude": ["none", "postprocess"],
+            "samples": [128, 512],
+        },
+        metric=evaluate_model,  # top-level function: model path -> accuracy
+        output_dir="sweep",
+    )
+    best = pick_fastest(results, accuracy_floor=0.55)
+
+    Args:
+        model_path: Path to the preprocessed fp32 ONNX model.
+        dataset: Indexable dataset whose items are `(input, *targets)` tuples.
+        grid: Values to try per configuration key, see `DEFAULT_CONFIG`. "nodes_to_exclude" takes the names
+            of NODES_TO_EXCLUDE_STRATEGIES or lists of node names.
+        metric: Callable mapping a quantized model path to its accuracy, higher is better, e.g. a
+            `ReferenceSQNR`. It must be picklable if the processes are not forked.
+        output_dir: Directory for the quantized models, the caches and the results (sweep.json, sweep.csv).
+        num_workers: Number of worker processes. Defaults to the number of CPU cores.
+        latency_repeat: Number of timed runs per model.
+        intra_op_num_threads: Threads of the latency measurement sessions.
+        seed: Seed used to draw the calibration samples.
+        image_paths: The image files of the dataset for its fingerprint, see `dataset_fingerprint`.
+
+    Returns:
+        One result per configuration with the configuration, `model_path`, `size_bytes`, `accuracy`,
+        `latency_ms` and `pareto`, whether it is on the latency/accuracy Pareto frontier.
+    """
+    model_path = Path(model_path)
+    output_dir = Path(output_dir)
+    cache_dir = output_dir / "cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    num_workers = num_workers or os.cpu_count() or 1
+    configs = expand_grid(grid)
+
+    fingerprint = dataset_fingerprint(dataset, image_paths)
+    inputs = cache_calibration_set(
+        dataset,
+        max(config["samples"] for config in configs),
+        cache_dir / f"calibration_{fingerprint}_seed{seed}.npy",
+        seed,
+    )
+
+    ranges_paths = {}
+    for method, samples in sorted(
+        {(c["calibrate_method"], c["samples"]) for c in configs},
+        key=lambda pair: (pair[0].name, pair[1]),
+    ):
+        path = _ranges_cache_path(
+            cache_dir, model_path, fingerprint, method, samples, seed
+        )
+        if not path.exists():
+            tensors_range = collect_calibration_ranges(
+                model_path,
+                ArrayDataset(inputs[:samples]),
+                samples=samples,
+                calibrate_method=method,
+                num_workers=num_workers,
+                seed=seed,
+            )
+            with open(path, "wb") as file:
+                pickle.dump(tensors_range, file)
+        ranges_paths[method, samples] = path
+
+    exclusions = {}
+    for config in configs:
+        strategy = config["nodes_to_exclude"]
+        if isinstance(strategy, str) and strategy not in exclusions:
+            if strategy not in NODES_TO_EXCLUDE_STRATEGIES:
+                raise ValueError(
+                    f"{strategy} is not a valid nodes_to_exclude strategy. "
+                    f"Options are {list(NODES_TO_EXCLUDE_STRATEGIES)} or a list of node names."
+                )
+            exclusions[strategy] = NODES_TO_EXCLUDE_STRATEGIES[strategy](model_path)
+
+    results = []
+    with (
+        tempfile.TemporaryDirectory(prefix="sweep.") as work_dir,
+        ProcessPoolExecutor(
+            max_workers=min(num_workers, len(configs)),
+            initializer=_init_worker,
+            initargs=(model_path, metric, work_dir),
+        ) as executor,
+    ):
+        futures = []
+        for config_id, config in enumerate(configs):
+            strategy = config["nodes_to_exclude"]
+            output_path = output_dir / f"config_{config_id:03d}.onnx"
+            futures.append(
+                executor.submit(
+                    _quantize_and_score,
+                    output_path,
+                    ranges_paths[config["calibrate_method"], config["samples"]],
+                    list(
+                        exclusions[strategy] if isinstance(strategy, str) else strategy
+                    ),
+                    {
+                        key: config[key]
+                        for key in (
+                            "quant_format",
+                            "per_channel",
+                            "activation_type",
+                            "weight_type",
+                        )
+                    },
+                )
+            )
+            results.append({**_config_to_row(config), "model_path": str(output_path)})
+        for result, future in zip(results, futures):
+            result["accuracy"] = float(future.result())
+
+    for result in results:
+        timing = measure_latency(
+            result["model_path"], inputs, latency_repeat, intra_op_num_threads
+        )
+        result["size_bytes"] = os.path.getsize(result["model_path"])
+        result["latency_ms"] = timing["mean"] * 1000
+
+    frontier = {id(r) for r in pareto_frontier(results)}
+    for result in results:
+        result["pareto"] = id(result) in frontier
+
+    save_sweep_results(results, output_dir / "sweep.json", output_dir / "sweep.csv")
+    print(f"{'config':<12} {'accuracy':>10} {'latency ms':>11}  pareto")
+    for result in results:
+        print(
+            f"{Path(result['model_path']).stem:<12} {result['accuracy']:>10.4f} "
+            f"{result['latency_ms']:>11.2f}  {'*' if result['pareto'] else ''}"
+        )
+    return results
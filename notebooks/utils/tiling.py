@@ -0,0 +1,301 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from utils.benchmark import measure
+from utils.image import boxes_to_image, decode_boxes, preprocess_from_metadata
+from utils.runtime import UnivisionSession
+
+MERGE_METHODS = ("nms", "wbf")
+
+
+def tile_starts(length: int, tile: int, overlap: float) -> np.ndarray:
+    """
+    Returns the start positions of overlapping tiles covering `length` pixels. The tiles are evenly spaced,
+    the last one ends at the border, so the overlap is at least `overlap * tile`.
+    """
+    if length <= tile:
+        return np.zeros(1, dtype=int)
+    stride = tile * (1 - overlap)
+    count = int(np.ceil((length - tile) / stride)) + 1
+    return np.round(np.linspace(0, length - tile, count)).astype(int)
+
+
+def make_tiles(
+    image: np.ndarray, tile_size: Tuple[int, int], overlap: float = 0.2
+) -> Tuple[List[np.ndarray], np.ndarray]:
+    """
+    Cuts an image into overlapping tiles of the model input size. An image smaller than a tile in a dimension
+    gives tiles of the image size in that dimension, they are resized like the whole image by the
+    preprocessing of the model, see `preprocess_from_metadata`.
+
+    Args:
+        image: Image (H, W, C).
+        tile_size: Model input size (height, width).
+        overlap: Minimum overlap of neighbouring tiles, as a fraction of the tile size. It should be larger
+            than the objects to detect, relative to the tile, so every object is complete in some tile.
+
+    Returns:
+        The tiles, views (h, w, C) of the image, and their (x, y) offsets in the image, shape (tiles, 2).
+    """
+    tile_h, tile_w = tile_size
+    h, w = image.shape[:2]
+    ys = tile_starts(h, tile_h, overlap)
+    xs = tile_starts(w, tile_w, overlap)
+    offsets = np.stack(np.meshgrid(xs, ys), axis=-1).reshape(-1, 2)
+    tiles = [image[y : y + tile_h, x : x + tile_w] for x, y in offsets]
+    return tiles, offsets
+
+
+def box_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """IoU of one xyxy box with every box of an (N, 4) array."""
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(area + areas - intersection, 1e-9)
+
+
+def class_aware_nms(
+    boxes: np.ndarray, scores: np.ndarray, labels: np.ndarray, iou_threshold: float
+) -> np.ndarray:
+    """
+    Non-maximum suppression within each class.
+
+    Returns:
+        Indices of the kept boxes, by decreasing score.
+    """
+    if not len(boxes):
+        return np.zeros(0, dtype=int)
+    # shifting every class to its own region makes boxes of different classes disjoint
+    shifted = boxes + (labels * (boxes.max() + 1))[:, np.newaxis]
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while len(order):
+        best = order[0]
+        keep.append(best)
+        order = order[1:][box_iou(shifted[best], shifted[order[1:]]) <= iou_threshold]
+    return np.asarray(keep, dtype=int)
+
+
+def weighted_box_fusion(
+    boxes: np.ndarray, scores: np.ndarray, labels: np.ndarray, iou_threshold: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Weighted box fusion within each class: overlapping boxes are replaced by their score weighted average.
+    Unlike NMS the merged box uses the parts of an object seen in several tiles.
+
+    Returns:
+        The fused boxes, labels and scores, the score of a fused box is the maximum of its cluster.
+    """
+    fused_boxes, fused_labels, fused_scores = [], [], []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        order = members[np.argsort(-scores[members], kind="stable")]
+        while len(order):
+            cluster = order[box_iou(boxes[order[0]], boxes[order]) > iou_threshold]
+            cluster = np.union1d(cluster, order[:1])
+            weights = scores[cluster]
+            fused_boxes.append(weights @ boxes[cluster] / weights.sum())
+            fused_labels.append(label)
+            fused_scores.append(weights.max())
+            order = order[~np.isin(order, cluster)]
+    if not fused_boxes:
+        return boxes[:0], labels[:0], scores[:0]
+    order = np.argsort(-np.asarray(fused_scores), kind="stable")
+    return (
+        np.asarray(fused_boxes, dtype=boxes.dtype)[order],
+        np.asarray(fused_labels, dtype=labels.dtype)[order],
+        np.asarray(fused_scores, dtype=scores.dtype)[order],
+    )
+
+
+class TiledDetector:
+    def __init__(
+        self,
+        session: UnivisionSession,
+        overlap: float = 0.2,
+        merge: str = "nms",
+        iou_threshold: float = 0.5,
+        score_threshold: float = 0.0,
+        batch_size: int = 8,
+        input_metadata: Optional[Dict] = None,
+        output_metadata: Optional[Dict] = None,
+    ):
+        """
+        Runs an object detection model on overlapping tiles of high resolution images instead of a
+        letterbox of the whole image, so small objects keep their resolution.
+
+        The tiles have the size of the model input and are preprocessed like uniVision does, see
+        `preprocess_from_metadata`. Models with a dynamic batch size and batched outputs get the tiles as
+        batches of `batch_size`. Detectors ending with NonMaxSuppression, whose outputs are not batched, run
+        the tiles concurrently on the bindings of the session, so create it with a `pool_size` like the
+        number of tiles per image. The boxes are decoded according to the metadata, see `decode_boxes`,
+        moved to image coordinates and the duplicates at the tile seams are merged per class.
+
+        Example:
+        detector = TiledDetector(UnivisionSession("detector.u3o", pool_size=4), overlap=0.25)
+        boxes, labels, scores = detector.detect(read_image_file("frame.png"))
+
+        Args:
+            session: Session of the detector.
+            overlap: Minimum overlap of neighbouring tiles, see `make_tiles`.
+            merge: "nms" for class-aware NMS or "wbf" for weighted box fusion.
+            iou_threshold: IoU above which boxes of neighbouring tiles are merged.
+            score_threshold: Boxes with a lower score are dropped before merging.
+            batch_size: Number of tiles per batch for batchable models.
+            input_metadata: The `input` of the model metadata, defaults to the one of the uniVision model.
+                Required for ONNX models.
+            output_metadata: The detection output of the model metadata with the output indices and the boxes
+                format, defaults to the one of the uniVision model, or to absolute xyxy boxes, labels and scores.
+        """
+        if merge not in MERGE_METHODS:
+            raise ValueError(f"merge must be one of {MERGE_METHODS}, got {merge}.")
+        self.session = session
+        self.overlap = overlap
+        self.merge = merge
+        self.iou_threshold = iou_threshold
+        self.score_threshold = score_threshold
+        self.batch_size = batch_size
+
+        metadata = session.metadata or {}
+        self.input_metadata = input_metadata or metadata.get("input")
+        if self.input_metadata is None:
+            raise ValueError("The input metadata is required for ONNX models.")
+        self.output_metadata = output_metadata or (metadata.get("outputs") or [{}])[0]
+        self.input_size = (self.input_metadata["height"], self.input_metadata["width"])
+
+        model_input = session.session.get_inputs()[0]
+        self.batchable = not isinstance(model_input.shape[0], int) and all(
+            output.shape and output.shape[0] == model_input.shape[0]
+            for output in session.session.get_outputs()
+        )
+        self.output_indices = tuple(
+            self.output_metadata.get(f"{name}_output_index", default)
+            for name, default in (("boxes", 0), ("labels", 1), ("scores", 2))
+        )
+        self._executor = ThreadPoolExecutor(max_workers=session.pool_size)
+
+    def _detections(self, outputs: List[np.ndarray]):
+        return tuple(outputs[i] for i in self.output_indices)
+
+    def _run_tiles(self, tiles: np.ndarray):
+        """Returns the boxes, labels and scores of all preprocessed tiles and the tile of every box."""
+        per_tile = []
+        if self.batchable:
+            for start in range(0, len(tiles), self.batch_size):
+                boxes, labels, scores = self._detections(
+                    self.session.run(tiles[start : start + self.batch_size])
+                )
+                per_tile += list(zip(boxes, labels, scores))
+        else:
+            per_tile = [
+                self._detections(outputs)
+                for outputs in self._executor.map(
+                    self.session.run, (tile[np.newaxis] for tile in tiles)
+                )
+            ]
+        tile_ids = np.concatenate(
+            [
+                np.full(len(boxes.reshape(-1, 4)), i)
+                for i, (boxes, _, _) in enumerate(per_tile)
+            ]
+        ).astype(int)
+        boxes = np.concatenate(
+            [
+                decode_boxes(detections[0], self.output_metadata, self.input_metadata)
+                for detections in per_tile
+            ]
+        )
+        labels, scores = (
+            np.concatenate([detections[k].reshape(-1) for detections in per_tile])
+            for k in (1, 2)
+        )
+        return boxes, labels, scores, tile_ids
+
+    def detect(self, image: np.ndarray):
+        """
+        Detects objects on the tiles of an image.
+
+        Args:
+            image: Image (H, W, C) in RGB or grayscale, e.g. from `read_image_file`.
+
+        Returns:
+            Boxes (N, 4) in xyxy image coordinates, labels (N,) and scores (N,).
+        """
+        tiles, offsets = make_tiles(image, self.input_size, self.overlap)
+        inputs, transforms = zip(
+            *(preprocess_from_metadata(tile, self.input_metadata) for tile in tiles)
+        )
+        boxes, labels, scores, tile_ids = self._run_tiles(np.concatenate(inputs))
+        keep = scores >= self.score_threshold
+        boxes, labels, scores, tile_ids = (
+            boxes[keep],
+            labels[keep],
+            scores[keep],
+            tile_ids[keep],
+        )
+        for i, (tile, transform, offset) in enumerate(zip(tiles, transforms, offsets)):
+            in_tile = tile_ids == i
+            boxes[in_tile] = boxes_to_image(
+                boxes[in_tile], transform, tile.shape
+            ) + np.tile(offset, 2)
+        if self.merge == "wbf":
+            return weighted_box_fusion(boxes, scores, labels, self.iou_threshold)
+        keep = class_aware_nms(boxes, scores, labels, self.iou_threshold)
+        return boxes[keep], labels[keep], scores[keep]
+
+    def detect_whole_image(self, image: np.ndarray):
+        """Detects objects on the whole image preprocessed like the plain export path, see `detect`."""
+        x, transform = preprocess_from_metadata(image, self.input_metadata)
+        boxes, labels, scores = self._detections(self.session.run(x))
+        boxes = decode_boxes(boxes, self.output_metadata, self.input_metadata)
+        labels, scores = labels.reshape(-1), scores.reshape(-1)
+        keep = scores >= self.score_threshold
+        boxes = boxes_to_image(boxes[keep], transform, image.shape)
+        return boxes.astype(np.float32), labels[keep], scores[keep]
+
+
+def benchmark_tiled_inference(
+    detector: TiledDetector, images: Sequence[np.ndarray], repeat: int = 3
+) -> Dict[str, Dict]:
+    """
+    Compares the throughput and the number of detections of the tiled path and of the whole image path.
+
+    Args:
+        detector: The tiled detector.
+        images: Images (H, W, C), e.g. a few frames of the camera.
+        repeat: Number of timed passes over the images.
+
+    Returns:
+        Per path ("whole", "tiled") the `measure` timings of a pass, `images_per_s` and `detections`
+        per image.
+    """
+    results = {}
+    for path, detect in (
+        ("whole", detector.detect_whole_image),
+        ("tiled", detector.detect),
+    ):
+        detections = [len(detect(image)[0]) for image in images]
+        timings = measure(lambda: [detect(image) for image in images], repeat=repeat)
+        results[path] = {
+            **timings,
+            "images_per_s": len(images) / timings["mean"],
+            "detections": float(np.mean(detections)),
+        }
+
+    tiles = len(make_tiles(images[0], detector.input_size, detector.overlap)[1])
+    print(
+        f"{len(images)} images of {images[0].shape[1]}x{images[0].shape[0]}, "
+        f"{tiles} tiles of {detector.input_size[1]}x{detector.input_size[0]} per image"
+    )
+    print(f"{'path':<10} {'images/s':>9} {'ms/image':>9} {'detections':>11}")
+    for path, result in results.items():
+        print(
+            f"{path:<10} {result['images_per_s']:>9.2f} "
+            f"{1000 / result['images_per_s']:>9.1f} {result['detections']:>11.1f}"
+        )
+    return results
@@ -0,0 +1,217 @@
+import atexit
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Set to a file path to trace a whole program, e.g. a CI job, see `enable_tracing_from_environment`.
+TRACE_ENVIRONMENT_VARIABLE = "UNIVISION_TRACE"
+
+_tracer: Optional["Tracer"] = None
+_disabled_span = nullcontext()
+
+
+class Tracer:
+    def __init__(self):
+        """
+        Records timed spans of a pipeline, e.g. the stages of an export or quantization, as Chrome trace
+        "complete" events. Spans nest, every event records the span it was started in as its `parent`.
+
+        Use it through `tracing`, `span` and `traced`, so the instrumentation of the utils costs a single
+        check when tracing is disabled.
+
+        Example:
+        with tracing("export_trace.json") as tracer:
+            export_univision_model_v3(...)
+        tracer.print_report()
+        # open export_trace.json in chrome://tracing or https://ui.perfetto.dev
+        """
+        self.events: List[Dict] = []
+        # timestamps are microseconds since the epoch, so traces of several processes line up
+        self._origin_ns = time.time_ns() - time.perf_counter_ns()
+        self._stacks = threading.local()
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """Records the duration of the code in the block as an event called `name` with the `args`."""
+        stack = self._stacks.__dict__.setdefault("names", [])
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        start = time.perf_counter_ns()
+        try:
+            yield
+        except BaseException as error:
+            args["error"] = type(error).__name__
+            raise
+        finally:
+            end = time.perf_counter_ns()
+            stack.pop()
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": "univision",
+                    "ph": "X",
+                    "ts": (self._origin_ns + start) / 1000,
+                    "dur": (end - start) / 1000,
+                    "pid": os.getpid(),
+                    "tid": threading.get_native_id(),
+                    "args": {"parent": parent, **args},
+                }
+            )
+
+    def summary(self) -> List[Dict]:
+        """
+        Aggregates the events by name, in order of first appearance.
+
+        Returns:
+            One row per span name with the `count`, `total_ms`, `mean_ms` and `max_ms`.
+        """
+        durations = defaultdict(list)
+        for event in self.events:
+            durations[event["name"]].append(event["dur"] / 1000)
+        return [
+            {
+                "name": name,
+                "count": len(values),
+                "total_ms": sum(values),
+                "mean_ms": sum(values) / len(values),
+                "max_ms": max(values),
+            }
+            for name, values in durations.items()
+        ]
+
+    def print_report(self):
+        print(
+            f"{'span':<40} {'count':>6} {'total ms':>10} {'mean ms':>10} {'max ms':>10}"
+        )
+        for row in self.summary():
+            print(
+                f"{row['name'][-40:]:<40} {row['count']:>6} {row['total_ms']:>10.2f} "
+                f"{row['mean_ms']:>10.2f} {row['max_ms']:>10.2f}"
+            )
+
+    def save(self, path):
+        """
+        Saves the events as a Chrome trace file, or as JSON lines, one event per line, if the path ends with
+        ".jsonl". Both are easy to aggregate across runs, e.g. with `json.loads` per line.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as file:
+            if path.suffix == ".jsonl":
+                for event in self.events:
+                    file.write(json.dumps(event, default=str) + "\n")
+            else:
+                json.dump(
+                    {"traceEvents": self.events, "displayTimeUnit": "ms"},
+                    file,
+                    default=str,
+                )
+
+
+def get_tracer() -> Optional[Tracer]:
+    """Returns the active tracer, None if tracing is disabled."""
+    return _tracer
+
+
+def enable_tracing(tracer: Optional[Tracer] = None) -> Tracer:
+    """Activates a tracer, a new one by default, for the spans of the utils."""
+    global _tracer
+    _tracer = tracer or Tracer()
+    return _tracer
+
+
+def disable_tracing() -> Optional[Tracer]:
+    """Deactivates tracing and returns the tracer which was active."""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+@contextmanager
+def tracing(path=None):
+    """
+    Traces the code in the block with a new tracer, see `Tracer`, and saves the events to `path` if given.
+    The previously active tracer is restored afterwards.
+    """
+    previous = _tracer
+    tracer = enable_tracing()
+    try:
+        yield tracer
+    finally:
+        if previous is not None:
+            enable_tracing(previous)
+        else:
+            disable_tracing()
+        if path is not None:
+            tracer.save(path)
+
+
+def span(name: str, **args):
+    """
+    Records the code in the `with` block as a span of the active tracer. Without an active tracer it returns
+    a shared no-op context manager.
+
+    Args:
+        name: Name of the span, e.g. "zip write".
+        **args: Values recorded with the event, e.g. the model path. They should be cheap to compute.
+    """
+    if _tracer is None:
+        return _disabled_span
+    return _tracer.span(name, **args)
+
+
+def traced(name: Optional[str] = None):
+    """Decorator recording every call of a function as a span, named after the function by default."""
+
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return function(*args, **kwargs)
+            with _tracer.span(span_name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def enable_tracing_from_environment():
+    """
+    Enables tracing if the `UNIVISION_TRACE` environment variable is set to a file path, and saves the events
+    when the process exits. The process id is added to the file name, e.g. trace.1234.json, so that worker
+    processes, which inherit the variable, do not overwrite each other's trace.
+
+    multiprocessing ends forked workers with os._exit, which skips atexit, so in workers the events are
+    saved by a multiprocessing finalizer when the worker returns, e.g. when a ProcessPoolExecutor shuts down.
+    Workers stopped with `terminate`, like by the `with` block of a multiprocessing.Pool, lose their events.
+    """
+    path = os.environ.get(TRACE_ENVIRONMENT_VARIABLE)
+    if not path or _tracer is not None:
+        return
+    tracer = enable_tracing()
+    path = Path(path)
+
+    def save():
+        if tracer.events:
+            tracer.save(path.with_name(f"{path.stem}.{os.getpid()}{path.suffix}"))
+
+    def after_fork(tracer):
+        # a forked worker starts with a copy of the events of its parent
+        del tracer.events[:]
+        multiprocessing.util.Finalize(None, save, exitpriority=0)
+
+    atexit.register(save)
+    multiprocessing.util.register_after_fork(tracer, after_fork)
+
+
+enable_tracing_from_environment()
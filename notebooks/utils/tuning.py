@@ -0,0 +1,231 @@
+import json
+import os
+import statistics
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import onnxruntime
+from utils.runtime import (
+    create_session,
+    create_session_options,
+    random_feeds,
+    read_external_initializers,
+    read_univision_model,
+    session_config_path,
+)
+
+TUNING_OBJECTIVES = ("latency", "throughput")
+
+
+def _threads_per_run(session_config: dict) -> int:
+    threads = max(1, session_config.get("intra_op_num_threads", 1))
+    if session_config.get("execution_mode") == "parallel":
+        threads *= max(1, session_config.get("inter_op_num_threads", 1))
+    return threads
+
+
+def measure_session_config(
+    model_bytes: bytes,
+    session_config: dict,
+    core_budget: int,
+    batch_size: int = 1,
+    repeat: int = 50,
+    warmup: int = 10,
+    external_initializers: Optional[Dict[str, np.ndarray]] = None,
+) -> Dict[str, float]:
+    """
+    Measures the steady-state latency and throughput of a model with a session configuration.
+
+    The latency comes from sequential calls after `warmup` calls. The throughput runs as many concurrent
+    callers as fit in the core budget, `core_budget` divided by the threads of one call, each making
+    `repeat` calls. The initializers of a model with external data are passed as `external_initializers`,
+    see `utils.runtime.read_external_initializers`.
+
+    Returns:
+        Dictionary with the median and 90th percentile latency in ms (`latency_ms`, `p90_ms`), the
+        `throughput` in samples per second and the `concurrency` of the throughput measurement.
+    """
+    session = create_session(
+        model_bytes,
+        create_session_options(session_config),
+        external_initializers=external_initializers or {},
+    )
+    feeds = random_feeds(session, batch_size)
+    for _ in range(warmup):
+        session.run(None, feeds)
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        session.run(None, feeds)
+        durations.append(time.perf_counter() - start)
+
+    concurrency = max(1, core_budget // _threads_per_run(session_config))
+
+    def call_repeatedly():
+        for _ in range(repeat):
+            session.run(None, feeds)
+
+    threads = [threading.Thread(target=call_repeatedly) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "latency_ms": 1000 * statistics.median(durations),
+        "p90_ms": 1000 * float(np.percentile(durations, 90)),
+        "throughput": concurrency * repeat * batch_size / elapsed,
+        "concurrency": concurrency,
+    }
+
+
+def _thread_candidates(core_budget: int) -> List[dict]:
+    """Sequential configurations with powers of two intra-op threads, and parallel splits of the budget."""
+    intra_threads = sorted(
+        {2**i for i in range(core_budget.bit_length()) if 2**i <= core_budget}
+        | {core_budget}
+    )
+    candidates = [
+        {"intra_op_num_threads": intra, "execution_mode": "sequential"}
+        for intra in intra_threads
+    ]
+    for intra in intra_threads:
+        inter = core_budget // intra
+        if inter >= 2:
+            candidates.append(
+                {
+                    "intra_op_num_threads": intra,
+                    "inter_op_num_threads": inter,
+                    "execution_mode": "parallel",
+                }
+            )
+    return candidates
+
+
+def tune_session(
+    model_path,
+    core_budget: Optional[int] = None,
+    batch_size: int = 1,
+    objective: str = "latency",
+    repeat: int = 50,
+    warmup: int = 10,
+    save: bool = True,
+    zip_password: Optional[str] = None,
+) -> dict:
+    """
+    Searches the ONNX Runtime session options of a model for a core budget and saves the best ones next to
+    the model, where `UnivisionSession` and the other session-creation paths of `utils` pick them up.
+
+    The search is staged, each stage starts from the best configuration of the previous one: first the
+    intra-op/inter-op threads and the execution mode, then the CPU memory arena and the memory pattern,
+    last whether idle intra-op threads spin. The number of runs stays small, so the tuning is quick
+    enough to repeat on every target machine.
+
+    Example:
+    session_config = tune_session("model.u3o", core_budget=4)
+    session = UnivisionSession("model.u3o")  # uses model.u3o.session.json
+
+    Args:
+        model_path: Path to a uniVision model (.u3o) or to an ONNX model.
+        core_budget: Number of cores the model may use. Defaults to all cores.
+        batch_size: Batch size of the measurement, used for the dynamic batch dimension.
+        objective: "latency" minimizes the median latency of one call, "throughput" maximizes the samples
+            per second of concurrent calls within the core budget.
+        repeat: Number of measured calls per configuration, and per caller for the throughput.
+        warmup: Number of calls before the measurement.
+        save: Whether to write the best configuration to `session_config_path(model_path)`.
+        zip_password: Password of an encrypted uniVision model.
+
+    Returns:
+        The best session configuration, see `utils.runtime.create_session_options`.
+    """
+    if objective not in TUNING_OBJECTIVES:
+        raise ValueError(
+            f"objective must be one of {TUNING_OBJECTIVES}, got {objective}."
+        )
+    core_budget = core_budget or os.cpu_count()
+    model_bytes, _ = read_univision_model(model_path, zip_password)
+    external_initializers = read_external_initializers(
+        model_path, model_bytes, zip_password
+    )
+    measured = {}
+
+    def score(result: Dict[str, float]) -> float:
+        return result["latency_ms"] if objective == "latency" else -result["throughput"]
+
+    def search(candidates: Sequence[dict]) -> dict:
+        for candidate in candidates:
+            key = json.dumps(candidate, sort_keys=True)
+            if key not in measured:
+                measured[key] = measure_session_config(
+                    model_bytes,
+                    candidate,
+                    core_budget,
+                    batch_size,
+                    repeat,
+                    warmup,
+                    external_initializers,
+                )
+                _print_result(candidate, measured[key])
+        return min(
+            candidates,
+            key=lambda candidate: score(
+                measured[json.dumps(candidate, sort_keys=True)]
+            ),
+        )
+
+    print(
+        f"{'intra':>5} {'inter':>5} {'mode':<10} {'arena':>5} {'pattern':>7} {'spin':>4} "
+        f"{'median ms':>10} {'p90 ms':>10} {'samples/s':>10}"
+    )
+    best = search(_thread_candidates(core_budget))
+    best = search(
+        [
+            {**best, "enable_cpu_mem_arena": arena, "enable_mem_pattern": pattern}
+            for arena in (True, False)
+            for pattern in (True, False)
+        ]
+    )
+    if best["intra_op_num_threads"] > 1:
+        best = search(
+            [{**best, "allow_spinning": spinning} for spinning in (True, False)]
+        )
+
+    result = measured[json.dumps(best, sort_keys=True)]
+    print(
+        f"Best for {objective} on {core_budget} cores: {best}, "
+        f"{result['latency_ms']:.2f} ms, {result['throughput']:.1f} samples/s"
+    )
+    if save:
+        path = session_config_path(model_path)
+        path.write_text(
+            json.dumps(
+                {
+                    "session_options": best,
+                    "objective": objective,
+                    "core_budget": core_budget,
+                    "cpu_count": os.cpu_count(),
+                    "batch_size": batch_size,
+                    "onnxruntime_version": onnxruntime.__version__,
+                    **result,
+                },
+                indent=2,
+            )
+        )
+        print(f"Session configuration saved to {path}")
+    return best
+
+
+def _print_result(session_config: dict, result: Dict[str, float]):
+    print(
+        f"{session_config['intra_op_num_threads']:>5} "
+        f"{session_config.get('inter_op_num_threads', '-'):>5} "
+        f"{session_config['execution_mode']:<10} "
+        f"{str(session_config.get('enable_cpu_mem_arena', '-')):>5} "
+        f"{str(session_config.get('enable_mem_pattern', '-')):>7} "
+        f"{str(session_config.get('allow_spinning', '-')):>4} "
+        f"{result['latency_ms']:>10.3f} {result['p90_ms']:>10.3f} {result['throughput']:>10.1f}"
+    )